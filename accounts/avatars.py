@@ -0,0 +1,136 @@
+"""
+Обработка аватаров: квадратные варианты фиксированных размеров в WebP и JPEG.
+
+Оригинал сохраняется как есть, варианты создаются в фоновом потоке.
+Имена файлов - хэш содержимого, поэтому их можно кэшировать навсегда:
+новый аватар всегда получает новые имена.
+
+    avatar_url(user, 40)          - URL для элемента 40px (JSON, шаблоны)
+    json_avatar_url(user)         - то же для JSON и событий (AVATAR_JSON_SIZE)
+    {% avatar_img user 40 "..." %} - <picture> с WebP и JPEG (accounts/templatetags/avatars.py)
+"""
+import hashlib
+import io
+import logging
+from functools import reduce
+from operator import or_
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db.models import Q
+
+from messenger import background, fragment_cache
+
+logger = logging.getLogger(__name__)
+
+FORMATS = {
+    'webp': {'format': 'WEBP', 'quality': 82, 'method': 4},
+    'jpeg': {'format': 'JPEG', 'quality': 85, 'optimize': True, 'progressive': True},
+}
+
+
+def sizes():
+    return sorted(getattr(settings, 'AVATAR_SIZES', (64, 128, 256)))
+
+
+def render_variants(source):
+    """
+    Варианты из открытого файла-оригинала: {размер: {формат: (имя, байты)}}.
+    Квадрат по центру, ориентация из EXIF, без метаданных.
+    """
+    from PIL import Image, ImageOps
+
+    with Image.open(source) as image:
+        image = ImageOps.exif_transpose(image)
+        if image.mode not in ('RGB', 'L'):
+            background_layer = Image.new('RGB', image.size, (255, 255, 255))
+            rgba = image.convert('RGBA')
+            background_layer.paste(rgba, mask=rgba.split()[-1])
+            image = background_layer
+        elif image.mode == 'L':
+            image = image.convert('RGB')
+
+        variants = {}
+        for size in sizes():
+            square = ImageOps.fit(image, (size, size), Image.Resampling.LANCZOS)
+            variants[size] = {}
+            for extension, options in FORMATS.items():
+                buffer = io.BytesIO()
+                square.save(buffer, **options)
+                data = buffer.getvalue()
+                digest = hashlib.sha256(data).hexdigest()[:20]
+                variants[size][extension] = (f'avatars/v/{digest}.{extension}', data)
+        return variants
+
+
+def process_avatar(user_id, avatar_name):
+    """
+    Создает варианты аватара и записывает их пользователю.
+    Если за это время аватар сменили, результат отбрасывается.
+    """
+    from .models import CustomUser
+
+    with default_storage.open(avatar_name, 'rb') as source:
+        variants = render_variants(source)
+
+    stored = {}
+    for size, formats in variants.items():
+        stored[str(size)] = {}
+        for extension, (name, data) in formats.items():
+            # Одинаковое содержимое - одинаковое имя: повторно не пишем
+            if not default_storage.exists(name):
+                name = default_storage.save(name, ContentFile(data))
+            stored[str(size)][extension] = name
+
+    updated = CustomUser.objects.filter(pk=user_id, avatar=avatar_name).update(avatar_variants=stored)
+    if updated:
+        # update() обходит сигналы: карточки пользователя сбрасываем сами
+        fragment_cache.invalidate_user(user_id)
+    return updated
+
+
+def schedule(user):
+    """Поставить обработку текущего аватара пользователя в фон"""
+    if user.avatar:
+        background.submit(process_avatar, user.pk, user.avatar.name)
+
+
+def referenced_variants(paths):
+    """Имена вариантов из paths, записанные хотя бы одному пользователю (для messenger.media_gc)"""
+    from .models import CustomUser
+
+    candidates = [path for path in paths if path.startswith('avatars/v/')]
+    if not candidates:
+        return set()
+    stored = set()
+    lookup = reduce(or_, (Q(avatar_variants__icontains=path) for path in candidates))
+    for variants in CustomUser.objects.filter(lookup).values_list('avatar_variants', flat=True):
+        for formats in (variants or {}).values():
+            stored.update(formats.values())
+    return stored & set(candidates)
+
+
+def pick_variant(user, size):
+    """Ключ наименьшего варианта не меньше size с учетом плотности экрана"""
+    variants = user.avatar_variants or {}
+    if not variants:
+        return None
+    wanted = size * getattr(settings, 'AVATAR_DENSITY', 2)
+    available = sorted(int(key) for key in variants)
+    return str(next((key for key in available if key >= wanted), available[-1]))
+
+
+def avatar_url(user, size, extension='webp'):
+    """URL аватара для элемента size px; оригинал, пока варианты не готовы; None без аватара"""
+    if not user.avatar:
+        return None
+    key = pick_variant(user, size)
+    if key is None:
+        return user.avatar.url
+    return default_storage.url(user.avatar_variants[key][extension])
+
+
+def json_avatar_url(user):
+    """URL аватара для JSON-ответов и событий WebSocket"""
+    return avatar_url(user, getattr(settings, 'AVATAR_JSON_SIZE', 40))
@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand
+
+from accounts.avatars import process_avatar
+from accounts.models import CustomUser
+
+
+class Command(BaseCommand):
+    help = 'Создает варианты аватаров (WebP/JPEG) для уже загруженных аватаров'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--force', action='store_true', help='пересоздать и готовые варианты')
+        parser.add_argument('--batch-size', type=int, default=100)
+
+    def handle(self, *args, **options):
+        users = CustomUser.objects.exclude(avatar='').exclude(avatar__isnull=True)
+        if not options['force']:
+            users = users.filter(avatar_variants={})
+
+        processed = failed = 0
+        for user_id, avatar_name in users.values_list('id', 'avatar').iterator(chunk_size=options['batch_size']):
+            try:
+                process_avatar(user_id, avatar_name)
+            except Exception as e:
+                failed += 1
+                self.stderr.write(f'{user_id}: {avatar_name}: {e}')
+                continue
+            processed += 1
+
+        self.stdout.write(self.style.SUCCESS(f'Обработано аватаров: {processed}, ошибок: {failed}'))
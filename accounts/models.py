@@ -6,6 +6,8 @@ from django.conf import settings
 class CustomUser(AbstractUser):
     bio = models.TextField(blank=True, null=True, verbose_name="О себе")
     avatar = models.ImageField(upload_to='avatars/', blank=True, null=True, verbose_name="Аватар")
+    # Готовые варианты аватара: {"64": {"webp": имя, "jpeg": имя}, ...} (accounts.avatars)
+    avatar_variants = models.JSONField(default=dict, blank=True, verbose_name="Варианты аватара")
     online = models.BooleanField(default=False, verbose_name="Онлайн")
     last_seen = models.DateTimeField(auto_now=True, verbose_name="Последний раз в сети")
 
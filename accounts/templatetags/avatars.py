@@ -0,0 +1,28 @@
+from django import template
+from django.utils.html import format_html
+
+from accounts.avatars import avatar_url, pick_variant
+
+register = template.Library()
+
+
+@register.filter(name='avatar_url')
+def avatar_url_filter(user, size):
+    """{{ user|avatar_url:40 }}"""
+    return avatar_url(user, int(size)) or ''
+
+
+@register.simple_tag
+def avatar_img(user, size, css_class=''):
+    """<picture> с WebP и JPEG нужного размера; до обработки - оригинал"""
+    if pick_variant(user, size) is None:
+        return format_html(
+            '<img src="{}" alt="{}" class="{}" width="{}" height="{}" loading="lazy">',
+            user.avatar.url, user.username, css_class, size, size,
+        )
+    return format_html(
+        '<picture><source type="image/webp" srcset="{}">'
+        '<img src="{}" alt="{}" class="{}" width="{}" height="{}" loading="lazy"></picture>',
+        avatar_url(user, size, 'webp'), avatar_url(user, size, 'jpeg'),
+        user.username, css_class, size, size,
+    )
@@ -5,6 +5,8 @@ from django.contrib.auth import update_session_auth_hash
 from django.contrib import messages
 from .forms import CustomUserCreationForm
 from .models import CustomUser
+from . import avatars
+from messenger import fragment_cache
 
 
 def register(request):
@@ -12,6 +14,7 @@ def register(request):
         form = CustomUserCreationForm(request.POST, request.FILES)
         if form.is_valid():
             user = form.save()
+            avatars.schedule(user)
             login(request, user)
             messages.success(request, 'Регистрация прошла успешно!')
             return redirect('chat_list')
@@ -28,7 +31,11 @@ def profile(request):
         user.bio = request.POST.get('bio', '')
         if 'avatar' in request.FILES:
             user.avatar = request.FILES['avatar']
+            # До фоновой обработки показывается оригинал
+            user.avatar_variants = {}
         user.save()
+        if 'avatar' in request.FILES:
+            avatars.schedule(user)
         messages.success(request, 'Профиль обновлен!')
         return redirect('profile')
 
@@ -38,4 +45,4 @@ def profile(request):
 @login_required
 def user_list(request):
     users = CustomUser.objects.exclude(id=request.user.id)
-    return render(request, 'accounts/user_list.html', {'users': users})
\ No newline at end of file
+    return render(request, 'accounts/user_list.html', {'cards': fragment_cache.user_cards(users)})
\ No newline at end of file
@@ -1,3 +1,22 @@
 from django.contrib import admin
+from django.template.defaultfilters import filesizeformat
 
-# Register your models here.
+from .models import StorageUsage
+
+
+@admin.register(StorageUsage)
+class StorageUsageAdmin(admin.ModelAdmin):
+    """Крупнейшие потребители места: список по индексу (scope, -bytes), без агрегатов"""
+    list_display = ('scope', 'object_id', 'size_display', 'files', 'updated_at')
+    list_filter = ('scope',)
+    ordering = ('-bytes',)
+    # Без COUNT(*) по всей таблице на каждой странице
+    show_full_result_count = False
+    readonly_fields = ('scope', 'object_id', 'bytes', 'files', 'updated_at')
+
+    @admin.display(description='Занято', ordering='bytes')
+    def size_display(self, usage):
+        return filesizeformat(usage.bytes)
+
+    def has_add_permission(self, request):
+        return False
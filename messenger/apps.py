@@ -4,3 +4,13 @@ from django.apps import AppConfig
 class MessengerConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'messenger'
+
+    def ready(self):
+        from django.db.backends.signals import connection_created
+        from . import broadcast, fragment_cache, profiling, querystats, quotas, sync
+        connection_created.connect(querystats.install)
+        fragment_cache.connect_signals()
+        sync.connect_signals()
+        broadcast.connect_signals()
+        quotas.connect_signals()
+        profiling.install_signal_handler()
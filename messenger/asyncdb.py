@@ -0,0 +1,60 @@
+"""
+Пул потоков для запросов к БД из консьюмеров WebSocket.
+
+database_sync_to_async из channels по умолчанию thread_sensitive: все
+консьюмеры процесса ждут один и тот же поток, и запросы выполняются
+строго по очереди. Здесь функции выполняются в отдельном пуле из
+CHAT_DB_EXECUTOR_WORKERS потоков (у каждого свое соединение с БД),
+поэтому события разных сокетов не стоят друг за другом.
+CHAT_DB_EXECUTOR_WORKERS = 0 возвращает поведение channels.
+
+Асинхронные методы ORM Django (aget, aexists, ...) внутри тоже
+sync_to_async в общий поток, поэтому консьюмеры их не используют:
+вся работа события с БД - одна функция и один переход в пул.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from functools import wraps
+
+from channels.db import DatabaseSyncToAsync
+from django.conf import settings
+
+from . import profiling
+
+_executor = None
+
+
+def workers():
+    return getattr(settings, 'CHAT_DB_EXECUTOR_WORKERS', 0)
+
+
+def executor():
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=workers(), thread_name_prefix='messenger-db')
+    return _executor
+
+
+def reset():
+    """Останавливает пул; следующий вызов создаст новый с текущими настройками"""
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=True)
+        _executor = None
+
+
+def database_sync_to_async(func):
+    """
+    Как database_sync_to_async из channels (закрывает устаревшие соединения
+    до и после), но в пуле executor() и с меткой профилировщика.
+    """
+    func = profiling.labelled(func)
+
+    @wraps(func)
+    async def wrapper(*args, **kwargs):
+        if workers():
+            call = DatabaseSyncToAsync(func, thread_sensitive=False, executor=executor())
+        else:
+            call = DatabaseSyncToAsync(func)
+        return await call(*args, **kwargs)
+
+    return wrapper
@@ -0,0 +1,45 @@
+"""
+Фоновые задачи процесса: ограниченный пул потоков без внешней очереди.
+
+Задача ставится после коммита транзакции, чтобы поток видел сохраненные
+данные. После выполнения соединение с БД потока закрывается. При
+BACKGROUND_TASKS_EAGER задачи выполняются сразу в вызывающем потоке
+(тесты, команды управления).
+"""
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import close_old_connections, connection, transaction
+
+logger = logging.getLogger(__name__)
+
+_executor = None
+
+
+def executor():
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(
+            max_workers=getattr(settings, 'BACKGROUND_WORKERS', 2),
+            thread_name_prefix='messenger-background',
+        )
+    return _executor
+
+
+def _run(func, args, kwargs):
+    close_old_connections()
+    try:
+        return func(*args, **kwargs)
+    except Exception:
+        logger.exception('Ошибка фоновой задачи %s', getattr(func, '__name__', func))
+    finally:
+        connection.close()
+
+
+def submit(func, *args, **kwargs):
+    """Выполнить func(*args, **kwargs) в фоне после коммита текущей транзакции"""
+    if getattr(settings, 'BACKGROUND_TASKS_EAGER', False):
+        transaction.on_commit(lambda: func(*args, **kwargs))
+        return
+    transaction.on_commit(lambda: executor().submit(_run, func, args, kwargs))
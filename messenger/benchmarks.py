@@ -0,0 +1,292 @@
+"""
+Нагрузочные замеры мессенджера (manage.py bench).
+
+Всё выполняется в процессе на отдельной тестовой базе: синтетические
+пользователи, чаты, сообщения и медиа, затем HTTP-запросы через тестовый
+клиент Django и N одновременных WebSocket-клиентов ChatConsumer.
+"""
+import asyncio
+import io
+import logging
+import random
+import time
+
+from django.contrib.auth import get_user_model
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import Client
+from django.urls import reverse
+
+from .models import ChatRoom, Message, MediaFile
+from .querystats import track_queries, logger as query_logger
+
+User = get_user_model()
+
+
+def percentile(sorted_values, q):
+    """Перцентиль q (0..100) по отсортированному списку"""
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(round(q / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def summarize(latencies, elapsed, queries=None):
+    """
+    Сводка по замерам: пропускная способность, перцентили в мс, запросы к БД.
+    queries - список QueryStats по одному на запрос.
+    """
+    latencies = sorted(latencies)
+    result = {
+        'count': len(latencies),
+        'throughput_per_sec': round(len(latencies) / elapsed, 1) if elapsed else None,
+        'p50_ms': round(percentile(latencies, 50) * 1000, 2) if latencies else None,
+        'p95_ms': round(percentile(latencies, 95) * 1000, 2) if latencies else None,
+        'p99_ms': round(percentile(latencies, 99) * 1000, 2) if latencies else None,
+    }
+    if queries:
+        result['queries_per_request'] = round(sum(stats.count for stats in queries) / len(queries), 1)
+        result['queries_max'] = max(stats.count for stats in queries)
+        result['duplicate_queries_per_request'] = round(sum(stats.duplicates for stats in queries) / len(queries), 1)
+        result['sql_ms_per_request'] = round(sum(stats.time for stats in queries) / len(queries) * 1000, 2)
+    return result
+
+
+def sample_image():
+    """Маленькая PNG-картинка (или просто байты, если нет Pillow)"""
+    try:
+        from PIL import Image
+    except ImportError:
+        return b'\x89PNG\r\n\x1a\n' + b'\x00' * 1024
+    buffer = io.BytesIO()
+    Image.new('RGB', (64, 64), (200, 100, 50)).save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
+def seed_data(users=50, chats=20, messages_per_chat=200, media_per_chat=10, seed=42):
+    """
+    Создает синтетические данные. Возвращает (пользователь для замеров, его чат).
+    Один и тот же seed дает одни и те же данные.
+    """
+    rng = random.Random(seed)
+    all_users = [
+        User.objects.create_user(username=f'bench_{i}', password='bench', email=f'bench_{i}@example.com')
+        for i in range(users)
+    ]
+    main_user = all_users[0]
+    image = sample_image()
+
+    main_chat = None
+    for chat_index in range(chats):
+        is_group = chat_index % 4 == 0
+        chat = ChatRoom.objects.create(is_group=is_group, name=f'Группа {chat_index}' if is_group else None)
+        members = [main_user] + rng.sample(all_users[1:], min(8 if is_group else 1, users - 1))
+        chat.participants.add(*members)
+        main_chat = main_chat or chat
+
+        Message.objects.bulk_create([
+            Message(
+                chat=chat,
+                sender=rng.choice(members),
+                content=f'Сообщение {i} ' * rng.randint(1, 5),
+                seq=i + 1,
+            )
+            for i in range(messages_per_chat)
+        ])
+        ChatRoom.objects.filter(pk=chat.pk).update(last_seq=messages_per_chat)
+
+        for i in range(media_per_chat):
+            sender = rng.choice(members)
+            media_file = MediaFile.objects.create(
+                chat=chat,
+                sender=sender,
+                file=SimpleUploadedFile(f'bench_{i}.png', image),
+                file_type='image',
+                file_name=f'bench_{i}.png',
+                file_size=len(image),
+                mime_type='image/png',
+            )
+            Message.objects.create(chat=chat, sender=sender, media_file=media_file)
+
+    return main_user, main_chat
+
+
+def http_scenarios(chat):
+    """Сценарии HTTP: имя -> функция(client), выполняющая один запрос"""
+    image = sample_image()
+    return {
+        'chat_list': lambda client: client.get(reverse('chat_list')),
+        'chat_detail': lambda client: client.get(reverse('chat_detail', args=[chat.id])),
+        'get_unread_count': lambda client: client.get(reverse('unread_count')),
+        'get_chat_media': lambda client: client.get(reverse('get_chat_media', args=[chat.id])),
+        'upload_media': lambda client: client.post(
+            reverse('upload_media', args=[chat.id]),
+            {'file': SimpleUploadedFile('bench.png', image)},
+        ),
+    }
+
+
+def run_http(user, chat, requests=50, warmup=3):
+    """Последовательные запросы к каждому сценарию"""
+    client = Client()
+    client.force_login(user)
+    results = {}
+    for name, scenario in http_scenarios(chat).items():
+        for _ in range(warmup):
+            scenario(client)
+
+        latencies, queries = [], []
+        started = time.perf_counter()
+        for _ in range(requests):
+            with track_queries(name) as stats:
+                request_started = time.perf_counter()
+                response = scenario(client)
+                latencies.append(time.perf_counter() - request_started)
+            if response.status_code != 200:
+                raise RuntimeError(f'{name}: HTTP {response.status_code}')
+            queries.append(stats)
+        results[name] = summarize(latencies, time.perf_counter() - started, queries)
+    return results
+
+
+async def _websocket_client(application, user, chat_id, messages, ready, start, latencies):
+    from channels.testing import WebsocketCommunicator
+
+    communicator = WebsocketCommunicator(application, f'/ws/chat/{chat_id}/')
+    communicator.scope['user'] = user
+    connected, _ = await communicator.connect(timeout=10)
+    if not connected:
+        raise RuntimeError('WebSocket: соединение отклонено')
+    ready.release()
+    await start.wait()
+
+    received = 0
+    for i in range(messages):
+        sent_at = time.perf_counter()
+        text = f'bench {user.id} {i}'
+        await communicator.send_json_to({'type': 'chat_message', 'message': text})
+        # Ждем эха своего сообщения, попутно читая чужие
+        while True:
+            event = await communicator.receive_json_from(timeout=30)
+            received += 1
+            if event.get('message') == text:
+                latencies.append(time.perf_counter() - sent_at)
+                break
+    await communicator.disconnect()
+    return received
+
+
+class _EventStatsHandler(logging.Handler):
+    """Собирает статистику запросов по событиям WebSocket из лога querystats"""
+
+    def __init__(self):
+        super().__init__()
+        self.events = []
+
+    def emit(self, record):
+        stats = getattr(record, 'query_stats', None)
+        if stats and stats['label'].startswith('ws:'):
+            self.events.append(stats)
+
+
+async def _run_websocket(clients, messages, users, chat):
+    # Консьюмеры работают в своем контексте, поэтому запросы берем из их логов
+    handler = _EventStatsHandler()
+    previous_level = query_logger.level
+    query_logger.addHandler(handler)
+    query_logger.setLevel(logging.INFO)
+    try:
+        result = await _run_websocket_clients(clients, messages, users, chat)
+    finally:
+        query_logger.removeHandler(handler)
+        query_logger.setLevel(previous_level)
+
+    sent = [stats for stats in handler.events if stats['label'] == 'ws:chat_message']
+    if sent:
+        result['queries_per_message'] = round(sum(stats['queries'] for stats in sent) / len(sent), 1)
+        result['sql_ms_per_message'] = round(sum(stats['sql_time_ms'] for stats in sent) / len(sent), 2)
+    return result
+
+
+async def _run_websocket_clients(clients, messages, users, chat):
+    from .routing import websocket_urlpatterns
+    from channels.routing import URLRouter
+
+    application = URLRouter(websocket_urlpatterns)
+    ready = asyncio.Semaphore(0)
+    start = asyncio.Event()
+    latencies = []
+    tasks = [
+        asyncio.ensure_future(_websocket_client(
+            application, users[i % len(users)], chat.id, messages, ready, start, latencies,
+        ))
+        for i in range(clients)
+    ]
+    for _ in range(clients):
+        await ready.acquire()
+
+    started = time.perf_counter()
+    start.set()
+    received = await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - started
+
+    result = summarize(latencies, elapsed)
+    result['clients'] = clients
+    result['events_delivered'] = sum(received)
+    result['events_per_sec'] = round(sum(received) / elapsed, 1)
+    return result
+
+
+def run_websocket(chat, clients=10, messages=20):
+    """N одновременных клиентов одного чата, каждый отправляет messages сообщений"""
+    users = list(chat.participants.all())
+    for i in range(len(users), clients):
+        # Для большого числа клиентов добавляем участников
+        user = User.objects.create_user(username=f'bench_ws_{i}', password='bench')
+        chat.participants.add(user)
+        users.append(user)
+    return asyncio.run(_run_websocket(clients, messages, users, chat))
+
+
+def run_websocket_sweep(chat, client_counts, messages=20):
+    """
+    События/с в зависимости от числа одновременных сокетов: насколько
+    пропускная способность упирается в потоки БД (CHAT_DB_EXECUTOR_WORKERS).
+    """
+    rows = []
+    for clients in client_counts:
+        result = run_websocket(chat, clients=clients, messages=messages)
+        rows.append({key: result.get(key) for key in (
+            'clients', 'events_per_sec', 'throughput_per_sec', 'p50_ms', 'p95_ms', 'queries_per_message',
+        )})
+    return rows
+
+
+def run_broadcast_comparison(chat, clients=10, messages=20):
+    """
+    Один и тот же чат в обычном и широковещательном режиме (messenger.broadcast):
+    события/с, задержки и число доставок слоя каналов на одно сообщение.
+    """
+    from channels.layers import get_channel_layer
+
+    layer = get_channel_layer()
+    layer_send = layer.send
+    sends = 0
+
+    async def counting_send(channel, message):
+        nonlocal sends
+        sends += 1
+        return await layer_send(channel, message)
+
+    layer.send = counting_send
+    results = {}
+    try:
+        for name, broadcast_tier in (('normal', False), ('broadcast', True)):
+            ChatRoom.objects.filter(pk=chat.pk).update(broadcast_tier=broadcast_tier)
+            sends = 0
+            result = run_websocket(chat, clients=clients, messages=messages)
+            result['layer_sends_per_message'] = round(sends / (clients * messages), 1)
+            results[name] = result
+    finally:
+        del layer.send
+        ChatRoom.objects.filter(pk=chat.pk).update(broadcast_tier=False)
+    return results
@@ -0,0 +1,204 @@
+"""
+Широковещательный режим для больших групп (CHAT_BROADCAST_THRESHOLD участников).
+
+Обычный чат - группа chat_<id>, в которой канал каждого соединения:
+одно сообщение - по доставке на участника онлайн. В большом чате
+(ChatRoom.broadcast_tier) в группе broadcast_<id> только хабы процессов,
+по одному каналу на процесс. Хаб складывает события в кольцевой буфер
+комнаты, а соединения процесса читают его сами (BaseChatConsumer
+.read_broadcast): одна доставка слоя каналов на процесс.
+
+Отставшее больше чем на буфер соединение получает resync_required.
+Цикл приема хаба переживает сбои слоя (перезапуск с восстановлением
+групп), а членство в группах продлевается до истечения group_expiry.
+Набор текста в таких чатах не рассылается.
+
+Чат переходит в режим автоматически, когда участников становится не
+меньше порога; подключенные соединения узнают об этом из события
+room_tier_changed и переносят подписку на хаб. Обратно режим не
+выключается.
+"""
+import asyncio
+import logging
+from collections import deque
+from itertools import islice
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.db import models, transaction
+
+from . import metrics
+from .models import ChatRoom, broadcast_group_name
+
+logger = logging.getLogger(__name__)
+
+
+# Пауза перед перезапуском упавшего цикла приема хаба, сек.
+RESTART_DELAY = 1
+
+
+def threshold():
+    return getattr(settings, 'CHAT_BROADCAST_THRESHOLD', 1000)
+
+
+def refresh_interval(layer):
+    """Как часто хаб заново добавляет себя в группы: до истечения group_expiry слоя"""
+    configured = getattr(settings, 'CHAT_BROADCAST_GROUP_REFRESH', None)
+    if configured:
+        return configured
+    return getattr(layer, 'group_expiry', 86400) / 2
+
+
+class RoomBuffer:
+    """Кольцевой буфер событий комнаты; позиция - номер события в процессе"""
+
+    def __init__(self, size):
+        self.events = deque(maxlen=size)
+        self.end = 0
+        self.readers = 0
+        self.changed = asyncio.Event()
+
+    def append(self, event):
+        self.events.append(event)
+        self.end += 1
+        changed, self.changed = self.changed, asyncio.Event()
+        changed.set()
+
+    def read(self, position):
+        """(события начиная с position, новая позиция); None вместо событий - читатель отстал"""
+        start = self.end - len(self.events)
+        if position < start:
+            return None, self.end
+        return list(islice(self.events, position - start, None)), self.end
+
+    async def wait(self, position):
+        """Ждет событий после position"""
+        while self.end <= position:
+            await self.changed.wait()
+
+
+class BroadcastHub:
+    """Один канал процесса на все большие комнаты, в которых есть его соединения"""
+
+    def __init__(self, layer):
+        self.layer = layer
+        self.loop = asyncio.get_running_loop()
+        self.channel = None
+        self.task = None
+        self.refresh_task = None
+        self.rooms = {}
+
+    async def join(self, chat_id):
+        room = self.rooms.get(chat_id)
+        if room is None:
+            room = self.rooms[chat_id] = RoomBuffer(getattr(settings, 'CHAT_BROADCAST_BUFFER', 1000))
+        room.readers += 1
+        if self.channel is None:
+            self.channel = await self.layer.new_channel('broadcast-hub.')
+            self.task = asyncio.ensure_future(self.receive_loop())
+            self.refresh_task = asyncio.ensure_future(self.refresh_loop())
+        # Повторное добавление продлевает членство в группе (group_expiry)
+        await self.layer.group_add(broadcast_group_name(chat_id, True), self.channel)
+        return room
+
+    async def leave(self, chat_id):
+        room = self.rooms.get(chat_id)
+        if room is None:
+            return
+        room.readers -= 1
+        if room.readers <= 0:
+            del self.rooms[chat_id]
+            await self.layer.group_discard(broadcast_group_name(chat_id, True), self.channel)
+
+    def dispatch(self, event):
+        room = self.rooms.get(event.get('chat_id'))
+        if room is None:
+            return
+        metrics.broadcast_events.inc()
+        room.append(event)
+
+    async def receive_events(self):
+        while True:
+            event = await self.layer.receive(self.channel)
+            try:
+                self.dispatch(event)
+            except Exception:
+                # Одно испорченное событие не останавливает доставку во все комнаты
+                logger.exception('Хаб: событие %r не обработано', event)
+
+    async def receive_loop(self):
+        """Прием событий; при сбое слоя - перезапуск с восстановлением групп"""
+        while True:
+            try:
+                await self.receive_events()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception('Хаб: цикл приема упал, перезапуск через %s с', RESTART_DELAY)
+                await asyncio.sleep(RESTART_DELAY)
+                # Слой мог потерять группы вместе с соединением
+                await self.refresh_groups()
+
+    async def refresh_groups(self):
+        """Заново добавляет канал хаба в группы всех комнат процесса"""
+        for chat_id in list(self.rooms):
+            try:
+                await self.layer.group_add(broadcast_group_name(chat_id, True), self.channel)
+            except Exception:
+                logger.exception('Хаб: группа чата %s не продлена', chat_id)
+
+    async def refresh_loop(self):
+        """Продлевает членство в группах раньше, чем его снимет group_expiry"""
+        while True:
+            await asyncio.sleep(refresh_interval(self.layer))
+            await self.refresh_groups()
+
+
+_hub = None
+
+
+def get_hub():
+    """Хаб текущего цикла событий (в Daphne цикл один на процесс)"""
+    global _hub
+    if _hub is None or _hub.loop is not asyncio.get_running_loop():
+        _hub = BroadcastHub(get_channel_layer())
+    return _hub
+
+
+# ==================== ПЕРЕХОД В РЕЖИМ ====================
+
+def enable(chat_id):
+    """
+    Включает режим для чата и после коммита сообщает подключенным
+    соединениям (room_tier_changed в старую группу).
+    """
+    if not ChatRoom.objects.filter(pk=chat_id, broadcast_tier=False).update(broadcast_tier=True):
+        return False
+    transaction.on_commit(lambda: async_to_sync(get_channel_layer().group_send)(
+        broadcast_group_name(chat_id),
+        {'type': 'room_tier_changed', 'chat_id': chat_id, 'broadcast': True},
+    ))
+    logger.info('Чат %s переведен в широковещательный режим', chat_id)
+    return True
+
+
+def participants_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if action != 'post_add':
+        return
+    chat_ids = pk_set if reverse else [instance.pk]
+    large = ChatRoom.objects.filter(pk__in=chat_ids, broadcast_tier=False).annotate(
+        members=models.Count('participants'),
+    ).filter(members__gte=threshold()).values_list('pk', flat=True)
+    for chat_id in large:
+        enable(chat_id)
+
+
+def connect_signals():
+    from django.db.models.signals import m2m_changed
+
+    m2m_changed.connect(
+        participants_changed,
+        sender=ChatRoom.participants.through,
+        dispatch_uid='broadcast.participants_changed',
+    )
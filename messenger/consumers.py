@@ -1,212 +1,830 @@
-import json
+import asyncio
+import logging
+import time
+from collections import deque
+from functools import partial
+from urllib.parse import parse_qs
+
 from channels.generic.websocket import AsyncWebsocketConsumer
-from channels.db import database_sync_to_async
+from django.conf import settings
 from django.contrib.auth import get_user_model
-from .models import ChatRoom, Message, MediaFile
+from django.utils import timezone
+from accounts.avatars import json_avatar_url
+from .models import ChatRoom, Message, MediaFile, broadcast_group_name
+from .asyncdb import database_sync_to_async
+from .protocol import FrameError, negotiate
+from .events import message_event
+from .replay import SeqWindow, get_buffer
+from . import broadcast, editing, fragment_cache, idempotency, metrics, outbox, profiling, ratelimit, sharding
+from .querystats import track_queries, check_budget, logger as query_logger
+
+logger = logging.getLogger(__name__)
 
 User = get_user_model()
 
 
-class ChatConsumer(AsyncWebsocketConsumer):
-    async def connect(self):
-        self.user = self.scope["user"]
-        if self.user.is_authenticated:
-            self.chat_id = self.scope['url_route']['kwargs']['chat_id']
-            self.room_group_name = f'chat_{self.chat_id}'
+class Subscription:
+    """
+    Подписка соединения на один чат.
+    credit - сколько событий клиент готов принять (None - без ограничений),
+    события сверх этого ждут в pending. broadcast - большой чат: события
+    читаются из буфера хаба процесса задачей reader (messenger.broadcast).
+    seen - номера, полученные из группы, sent - действительно отправленные
+    клиенту; gap_task дозапрашивает номера, не пришедшие вовремя.
+    """
 
-            if await self.is_participant():
-                await self.channel_layer.group_add(
-                    self.room_group_name,
-                    self.channel_name
-                )
-                await self.accept()
-                await self.update_user_status(True)
-            else:
-                await self.close()
-        else:
-            await self.close()
+    def __init__(self, chat_id, last_seq=None, credit=None, broadcast=False):
+        self.chat_id = chat_id
+        self.broadcast = broadcast
+        self.group_name = broadcast_group_name(chat_id, broadcast)
+        self.reader = None
+        self.seen = SeqWindow(last_seq)
+        self.sent = SeqWindow(last_seq)
+        self.gap_task = None
+        self.credit = credit
+        self.pending = deque()
+        self.resync_required = False
+
+    @property
+    def last_seq(self):
+        """Все номера до этого включительно получены"""
+        return self.seen.last_seq
+
+    @property
+    def sent_seq(self):
+        """Все номера до этого включительно отправлены клиенту"""
+        return self.sent.last_seq
+
+
+class BaseChatConsumer(AsyncWebsocketConsumer):
+    """
+    Общая логика чата: подписки на группы чатов, досылка пропущенного,
+    обработка входящих кадров и доставка событий групп клиенту.
+    """
+
+    # Типы событий, которые нумеруются и досылаются
+    SEQUENCED_TYPES = ('chat_message', 'media_message', 'voice_message', 'message_patch')
+    # Кадры клиента -> действия messenger.editing
+    EDIT_ACTIONS = {'edit_message': 'edit', 'delete_message': 'delete', 'unsend_message': 'unsend'}
+
+    async def websocket_connect(self, message):
+        self.subscriptions = {}
+        # Очередь отправки: события групп не ждут медленного клиента
+        self.send_queue = deque()
+        # Транспорт Daphne: его буфер записи - настоящий объем неотправленного
+        self.transport = find_transport(self.base_send)
+        self.send_queue_ready = asyncio.Event()
+        self.send_queue_congested = False
+        self.send_queue_collapsed = False
+        self.send_queue_collapsed_at = None
+        self.writer_task = None
+        self.shard_task = None
+        self.accepted = False
+        await super().websocket_connect(message)
 
     async def disconnect(self, close_code):
-        if hasattr(self, 'room_group_name'):
-            await self.channel_layer.group_discard(
-                self.room_group_name,
-                self.channel_name
-            )
+        if self.accepted:
+            self.accepted = False
+            metrics.ws_connections.dec()
+        if self.writer_task is not None:
+            self.writer_task.cancel()
+        if self.shard_task is not None:
+            self.shard_task.cancel()
+        metrics.ws_send_queue_depth.dec(len(self.send_queue))
+        self.send_queue.clear()
+
+        for subscription in list(self.subscriptions.values()):
+            await self.unsubscribe(subscription.chat_id)
 
         if self.user.is_authenticated:
             await self.update_user_status(False)
 
-    async def receive(self, text_data):
+    async def accept_connection(self, online=False):
+        """
+        Принимает соединение; одно обновление статуса на всё соединение.
+        online=True - статус уже обновлен вместе с проверкой участия (join_chat).
+        """
+        # JSON по умолчанию, бинарный протокол - если клиент его запросил
+        self.codec = negotiate(self.scope.get('subprotocols'))
+        await self.accept(subprotocol=self.codec.subprotocol)
+        self.accepted = True
+        metrics.ws_connections.inc()
+        self.writer_task = asyncio.ensure_future(self.write_loop())
+        if sharding.enabled():
+            self.shard_task = asyncio.ensure_future(self.watch_shard())
+        if not online:
+            await self.update_user_status(True)
+
+    async def subscribe(self, chat_id, last_seq=None, credit=None, chat_state=None):
+        """
+        Подписка на чат; False, если пользователь не участник.
+        chat_state - (режим чата, его last_seq), если участие уже проверено (join_chat).
+        Без last_seq клиента отсчет идет от текущего номера чата.
+        """
+        if chat_id in self.subscriptions:
+            await self.unsubscribe(chat_id)
+        if chat_state is None:
+            chat_state = await self.is_participant(chat_id)
+            if chat_state is None:
+                return False
+        broadcast_tier, chat_seq = chat_state
+
+        subscription = Subscription(chat_id, chat_seq if last_seq is None else last_seq, credit, broadcast_tier)
+        self.subscriptions[chat_id] = subscription
+        if broadcast_tier:
+            await self.attach_broadcast(subscription)
+        else:
+            await self.channel_layer.group_add(subscription.group_name, self.channel_name)
+        return True
+
+    async def unsubscribe(self, chat_id):
+        subscription = self.subscriptions.pop(chat_id, None)
+        if subscription is None:
+            return
+        if subscription.gap_task is not None:
+            subscription.gap_task.cancel()
+        if subscription.broadcast:
+            subscription.reader.cancel()
+            await broadcast.get_hub().leave(chat_id)
+        else:
+            await self.channel_layer.group_discard(subscription.group_name, self.channel_name)
+
+    async def attach_broadcast(self, subscription):
+        """Чтение событий большого чата из буфера хаба процесса"""
+        room = await broadcast.get_hub().join(subscription.chat_id)
+        subscription.reader = asyncio.ensure_future(self.read_broadcast(subscription, room, room.end))
+
+    async def read_broadcast(self, subscription, room, position):
+        while not subscription.resync_required:
+            events, position = room.read(position)
+            if events is None:
+                # Отстали больше чем на буфер - клиент переподпишется с last_seq
+                await self.require_resync(subscription)
+                return
+            for event in events:
+                await self.deliver(event)
+            await room.wait(position)
+
+    async def receive(self, text_data=None, bytes_data=None):
         try:
-            data = json.loads(text_data)
-            message_type = data.get('type')
-
-            if message_type == 'chat_message':
-                message = data.get('message', '').strip()
-                if message:
-                    saved_message = await self.save_message(message)
-
-                    # ОТПРАВЛЯЕМ В ГРУППУ - ЭТО КЛЮЧЕВОЕ!
-                    await self.channel_layer.group_send(
-                        self.room_group_name,
-                        {
-                            'type': 'chat_message',
-                            'message': message,
-                            'sender_id': self.user.id,
-                            'sender_username': self.user.username,
-                            'timestamp': saved_message.timestamp.isoformat(),
-                            'message_id': saved_message.id,
-                        }
-                    )
-
-            elif message_type == 'media_message':
-                # Получаем данные медиа из БД после загрузки
-                message_id = data.get('message_id')
-                if message_id:
-                    media_data = await self.get_media_data(message_id)
-                    if media_data:
-                        await self.channel_layer.group_send(
-                            self.room_group_name,
-                            {
-                                'type': 'media_message',
-                                'sender_id': self.user.id,
-                                'sender_username': self.user.username,
-                                'message_id': message_id,
-                                'media': media_data,
-                                'content': data.get('caption', '')
-                            }
-                        )
-
-            elif message_type == 'voice_message':
-                message_id = data.get('message_id')
-                if message_id:
-                    voice_data = await self.get_voice_data(message_id)
-                    if voice_data:
-                        await self.channel_layer.group_send(
-                            self.room_group_name,
-                            {
-                                'type': 'voice_message',
-                                'sender_id': self.user.id,
-                                'sender_username': self.user.username,
-                                'message_id': message_id,
-                                'voice': voice_data
-                            }
-                        )
-
-            elif message_type == 'typing':
-                await self.channel_layer.group_send(
-                    self.room_group_name,
-                    {
-                        'type': 'typing',
-                        'user_id': self.user.id,
-                        'username': self.user.username,
-                        'is_typing': data.get('is_typing', False)
-                    }
-                )
-
-        except Exception as e:
-            print(f"Ошибка в WebSocket: {e}")
+            data = self.codec.decode(text_data, bytes_data)
+            metrics.ws_events_received.labels(metrics.frame_type(data.get('type'))).inc()
+            label = f"ws:{data.get('type')}"
+            with track_queries(label) as stats, profiling.tag(label):
+                await self.handle_message(data)
+            query_logger.info('websocket', extra={'query_stats': stats.as_dict()})
+            check_budget(stats)
+        except FrameError as error:
+            metrics.ws_errors.inc()
+            logger.warning('Кадр WebSocket отклонен (%s), соединение закрыто', error)
+            await self.close(code=error.close_code)
+        except Exception:
+            metrics.ws_errors.inc()
+            logger.exception('Ошибка в WebSocket')
+
+    async def handle_message(self, data):
+        raise NotImplementedError
+
+    async def reject_wrong_shard(self, chat_id):
+        """Чат обслуживает другой шард: адрес владельца и закрытие с кодом 4009"""
+        self.codec = negotiate(self.scope.get('subprotocols'))
+        await self.accept(subprotocol=self.codec.subprotocol)
+        data = self.codec.encode(sharding.redirect_event(chat_id))
+        if self.codec.binary:
+            await self.send(bytes_data=data)
+        else:
+            await self.send(text_data=data)
+        await self.close(code=sharding.WRONG_SHARD_CLOSE_CODE)
+
+    async def watch_shard(self):
+        """Следит за картой шардов: чаты, переехавшие на другой шард, отпускаем"""
+        interval = getattr(settings, 'CHAT_SHARD_WATCH_INTERVAL', 5)
+        while True:
+            await asyncio.sleep(interval)
+            for chat_id in list(self.subscriptions):
+                if not sharding.is_local(chat_id):
+                    await self.chat_moved(chat_id)
+
+    async def chat_moved(self, chat_id):
+        """Чат переехал: клиент переподпишется у владельца с last_seq"""
+        await self.unsubscribe(chat_id)
+        await self.send_event(sharding.redirect_event(chat_id))
+
+    async def group_send(self, group_name, event):
+        """group_send с замером задержки слоя каналов"""
+        started = time.perf_counter()
+        await self.channel_layer.group_send(group_name, event)
+        metrics.ws_group_send_seconds.labels(event['type']).observe(time.perf_counter() - started)
+
+    async def handle_frame(self, subscription, data):
+        """Обработка кадра клиента, относящегося к чату subscription"""
+        chat_id = subscription.chat_id
+        message_type = data.get('type')
+
+        if message_type == 'chat_message':
+            message = data.get('message', '').strip()
+            if message:
+                client_id = idempotency.clean(data.get('client_id'))
+                if client_id:
+                    # Повтор после таймаута: исходное сообщение уже разослано
+                    ack = idempotency.recent(chat_id, self.user.id, client_id)
+                    if ack is not None:
+                        await self.send_ack(chat_id, client_id, ack)
+                        return
+
+                retry_after = ratelimit.check('message', self.user.id, chat_id)
+                if retry_after is not None:
+                    await self.send_error(chat_id, 'rate_limited', retry_after=round(retry_after, 1))
+                    return
+
+                saved_message, created = await self.save_message(chat_id, message, client_id)
+                if not created:
+                    await self.send_ack(chat_id, client_id, idempotency.message_ack(saved_message))
+                    return
+
+                event = {
+                    'type': 'chat_message',
+                    'chat_id': chat_id,
+                    'message': message,
+                    'sender_id': self.user.id,
+                    'sender_username': self.user.username,
+                    'sender_avatar': json_avatar_url(self.user),
+                    'timestamp': saved_message.timestamp.isoformat(),
+                    'message_id': saved_message.id,
+                    'seq': saved_message.seq,
+                }
+                if client_id:
+                    event['client_id'] = client_id
+                # ОТПРАВЛЯЕМ В ГРУППУ - ЭТО КЛЮЧЕВОЕ!
+                await self.group_send(subscription.group_name, event)
+
+        elif message_type in self.EDIT_ACTIONS:
+            message_id = data.get('message_id')
+            if ratelimit.check('message', self.user.id, chat_id) is not None:
+                await self.send_error(chat_id, 'rate_limited', message_id=message_id)
+                return
+            try:
+                event = await self.change_message(chat_id, message_id, self.EDIT_ACTIONS[message_type], data.get('message', ''))
+            except editing.EditRejected as error:
+                await self.send_error(chat_id, error.code, message_id=message_id)
+                return
+            await self.group_send(subscription.group_name, event)
+
+        elif message_type in ('media_message', 'voice_message'):
+            # Только для старых клиентов: новые загрузки рассылает само
+            # представление через outbox, повторно их не отправляем
+            message_id = data.get('message_id')
+            if message_id:
+                event = await self.get_media_event(chat_id, message_id)
+                if event and event['type'] == message_type:
+                    await self.group_send(subscription.group_name, event)
+
+        elif message_type == 'typing':
+            if subscription.broadcast:
+                return  # в больших чатах набор текста не рассылается
+            if ratelimit.check('typing', self.user.id) is not None:
+                return  # лишние события набора текста просто не рассылаем
+            await self.group_send(
+                subscription.group_name,
+                {
+                    'type': 'typing',
+                    'chat_id': chat_id,
+                    'user_id': self.user.id,
+                    'username': self.user.username,
+                    'is_typing': data.get('is_typing', False)
+                }
+            )
+
+    async def send_event(self, event):
+        """
+        Постановка события в очередь отправки клиенту.
+
+        Очередь растет, только пока write_loop ждет клиента. Daphne пишет
+        в транспорт Twisted синхронно и не ждет, пока сокет освободится,
+        поэтому write_loop сам ждет, пока буфер записи транспорта
+        (transport_backlog) не опустится ниже CHAT_SEND_BUFFER_LOW, если он
+        вырос выше CHAT_SEND_BUFFER_HIGH. Сервер, чей send() сам ждет сокет
+        (uvicorn), дает тот же эффект без замера.
+
+        Выше CHAT_SEND_QUEUE_HIGH_WATERMARK события набора текста отбрасываются
+        (пока очередь не опустится до LOW_WATERMARK). При CHAT_SEND_QUEUE_MAX
+        очередь схлопывается в уведомления resync_required, а если клиент
+        не прочитал даже их за CHAT_SEND_STALL_TIMEOUT - соединение закрывается.
+        """
+        depth = len(self.send_queue)
+        if depth >= getattr(settings, 'CHAT_SEND_QUEUE_HIGH_WATERMARK', 100):
+            self.send_queue_congested = True
+        elif depth <= getattr(settings, 'CHAT_SEND_QUEUE_LOW_WATERMARK', 20):
+            self.send_queue_congested = False
+
+        if self.send_queue_congested and event['type'] == 'typing':
+            metrics.ws_send_queue_dropped.labels('typing').inc()
+            return
+
+        if depth >= getattr(settings, 'CHAT_SEND_QUEUE_MAX', 500):
+            if self.send_queue_collapsed:
+                await self.disconnect_slow_consumer()
+                return
+            self.collapse_send_queue()
+            if event['type'] in self.SEQUENCED_TYPES:
+                return  # клиент получит его при переподписке с last_seq
+
+        self.enqueue(event)
+
+    async def send_error(self, chat_id, code, **extra):
+        await self.send_event({'type': 'error', 'chat_id': chat_id, 'code': code, **extra})
+
+    async def send_ack(self, chat_id, client_id, ack):
+        """Ответ отправителю на повтор: сообщение с этим client_id уже сохранено"""
+        await self.send_event({'type': 'message_ack', 'chat_id': chat_id, 'client_id': client_id, 'duplicate': True, **ack})
+
+    def enqueue(self, event):
+        self.send_queue.append(event)
+        metrics.ws_send_queue_depth.inc()
+        self.send_queue_ready.set()
+
+    def collapse_send_queue(self):
+        """Заменяет очередь событий чатов уведомлениями resync_required"""
+        control = [event for event in self.send_queue if event['type'] not in self.SEQUENCED_TYPES + ('typing',)]
+        metrics.ws_send_queue_dropped.labels('collapsed').inc(len(self.send_queue) - len(control))
+        metrics.ws_send_queue_depth.dec(len(self.send_queue))
+        self.send_queue.clear()
+        for event in control:
+            self.enqueue(event)
+
+        for subscription in self.subscriptions.values():
+            self.mark_resync(subscription)
+            self.enqueue(self.resync_event(subscription))
+        self.send_queue_collapsed = True
+        self.send_queue_collapsed_at = time.monotonic()
+
+    def is_stalled(self):
+        """Клиент не прочитал уведомления resync_required за отведенное время"""
+        return (self.send_queue_collapsed and
+                time.monotonic() - self.send_queue_collapsed_at > getattr(settings, 'CHAT_SEND_STALL_TIMEOUT', 30))
+
+    async def disconnect_slow_consumer(self):
+        metrics.ws_slow_consumer_disconnects.inc()
+        metrics.ws_send_queue_depth.dec(len(self.send_queue))
+        self.send_queue.clear()
+        self.send_queue_collapsed = False
+        if self.writer_task is not None:
+            self.writer_task.cancel()
+        for subscription in list(self.subscriptions.values()):
+            await self.unsubscribe(subscription.chat_id)
+        await self.close(code=4008)
+
+    async def write_loop(self):
+        """Отправляет события из очереди по мере готовности клиента"""
+        while True:
+            while not self.send_queue:
+                self.send_queue_ready.clear()
+                await self.send_queue_ready.wait()
+
+            event = self.send_queue.popleft()
+            metrics.ws_send_queue_depth.dec()
+
+            data = self.codec.encode(event)
+            if self.codec.binary:
+                await self.send(bytes_data=data)
+            else:
+                await self.send(text_data=data)
+            await self.wait_for_drain()
+
+            if not self.send_queue:
+                # Клиент прочитал всё, включая уведомления resync_required
+                self.send_queue_collapsed = False
+
+            seq = event.get('seq')
+            if seq is not None:
+                subscription = self.subscriptions.get(event.get('chat_id'))
+                if subscription is not None:
+                    subscription.sent.add(seq)
+
+    async def wait_for_drain(self):
+        """Клиент не успевает читать: ждем, пока буфер записи транспорта освободится"""
+        backlog = transport_backlog(self.transport)
+        if backlog is None or backlog <= getattr(settings, 'CHAT_SEND_BUFFER_HIGH', 256 * 1024):
+            return
+        metrics.ws_send_buffer_waits.inc()
+        low = getattr(settings, 'CHAT_SEND_BUFFER_LOW', 64 * 1024)
+        interval = getattr(settings, 'CHAT_SEND_DRAIN_INTERVAL', 0.05)
+        while backlog is not None and backlog > low:
+            await asyncio.sleep(interval)
+            backlog = transport_backlog(self.transport)
+
+    async def deliver(self, event):
+        """
+        Доставка события группы клиенту с учетом подписки:
+        повторы по seq отбрасываются, без кредита события ждут в очереди.
+        Событие с номером меньше уже доставленного - не повтор, если этого
+        номера еще не было (конкурентные отправители): оно доставляется.
+        """
+        if self.is_stalled():
+            await self.disconnect_slow_consumer()
+            return
+
+        subscription = self.subscriptions.get(event['chat_id'])
+        if subscription is None or subscription.resync_required:
+            return
+
+        seq = event.get('seq')
+        if seq is not None:
+            get_buffer(subscription.chat_id).append(event)
+            if not subscription.seen.add(seq):
+                return
+            if subscription.seen.has_gap:
+                self.watch_gap(subscription)
+
+        if subscription.credit is None:
+            await self.send_event(event)
+        elif subscription.credit > 0 and not subscription.pending:
+            subscription.credit -= 1
+            await self.send_event(event)
+        elif seq is not None:
+            # Набор текста без кредита просто теряется, сообщения - ждут
+            subscription.pending.append(event)
+            if len(subscription.pending) > getattr(settings, 'CHAT_MUX_MAX_PENDING', 200):
+                await self.require_resync(subscription)
+
+    def watch_gap(self, subscription):
+        if subscription.gap_task is None or subscription.gap_task.done():
+            subscription.gap_task = asyncio.ensure_future(self.fill_gap(subscription))
+
+    async def fill_gap(self, subscription):
+        """
+        Пропуск в номерах не закрылся за CHAT_SEQ_GAP_TIMEOUT: недостающие
+        события берутся из базы, а номера, которых нет и там (отозванные
+        сообщения), считаются пропущенными окончательно.
+        """
+        await asyncio.sleep(getattr(settings, 'CHAT_SEQ_GAP_TIMEOUT', 2))
+        seen = subscription.seen
+        if subscription.resync_required or not seen.has_gap:
+            return
+        until = max(seen.ahead)
+        limit = getattr(settings, 'CHAT_REPLAY_MAX_EVENTS', 500)
+        for event in await self.get_events_since(subscription.chat_id, seen.last_seq, limit):
+            if event['seq'] > until:
+                break
+            await self.deliver(event)
+        seen.settle(until)
+        subscription.gap_task = None
+        if seen.has_gap:
+            self.watch_gap(subscription)
+
+    async def add_credit(self, subscription, credit):
+        """Клиент разрешил принять еще credit событий (без окна - ничего не меняет)"""
+        if subscription.credit is None:
+            return
+        subscription.credit += credit
+        while subscription.pending and subscription.credit > 0:
+            subscription.credit -= 1
+            await self.send_event(subscription.pending.popleft())
+
+    async def require_resync(self, subscription):
+        """Клиент слишком отстал: очередь сбрасывается, он переподписывается с last_seq"""
+        self.mark_resync(subscription)
+        await self.send_event(self.resync_event(subscription))
+
+    def mark_resync(self, subscription):
+        subscription.pending.clear()
+        subscription.resync_required = True
+
+    def resync_event(self, subscription):
+        metrics.ws_resync_notices.inc()
+        return {
+            'type': 'resync_required',
+            'chat_id': subscription.chat_id,
+            'last_seq': subscription.sent_seq,
+        }
+
+    async def replay_missed(self, subscription, last_seq):
+        """Досылает события, пропущенные клиентом, пока он был отключен"""
+        events = get_buffer(subscription.chat_id).since(last_seq) or []
+        after_seq = events[-1]['seq'] if events else last_seq
+
+        # Всё, чего нет в буфере, берем из базы
+        limit = getattr(settings, 'CHAT_REPLAY_MAX_EVENTS', 500)
+        db_events = await self.get_events_since(subscription.chat_id, after_seq, limit + 1)
+        if len(events) + len(db_events) > limit:
+            # Пропущено слишком много - клиенту проще перезагрузить историю
+            await self.require_resync(subscription)
+            return
+
+        for event in events + db_events:
+            await self.deliver(event)
 
     async def chat_message(self, event):
         """Отправка текстового сообщения"""
-        await self.send(text_data=json.dumps({
+        payload = {
             'type': 'chat_message',
+            'chat_id': event['chat_id'],
             'message': event['message'],
             'sender_id': event['sender_id'],
             'sender_username': event['sender_username'],
+            'sender_avatar': event.get('sender_avatar'),
             'timestamp': event['timestamp'],
             'message_id': event['message_id'],
-        }))
+            'seq': event['seq'],
+        }
+        if 'client_id' in event:
+            payload['client_id'] = event['client_id']
+        await self.deliver(payload)
 
     async def media_message(self, event):
         """Отправка медиа-сообщения"""
-        await self.send(text_data=json.dumps({
+        await self.deliver({
             'type': 'media_message',
+            'chat_id': event['chat_id'],
             'sender_id': event['sender_id'],
             'sender_username': event['sender_username'],
+            'sender_avatar': event.get('sender_avatar'),
+            'timestamp': event['timestamp'],
             'message_id': event['message_id'],
+            'seq': event['seq'],
             'media': event['media'],
             'content': event.get('content', '')
-        }))
+        })
 
     async def voice_message(self, event):
         """Отправка голосового сообщения"""
-        await self.send(text_data=json.dumps({
+        await self.deliver({
             'type': 'voice_message',
+            'chat_id': event['chat_id'],
             'sender_id': event['sender_id'],
             'sender_username': event['sender_username'],
+            'sender_avatar': event.get('sender_avatar'),
+            'timestamp': event['timestamp'],
             'message_id': event['message_id'],
+            'seq': event['seq'],
             'voice': event['voice']
-        }))
+        })
+
+    async def media_updated(self, event):
+        """Метаданные медиафайла после фоновой обработки"""
+        await self.deliver(event)
+
+    async def message_patch(self, event):
+        """Изменение отправленного сообщения: правка, удаление, отзыв"""
+        await self.deliver(event)
+
+    async def room_tier_changed(self, event):
+        """Чат стал большим: подписка переносится из группы соединений на хаб процесса"""
+        subscription = self.subscriptions.get(event['chat_id'])
+        if subscription is None or subscription.broadcast:
+            return
+        await self.channel_layer.group_discard(subscription.group_name, self.channel_name)
+        subscription.broadcast = True
+        subscription.group_name = broadcast_group_name(subscription.chat_id, True)
+        await self.attach_broadcast(subscription)
+        if subscription.last_seq is not None:
+            # Что успели разослать в новую группу до переноса
+            await self.replay_missed(subscription, subscription.last_seq)
 
     async def typing(self, event):
         """Индикатор набора текста"""
-        await self.send(text_data=json.dumps({
+        await self.deliver({
             'type': 'typing',
+            'chat_id': event['chat_id'],
             'user_id': event['user_id'],
             'username': event['username'],
             'is_typing': event['is_typing']
-        }))
+        })
+
+    def check_participant(self, chat_id):
+        """(режим чата, last_seq), если пользователь участник; иначе None"""
+        return ChatRoom.objects.filter(
+            id=chat_id,
+            participants=self.user.id,
+        ).values_list('broadcast_tier', 'last_seq').first()
+
+    def set_user_status(self, online):
+        # Один UPDATE вместо загрузки и полного сохранения пользователя
+        User.objects.filter(id=self.user.id).update(online=online, last_seen=timezone.now())
+        # update() обходит сигналы: карточки пользователя сбрасываем сами
+        fragment_cache.invalidate_user(self.user.id)
+
+    is_participant = database_sync_to_async(check_participant)
+    update_user_status = database_sync_to_async(set_user_status)
 
     @database_sync_to_async
-    def is_participant(self):
-        try:
-            chat = ChatRoom.objects.get(id=self.chat_id)
-            return self.user in chat.participants.all()
-        except ChatRoom.DoesNotExist:
-            return False
+    def join_chat(self, chat_id):
+        """Проверка участия и статус "в сети" за один переход в поток БД; (режим, last_seq) или None"""
+        chat_state = self.check_participant(chat_id)
+        if chat_state is not None:
+            self.set_user_status(True)
+        return chat_state
 
     @database_sync_to_async
-    def save_message(self, content):
-        chat = ChatRoom.objects.get(id=self.chat_id)
-        message = Message.objects.create(
-            chat=chat,
-            sender=self.user,
-            content=content
+    def save_message(self, chat_id, content, client_id=None):
+        """(сообщение, создано ли); повтор client_id возвращает исходное"""
+        # Чат не загружается: номер и updated_at выдает ChatRoom.allocate_seq
+        return idempotency.create_message(
+            chat_id,
+            self.user,
+            client_id,
+            content=content,
         )
-        chat.updated_at = message.timestamp
-        chat.save()
-        return message
 
     @database_sync_to_async
-    def get_media_data(self, message_id):
-        """Получение данных медиафайла для отправки"""
+    def change_message(self, chat_id, message_id, action, content):
+        """Событие message_patch; EditRejected - действие невозможно"""
         try:
-            message = Message.objects.select_related('media_file').get(id=message_id)
-            if message.media_file:
-                return {
-                    'id': message.media_file.id,
-                    'url': message.media_file.file.url,
-                    'thumbnail_url': message.media_file.get_thumbnail_url(),
-                    'type': message.media_file.file_type,
-                    'name': message.media_file.file_name,
-                    'size': message.media_file.get_file_size_display(),
-                }
+            message_id = int(message_id)
+        except (TypeError, ValueError):
+            raise editing.EditRejected('not_found')
+        _, event = editing.perform(self.user, message_id, action, content, chat_id=chat_id)
+        return event
+
+    @database_sync_to_async
+    def get_media_event(self, chat_id, message_id):
+        """Событие медиа- или голосового сообщения чата; None, если оно уже разослано"""
+        if outbox.is_published(message_id):
+            return None
+        try:
+            message = Message.objects.select_related('sender', 'media_file').get(
+                id=message_id,
+                chat_id=chat_id,
+            )
         except Message.DoesNotExist:
             return None
-        return None
+        if message.media_file is None:
+            return None
+        return message_event(message)
 
     @database_sync_to_async
-    def get_voice_data(self, message_id):
-        """Получение данных голосового сообщения"""
+    def get_events_since(self, chat_id, seq, limit):
+        """События сообщений и их изменений (message_patch) с номером больше seq"""
+        messages = Message.objects.filter(
+            chat_id=chat_id,
+            seq__gt=seq,
+        ).select_related('sender', 'media_file').order_by('seq')[:limit]
+        events = [message_event(message) for message in messages]
+        events += editing.patch_events_since(chat_id, seq, limit)
+        return sorted(events, key=lambda event: event['seq'])[:limit]
+
+
+class ChatConsumer(BaseChatConsumer):
+    """Одно соединение - один чат: ws/chat/<chat_id>/"""
+
+    async def connect(self):
+        self.user = self.scope["user"]
+        if self.user.is_authenticated:
+            self.chat_id = self.scope['url_route']['kwargs']['chat_id']
+            self.room_group_name = f'chat_{self.chat_id}'
+            last_seq = self.get_resume_seq()
+            if not sharding.is_local(self.chat_id):
+                await self.reject_wrong_shard(self.chat_id)
+                return
+
+            chat_state = await self.join_chat(self.chat_id)
+            if chat_state is not None:
+                await self.subscribe(self.chat_id, last_seq, chat_state=chat_state)
+                await self.accept_connection(online=True)
+                if last_seq is not None:
+                    await self.replay_missed(self.subscriptions[self.chat_id], last_seq)
+            else:
+                await self.close()
+        else:
+            await self.close()
+
+    async def handle_message(self, data):
+        subscription = self.subscriptions.get(self.chat_id)
+        if subscription is not None:
+            await self.handle_frame(subscription, data)
+
+    async def chat_moved(self, chat_id):
+        """Единственный чат соединения переехал: закрываемся, клиент переподключится к владельцу"""
+        await super().chat_moved(chat_id)
+        # Даем writer отправить wrong_shard до закрытия (не дольше секунды)
+        for _ in range(100):
+            if not self.send_queue:
+                break
+            await asyncio.sleep(0.01)
+        await self.close(code=sharding.WRONG_SHARD_CLOSE_CODE)
+
+    def get_resume_seq(self):
+        """last_seq из строки запроса: ws/chat/<id>/?last_seq=N"""
+        query = parse_qs(self.scope.get('query_string', b'').decode())
         try:
-            message = Message.objects.select_related('media_file').get(id=message_id)
-            if message.media_file and message.media_file.file_type == 'voice':
-                return {
-                    'id': message.media_file.id,
-                    'url': message.media_file.file.url,
-                    'duration': message.media_file.duration,
-                    'size': message.media_file.get_file_size_display(),
-                }
-        except Message.DoesNotExist:
+            return int(query['last_seq'][0])
+        except (KeyError, ValueError):
+            return None
+
+
+def find_transport(send):
+    """
+    Транспорт Twisted соединения Daphne по функции send приложения или None
+    (другой сервер, тестовый клиент). Daphne передает send как
+    partial(Server.handle_reply, protocol); SessionMiddleware оборачивает
+    его и хранит исходную функцию в real_send.
+    """
+    for _ in range(10):
+        if isinstance(send, partial):
+            protocol = next((arg for arg in send.args if hasattr(arg, 'transport')), None)
+            return getattr(protocol, 'transport', None)
+        send = getattr(getattr(send, '__self__', None), 'real_send', None)
+        if send is None:
             return None
+    return None
+
+
+def transport_backlog(transport):
+    """Байт в буфере записи транспорта Twisted; None - замер недоступен или соединение закрыто"""
+    if transport is None or not getattr(transport, 'connected', False):
+        return None
+    try:
+        return len(transport.dataBuffer) - transport.offset + transport._tempDataLen
+    except AttributeError:
         return None
 
-    @database_sync_to_async
-    def update_user_status(self, online):
+
+def frame_int(data, field, default=None, minimum=0):
+    """
+    Целое поле кадра клиента: default, если поля нет или оно null;
+    ValueError - не целое число или меньше minimum.
+    """
+    value = data.get(field)
+    if value is None:
+        return default
+    if isinstance(value, bool) or (isinstance(value, float) and not value.is_integer()):
+        raise ValueError(field)
+    try:
+        number = int(value)
+    except (TypeError, ValueError):
+        raise ValueError(field)
+    if number < minimum:
+        raise ValueError(field)
+    return number
+
+
+class MultiplexChatConsumer(BaseChatConsumer):
+    """
+    Одно соединение на все чаты пользователя: ws/chats/
+
+    Кадры клиента:
+        {"type": "subscribe", "chat_id": 1, "last_seq": 10, "window": 50}
+        {"type": "unsubscribe", "chat_id": 1}
+        {"type": "credit", "chat_id": 1, "credit": 50}
+    Остальные кадры - как в ChatConsumer, но с полем chat_id.
+    Все события сервера тоже содержат chat_id. Нецелые chat_id, window,
+    credit и last_seq - ответ {"type": "error", "code": "invalid_frame", "field": ...}.
+    """
+
+    async def connect(self):
+        self.user = self.scope["user"]
+        if self.user.is_authenticated:
+            await self.accept_connection()
+        else:
+            await self.close()
+
+    async def handle_message(self, data):
+        message_type = data.get('type')
         try:
-            user = User.objects.get(id=self.user.id)
-            user.online = online
-            user.save()
-        except User.DoesNotExist:
-            pass
\ No newline at end of file
+            chat_id = frame_int(data, 'chat_id', minimum=1)
+            if chat_id is None:
+                raise ValueError('chat_id')
+        except ValueError as error:
+            await self.send_error(data.get('chat_id'), 'invalid_frame', field=str(error))
+            return
+
+        if message_type == 'subscribe':
+            if len(self.subscriptions) >= getattr(settings, 'CHAT_MUX_MAX_SUBSCRIPTIONS', 100):
+                await self.send_error(chat_id, 'too_many_subscriptions')
+                return
+            if not sharding.is_local(chat_id):
+                redirect = sharding.redirect_event(chat_id)
+                await self.send_error(chat_id, 'wrong_shard', shard=redirect['shard'], url=redirect['url'])
+                return
+            try:
+                window = frame_int(data, 'window', getattr(settings, 'CHAT_MUX_DEFAULT_WINDOW', 100))
+                last_seq = frame_int(data, 'last_seq')
+            except ValueError as error:
+                await self.send_error(chat_id, 'invalid_frame', field=str(error))
+                return
+            if not await self.subscribe(chat_id, last_seq, window):
+                await self.send_error(chat_id, 'forbidden')
+                return
+            await self.send_event({'type': 'subscribed', 'chat_id': chat_id})
+            if last_seq is not None:
+                await self.replay_missed(self.subscriptions[chat_id], last_seq)
+
+        elif message_type == 'unsubscribe':
+            await self.unsubscribe(chat_id)
+
+        elif message_type == 'credit':
+            try:
+                credit = frame_int(data, 'credit', 0)
+            except ValueError as error:
+                await self.send_error(chat_id, 'invalid_frame', field=str(error))
+                return
+            subscription = self.subscriptions.get(chat_id)
+            if subscription is not None:
+                await self.add_credit(subscription, credit)
+
+        else:
+            subscription = self.subscriptions.get(chat_id)
+            if subscription is None:
+                await self.send_error(chat_id, 'not_subscribed')
+                return
+            await self.handle_frame(subscription, data)
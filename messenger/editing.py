@@ -0,0 +1,117 @@
+"""
+Редактирование, удаление и отзыв отправленных сообщений.
+
+    edit    - новый текст (только текстовые сообщения);
+    delete  - удаление у всех: в истории остается отметка, файл удаляется мягко;
+    unsend  - отзыв в течение CHAT_UNSEND_WINDOW секунд: сообщение исчезает целиком.
+
+Все действия доступны только отправителю, пока он участник чата, и пишут в базу только
+измененные поля. Результат - событие message_patch для группы чата:
+WebSocket рассылает его сразу, HTTP - через outbox в той же транзакции.
+"""
+from datetime import timedelta
+
+from django.conf import settings
+from django.utils import timezone
+
+from .events import message_patch_event
+from .models import ChangeLog, Message
+
+ACTIONS = ('edit', 'delete', 'unsend')
+
+
+class EditRejected(Exception):
+    """Действие невозможно; code уходит клиенту, status - HTTP-статус ответа"""
+
+    STATUS = {'not_found': 404, 'forbidden': 403}
+
+    def __init__(self, code):
+        super().__init__(code)
+        self.code = code
+        self.status = self.STATUS.get(code, 400)
+
+
+def unsend_window():
+    return timedelta(seconds=getattr(settings, 'CHAT_UNSEND_WINDOW', 15 * 60))
+
+
+def perform(user, message_id, action, content='', chat_id=None):
+    """
+    Выполняет действие над сообщением пользователя.
+    Возвращает (группа чата, событие message_patch); EditRejected - нельзя.
+    """
+    if action not in ACTIONS:
+        raise EditRejected('unknown_action')
+    # Вышедший из чата пользователь своих сообщений уже не меняет
+    messages = Message.objects.select_related('chat', 'media_file').filter(
+        pk=message_id,
+        is_deleted=False,
+        chat__participants=user.id,
+    )
+    if chat_id is not None:
+        messages = messages.filter(chat_id=chat_id)
+    message = messages.first()
+    if message is None:
+        raise EditRejected('not_found')
+    if message.sender_id != user.id:
+        raise EditRejected('forbidden')
+    group_name = message.chat.group_name
+
+    if action == 'edit':
+        content = (content or '').strip()
+        if not content:
+            raise EditRejected('empty')
+        if content == message.content:
+            raise EditRejected('not_modified')
+        if not message.edit_message(content):
+            raise EditRejected('not_editable')
+        return group_name, message_patch_event(
+            message.chat_id, message.id, message.patch_seq,
+            content=message.content,
+            is_edited=True,
+            edited_at=message.edited_at.isoformat(),
+        )
+
+    if action == 'unsend':
+        if timezone.now() - message.timestamp > unsend_window():
+            raise EditRejected('unsend_expired')
+        message_id = message.id
+        message.unsend()
+        return group_name, message_patch_event(message.chat_id, message_id, message.patch_seq, unsent=True)
+
+    message.delete_for_everyone()
+    return group_name, message_patch_event(message.chat_id, message.id, message.patch_seq, deleted=True)
+
+
+def patch_events_since(chat_id, seq, limit):
+    """
+    События message_patch чата с номером больше seq - из ChangeLog.
+    Правка отдает текущий текст; если сообщение потом удалено, ее
+    событие не нужно: удаление идет в том же списке с большим номером.
+    """
+    entries = list(ChangeLog.objects.filter(
+        scope=ChangeLog.chat_scope(chat_id),
+        seq__gt=seq,
+    ).order_by('seq')[:limit])
+    edited = Message.objects.filter(
+        pk__in=[entry.object_id for entry in entries if entry.kind == 'edit'],
+        is_deleted=False,
+    ).in_bulk()
+
+    events = []
+    for entry in entries:
+        if entry.kind == 'edit':
+            message = edited.get(entry.object_id)
+            if message is None:
+                continue
+            events.append(message_patch_event(
+                chat_id, entry.object_id, entry.seq,
+                content=message.content,
+                is_edited=True,
+                edited_at=message.edited_at.isoformat(),
+            ))
+        elif entry.data.get('unsent'):
+            events.append(message_patch_event(chat_id, entry.object_id, entry.seq, unsent=True))
+        else:
+            events.append(message_patch_event(chat_id, entry.object_id, entry.seq, deleted=True))
+    return events
@@ -0,0 +1,100 @@
+"""
+Построение событий чата из моделей.
+Используется и для живой рассылки, и для повторной отправки пропущенного.
+"""
+from accounts.avatars import json_avatar_url
+
+
+def media_payload(media_file):
+    """Данные медиафайла для события media_message"""
+    return {
+        'id': media_file.id,
+        'url': media_file.file.url,
+        'thumbnail_url': media_file.get_thumbnail_url(),
+        'type': media_file.file_type,
+        'name': media_file.file_name,
+        'size': media_file.get_file_size_display(),
+        'duration': media_file.duration,
+        'width': media_file.width,
+        'height': media_file.height,
+        'placeholder': media_file.placeholder,
+        'poster_url': media_file.thumbnail.url if media_file.is_video() and media_file.thumbnail else None,
+    }
+
+
+def voice_payload(media_file):
+    """Данные голосового сообщения для события voice_message"""
+    return {
+        'id': media_file.id,
+        'url': media_file.file.url,
+        'duration': media_file.duration,
+        'size': media_file.get_file_size_display(),
+        'waveform': media_file.waveform,
+    }
+
+
+def message_event(message):
+    """
+    Событие для группы чата по сохраненному сообщению.
+    Сообщение должно быть загружено с select_related('sender', 'media_file').
+    """
+    event = {
+        'chat_id': message.chat_id,
+        'sender_id': message.sender_id,
+        'sender_username': message.sender.username,
+        'sender_avatar': json_avatar_url(message.sender),
+        'timestamp': message.timestamp.isoformat(),
+        'message_id': message.id,
+        'seq': message.seq,
+    }
+    if message.client_id:
+        event['client_id'] = message.client_id
+    media_file = message.media_file
+    if message.is_deleted:
+        # Отметка вместо удаленного сообщения: номер в чате остается занят
+        event['type'] = 'chat_message'
+        event['message'] = ''
+        event['deleted'] = True
+    elif media_file is None:
+        event['type'] = 'chat_message'
+        event['message'] = message.content
+    elif media_file.file_type == 'voice':
+        event['type'] = 'voice_message'
+        event['voice'] = voice_payload(media_file)
+    else:
+        event['type'] = 'media_message'
+        event['media'] = media_payload(media_file)
+        event['content'] = message.content
+    return event
+
+
+def media_updated_event(message, media_file):
+    """
+    Метаданные медиафайла, извлеченные после загрузки (media_updated).
+    Не нумеруется: при переподключении сообщение и так приходит с ними.
+    """
+    event = {
+        'type': 'media_updated',
+        'chat_id': message.chat_id,
+        'message_id': message.id,
+    }
+    if media_file.file_type == 'voice':
+        event['voice'] = voice_payload(media_file)
+    else:
+        event['media'] = media_payload(media_file)
+    return event
+
+
+def message_patch_event(chat_id, message_id, seq, **changes):
+    """
+    Изменение уже отправленного сообщения (message_patch): id и только
+    измененные поля. Нумеруется вместе с сообщениями чата (seq из
+    ChangeLog), поэтому досылается при переподключении.
+    """
+    return {
+        'type': 'message_patch',
+        'chat_id': chat_id,
+        'message_id': message_id,
+        'seq': seq,
+        **changes,
+    }
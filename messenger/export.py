@@ -0,0 +1,186 @@
+"""
+Потоковый экспорт истории чата.
+
+    iter_jsonl(chat)   - сообщения в формате JSON Lines, одно на строку;
+    iter_zip(chat)     - ZIP: messages.jsonl и файлы media/<id>_<имя>.
+
+Сообщения читаются через iterator(chunk_size=EXPORT_CHUNK_SIZE) в порядке
+seq (индекс chat+seq), ZIP пишется в поток без seek (дескрипторы данных
+после каждого файла), медиафайлы копируются кусками. Память не зависит
+от размера чата: в ней одна пачка строк и буфер до EXPORT_BUFFER_SIZE.
+
+Продолжение прерванной выгрузки: after=<id последнего полученного
+сообщения> - экспорт начнется со следующего за ним.
+
+Под ASGI (Daphne) генератор отдается через aiter_sync; под WSGI - как
+есть. Асинхронный итератор WSGI-сервер не стримит: Django сначала
+собирает его целиком в память, поэтому выбор зависит от сервера (stream).
+"""
+import json
+import logging
+import zipfile
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.handlers.asgi import ASGIRequest
+from django.utils import timezone
+
+from .models import Message
+
+logger = logging.getLogger(__name__)
+
+
+def chunk_size():
+    return getattr(settings, 'EXPORT_CHUNK_SIZE', 500)
+
+
+def buffer_size():
+    return getattr(settings, 'EXPORT_BUFFER_SIZE', 256 * 1024)
+
+
+def export_messages(chat, after=None):
+    """Сообщения чата после сообщения с id after (None - с начала)"""
+    messages = Message.objects.filter(chat=chat, is_deleted=False).select_related('sender', 'media_file').order_by('seq')
+    if after is not None:
+        after_seq = Message.objects.filter(chat=chat, id=after).values_list('seq', flat=True).first()
+        if after_seq is None:
+            raise Message.DoesNotExist(f'Сообщение {after} не найдено в чате')
+        messages = messages.filter(seq__gt=after_seq)
+    return messages
+
+
+def media_path(media_file):
+    """Имя файла внутри архива"""
+    return f'media/{media_file.id}_{media_file.file_name or "file"}'.replace('\\', '_')
+
+
+def message_record(message, in_archive=False):
+    record = {
+        'id': message.id,
+        'seq': message.seq,
+        'timestamp': message.timestamp.isoformat(),
+        'sender_id': message.sender_id,
+        'sender': message.sender.username,
+        'type': message.message_type,
+        'content': message.content,
+        'is_edited': message.is_edited,
+    }
+    media_file = message.media_file
+    if media_file is not None and not media_file.is_deleted:
+        record['media'] = {
+            'id': media_file.id,
+            'file_type': media_file.file_type,
+            'file_name': media_file.file_name,
+            'file_size': media_file.file_size,
+            'mime_type': media_file.mime_type,
+            'duration': media_file.duration,
+        }
+        if in_archive:
+            record['media']['path'] = media_path(media_file)
+        else:
+            record['media']['url'] = media_file.file.url
+    return record
+
+
+def iter_jsonl(chat, after=None, in_archive=False):
+    """JSON Lines (bytes) кусками примерно по EXPORT_BUFFER_SIZE: целые строки, по одной на сообщение"""
+    lines, size, limit = [], 0, buffer_size()
+    for message in export_messages(chat, after).iterator(chunk_size=chunk_size()):
+        line = json.dumps(message_record(message, in_archive), ensure_ascii=False).encode() + b'\n'
+        lines.append(line)
+        size += len(line)
+        if size >= limit:
+            yield b''.join(lines)
+            lines, size = [], 0
+    if lines:
+        yield b''.join(lines)
+
+
+class StreamBuffer:
+    """
+    Приемник для zipfile без seek и tell: записанные байты забираются
+    через take() и сразу уходят клиенту.
+    """
+
+    def __init__(self):
+        self.parts = []
+        self.size = 0
+
+    def write(self, data):
+        self.parts.append(bytes(data))
+        self.size += len(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data = b''.join(self.parts)
+        self.parts.clear()
+        self.size = 0
+        return data
+
+
+def iter_zip(chat, after=None):
+    """
+    ZIP-архив кусками bytes: сначала messages.jsonl (сжатый), затем
+    медиафайлы тех же сообщений (без сжатия - они уже сжаты).
+    """
+    buffer = StreamBuffer()
+    limit = buffer_size()
+    with zipfile.ZipFile(buffer, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+        with archive.open('messages.jsonl', 'w', force_zip64=True) as entry:
+            for lines in iter_jsonl(chat, after, in_archive=True):
+                entry.write(lines)
+                if buffer.size >= limit:
+                    yield buffer.take()
+
+        messages = export_messages(chat, after).filter(
+            media_file__isnull=False,
+            media_file__is_deleted=False,
+        )
+        for message in messages.iterator(chunk_size=chunk_size()):
+            media_file = message.media_file
+            try:
+                source = media_file.file.open('rb')
+            except (OSError, ValueError):
+                logger.warning('Экспорт чата %s: файл %s недоступен', chat.id, media_file.file.name)
+                continue
+            info = zipfile.ZipInfo(
+                media_path(media_file),
+                date_time=timezone.localtime(media_file.uploaded_at).timetuple()[:6],
+            )
+            info.compress_type = zipfile.ZIP_STORED
+            with source, archive.open(info, 'w', force_zip64=True) as entry:
+                for chunk in source.chunks():
+                    entry.write(chunk)
+                    if buffer.size >= limit:
+                        yield buffer.take()
+        yield buffer.take()
+    # Центральный каталог записывается при закрытии архива
+    yield buffer.take()
+
+
+def stream(request, iterator):
+    """Содержимое StreamingHttpResponse, которое сервер запроса отдает потоком"""
+    if isinstance(request, ASGIRequest):
+        return aiter_sync(iterator)
+    return iterator
+
+
+async def aiter_sync(iterator):
+    """
+    Синхронный генератор для StreamingHttpResponse под ASGI: каждый шаг
+    выполняется в потоке запроса (thread_sensitive), где открыт курсор БД.
+    Иначе Django сначала собрал бы весь ответ в список.
+    """
+    step = sync_to_async(next, thread_sensitive=True)
+    done = object()
+    try:
+        while True:
+            chunk = await step(iterator, done)
+            if chunk is done:
+                break
+            yield chunk
+    finally:
+        await sync_to_async(iterator.close, thread_sensitive=True)()
@@ -0,0 +1,170 @@
+"""
+Двухуровневый кэш HTML-фрагментов: строки списка чатов и карточки пользователей.
+
+Уровень 1 - память процесса (кэш 'default', locmem), уровень 2 - общий
+кэш FRAGMENT_CACHE_SHARED (например Redis), если он настроен.
+
+Ключ фрагмента включает версии всего, от чего он зависит (чат, пользователь).
+Инвалидация - смена версии по событию (новое сообщение, правка профиля,
+смена статуса онлайн), поэтому сбрасываются только затронутые записи, а
+старые просто истекают. Версии хранятся в общем кэше, если он есть, иначе
+в локальном.
+"""
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.template.loader import render_to_string
+from django.utils.safestring import mark_safe
+
+from . import metrics
+
+KEY_PREFIX = 'fragment'
+
+
+def local_cache():
+    return caches['default']
+
+
+def shared_cache():
+    alias = getattr(settings, 'FRAGMENT_CACHE_SHARED', None)
+    return caches[alias] if alias else None
+
+
+def version_cache():
+    return shared_cache() or local_cache()
+
+
+# ==================== ВЕРСИИ ====================
+
+def _version_key(scope, object_id):
+    return f'{KEY_PREFIX}:ver:{scope}:{object_id}'
+
+
+def get_versions(scope, ids):
+    """Версии объектов scope одним запросом; недостающие создаются"""
+    keys = {object_id: _version_key(scope, object_id) for object_id in ids}
+    if not keys:
+        return {}
+    cache = version_cache()
+    found = cache.get_many(keys.values())
+    versions = {}
+    missing = {}
+    for object_id, key in keys.items():
+        if key in found:
+            versions[object_id] = found[key]
+        else:
+            # Версия пропала (вытеснение) - новая, чтобы не поднять старые фрагменты
+            missing[key] = versions[object_id] = time.time_ns()
+    if missing:
+        cache.set_many(missing, timeout=None)
+    return versions
+
+
+def bump(scope, object_id):
+    """Новая версия объекта после коммита транзакции"""
+    def set_version():
+        version_cache().set(_version_key(scope, object_id), time.time_ns(), timeout=None)
+
+    transaction.on_commit(set_version)
+
+
+def invalidate_chat(chat_id):
+    bump('chat', chat_id)
+
+
+def invalidate_user(user_id):
+    bump('user', user_id)
+
+
+# ==================== ФРАГМЕНТЫ ====================
+
+def get_or_render(kind, items):
+    """
+    items - список (ключ, шаблон, функция контекста). Возвращает HTML в
+    том же порядке. Отсутствующие фрагменты рендерятся и кладутся в оба уровня.
+    """
+    keys = [f'{KEY_PREFIX}:{kind}:{key}' for key, _, _ in items]
+    local = local_cache()
+    found = local.get_many(keys)
+    hits_local = len(found)
+
+    shared = shared_cache()
+    hits_shared = 0
+    if shared is not None and len(found) < len(keys):
+        from_shared = shared.get_many([key for key in keys if key not in found])
+        if from_shared:
+            hits_shared = len(from_shared)
+            local.set_many(from_shared, timeout=getattr(settings, 'FRAGMENT_CACHE_LOCAL_TIMEOUT', 60))
+            found.update(from_shared)
+
+    rendered = {}
+    for key, (_, template, context) in zip(keys, items):
+        if key not in found:
+            rendered[key] = found[key] = render_to_string(template, context())
+    if rendered:
+        local.set_many(rendered, timeout=getattr(settings, 'FRAGMENT_CACHE_LOCAL_TIMEOUT', 60))
+        if shared is not None:
+            shared.set_many(rendered, timeout=getattr(settings, 'FRAGMENT_CACHE_TIMEOUT', 3600))
+
+    metrics.fragment_cache_requests.labels(kind, 'hit_local').inc(hits_local)
+    metrics.fragment_cache_requests.labels(kind, 'hit_shared').inc(hits_shared)
+    metrics.fragment_cache_requests.labels(kind, 'miss').inc(len(rendered))
+    return [mark_safe(found[key]) for key in keys]
+
+
+def user_cards(users, template='accounts/user_card.html'):
+    """Карточки пользователей: [(пользователь, html)]"""
+    users = list(users)
+    versions = get_versions('user', [user.id for user in users])
+    html = get_or_render('user_card', [
+        (f'{user.id}:{versions[user.id]}', template, lambda user=user: {'card_user': user})
+        for user in users
+    ])
+    return list(zip(users, html))
+
+
+# ==================== СОБЫТИЯ ====================
+
+def message_saved(sender, instance, **kwargs):
+    invalidate_chat(instance.chat_id)
+
+
+def chat_saved(sender, instance, **kwargs):
+    invalidate_chat(instance.pk)
+
+
+def participants_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if not action.startswith('post_'):
+        return
+    if reverse:
+        # Изменены чаты пользователя: instance - пользователь
+        for chat_id in pk_set or ():
+            invalidate_chat(chat_id)
+    else:
+        invalidate_chat(instance.pk)
+
+
+def user_saved(sender, instance, update_fields=None, **kwargs):
+    # Вход в систему меняет только last_login - на фрагменты не влияет
+    if update_fields is not None and set(update_fields) <= {'last_login'}:
+        return
+    invalidate_user(instance.pk)
+
+
+def connect_signals():
+    from django.contrib.auth import get_user_model
+    from django.db.models.signals import m2m_changed, post_delete, post_save
+
+    from .models import ChatRoom, Message
+
+    post_save.connect(message_saved, sender=Message, dispatch_uid='fragment_cache.message_saved')
+    post_delete.connect(message_saved, sender=Message, dispatch_uid='fragment_cache.message_deleted')
+    post_save.connect(chat_saved, sender=ChatRoom, dispatch_uid='fragment_cache.chat_saved')
+    m2m_changed.connect(
+        participants_changed,
+        sender=ChatRoom.participants.through,
+        dispatch_uid='fragment_cache.participants_changed',
+    )
+    post_save.connect(user_saved, sender=get_user_model(), dispatch_uid='fragment_cache.user_saved')
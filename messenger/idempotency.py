@@ -0,0 +1,106 @@
+"""
+Идемпотентная отправка сообщений.
+
+Клиент может передать client_id (до CLIENT_ID_MAX_LENGTH символов) с
+кадром chat_message или с загрузкой файла. Повтор с тем же client_id в
+том же чате от того же отправителя не создает второе сообщение, а
+возвращает исходное: уникальный индекс (chat, sender, client_id)
+гарантирует это в базе, а недавние id из LRU процесса
+(CHAT_CLIENT_ID_CACHE_SIZE) отвечают на обычный повтор после таймаута
+без запроса к базе.
+"""
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+from django.db import IntegrityError
+
+from .models import Message
+
+CLIENT_ID_MAX_LENGTH = 64
+
+
+def cache_size():
+    return getattr(settings, 'CHAT_CLIENT_ID_CACHE_SIZE', 10000)
+
+
+class RecentIds:
+    """LRU {(чат, отправитель, client_id): подтверждение исходного сообщения}"""
+
+    def __init__(self):
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            ack = self.entries.get(key)
+            if ack is not None:
+                self.entries.move_to_end(key)
+            return ack
+
+    def put(self, key, ack):
+        with self.lock:
+            self.entries[key] = ack
+            self.entries.move_to_end(key)
+            while len(self.entries) > cache_size():
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+recent_ids = RecentIds()
+
+
+def clean(value):
+    """client_id из запроса; None - не передан или некорректен"""
+    if not isinstance(value, str):
+        return None
+    value = value.strip()
+    if not value or len(value) > CLIENT_ID_MAX_LENGTH:
+        return None
+    return value
+
+
+def message_ack(message):
+    return {
+        'message_id': message.id,
+        'timestamp': message.timestamp.isoformat(),
+    }
+
+
+def remember(message):
+    if message.client_id:
+        recent_ids.put((message.chat_id, message.sender_id, message.client_id), message_ack(message))
+
+
+def recent(chat_id, sender_id, client_id):
+    """Подтверждение исходного сообщения из LRU процесса или None"""
+    return recent_ids.get((chat_id, sender_id, client_id))
+
+
+def find(chat_id, sender_id, client_id):
+    """Исходное сообщение с этим client_id или None"""
+    return Message.objects.select_related('sender', 'media_file').filter(
+        chat_id=chat_id,
+        sender_id=sender_id,
+        client_id=client_id,
+    ).first()
+
+
+def create_message(chat_id, sender, client_id=None, **fields):
+    """
+    (сообщение, создано ли): при повторе client_id возвращается исходное.
+    Гонку двух одинаковых отправок решает уникальный индекс.
+    """
+    try:
+        message = Message.objects.create(chat_id=chat_id, sender=sender, client_id=client_id, **fields)
+    except IntegrityError:
+        original = find(chat_id, sender.id, client_id) if client_id else None
+        if original is None:
+            raise
+        remember(original)
+        return original, False
+    remember(message)
+    return message, True
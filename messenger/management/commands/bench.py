@@ -0,0 +1,183 @@
+import json
+import os
+import platform
+import subprocess
+import tempfile
+
+import django
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import override_settings
+from django.utils import timezone
+
+from messenger import asyncdb, benchmarks
+
+
+class Command(BaseCommand):
+    help = 'Нагрузочные замеры HTTP и WebSocket на синтетических данных (отдельная тестовая БД)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=50)
+        parser.add_argument('--chats', type=int, default=20)
+        parser.add_argument('--messages', type=int, default=200, help='сообщений в каждом чате')
+        parser.add_argument('--media', type=int, default=10, help='медиафайлов в каждом чате')
+        parser.add_argument('--requests', type=int, default=50, help='запросов на каждый HTTP-сценарий')
+        parser.add_argument('--ws-clients', type=int, default=10)
+        parser.add_argument('--ws-messages', type=int, default=20, help='сообщений от каждого WebSocket-клиента')
+        parser.add_argument(
+            '--ws-sweep',
+            help='числа одновременных сокетов через запятую (например 1,10,50): события/с для каждого',
+        )
+        parser.add_argument(
+            '--db-workers',
+            type=int,
+            help='CHAT_DB_EXECUTOR_WORKERS на время замера (0 - один общий поток channels)',
+        )
+        parser.add_argument(
+            '--broadcast',
+            action='store_true',
+            help='сравнить обычный и широковещательный режим чата на --ws-clients сокетах',
+        )
+        parser.add_argument('--seed', type=int, default=42)
+        parser.add_argument('--output', default='bench_results.json', help='куда записать результаты (JSON)')
+        parser.add_argument('--compare', help='предыдущие результаты (JSON) для сравнения')
+
+    def handle(self, *args, **options):
+        db_workers = options['db_workers']
+        if db_workers is None:
+            db_workers = asyncdb.workers()
+        with tempfile.TemporaryDirectory() as media_root:
+            if connection.vendor == 'sqlite':
+                # БД в памяти с общим кэшем не пускает параллельных писателей
+                # ("table is locked"), а консьюмеры пишут из нескольких потоков
+                connection.settings_dict['TEST']['NAME'] = os.path.join(media_root, 'bench.sqlite3')
+            old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+            try:
+                with override_settings(
+                    MEDIA_ROOT=media_root,
+                    RATE_LIMITS={},
+                    CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}},
+                    CHAT_DB_EXECUTOR_WORKERS=db_workers,
+                ):
+                    asyncdb.reset()
+                    try:
+                        results = self.run_benchmarks(options)
+                    finally:
+                        asyncdb.reset()
+            finally:
+                connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        with open(options['output'], 'w', encoding='utf-8') as output:
+            json.dump(results, output, ensure_ascii=False, indent=2)
+
+        self.print_table(results)
+        if options['compare']:
+            with open(options['compare'], encoding='utf-8') as previous:
+                self.print_comparison(json.load(previous), results)
+        self.stdout.write(self.style.SUCCESS(f"Результаты записаны в {options['output']}"))
+
+    def run_benchmarks(self, options):
+        self.stdout.write('Создание данных...')
+        user, chat = benchmarks.seed_data(
+            users=options['users'],
+            chats=options['chats'],
+            messages_per_chat=options['messages'],
+            media_per_chat=options['media'],
+            seed=options['seed'],
+        )
+
+        self.stdout.write('HTTP...')
+        http = benchmarks.run_http(user, chat, requests=options['requests'])
+
+        self.stdout.write('WebSocket...')
+        websocket = benchmarks.run_websocket(
+            chat,
+            clients=options['ws_clients'],
+            messages=options['ws_messages'],
+        )
+
+        results = {
+            'meta': {
+                'commit': self.git_commit(),
+                'created_at': timezone.now().isoformat(),
+                'python': platform.python_version(),
+                'django': django.get_version(),
+                'database': settings.DATABASES['default']['ENGINE'],
+                'options': {key: options[key] for key in (
+                    'users', 'chats', 'messages', 'media', 'requests', 'ws_clients', 'ws_messages', 'seed',
+                )},
+                'db_workers': asyncdb.workers(),
+            },
+            'http': http,
+            'websocket': websocket,
+        }
+
+        if options['ws_sweep']:
+            client_counts = [int(value) for value in options['ws_sweep'].split(',') if value.strip()]
+            self.stdout.write(f"WebSocket: {', '.join(map(str, client_counts))} сокетов...")
+            results['websocket_sweep'] = benchmarks.run_websocket_sweep(
+                chat, client_counts, messages=options['ws_messages'],
+            )
+        if options['broadcast']:
+            self.stdout.write('WebSocket: обычный и широковещательный режим...')
+            results['broadcast'] = benchmarks.run_broadcast_comparison(
+                chat, clients=options['ws_clients'], messages=options['ws_messages'],
+            )
+        return results
+
+    def git_commit(self):
+        try:
+            return subprocess.check_output(
+                ['git', 'rev-parse', '--short', 'HEAD'],
+                cwd=settings.BASE_DIR,
+                stderr=subprocess.DEVNULL,
+                text=True,
+            ).strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
+
+    def print_table(self, results):
+        self.stdout.write(f"{'сценарий':<20}{'rps':>9}{'p50 мс':>9}{'p95 мс':>9}{'p99 мс':>9}{'запросов':>10}")
+        for name, stats in results['http'].items():
+            self.stdout.write(
+                f"{name:<20}{stats['throughput_per_sec']:>9}{stats['p50_ms']:>9}"
+                f"{stats['p95_ms']:>9}{stats['p99_ms']:>9}{stats['queries_per_request']:>10}"
+            )
+        websocket = results['websocket']
+        self.stdout.write(
+            f"{'websocket':<20}{websocket['throughput_per_sec']:>9}{websocket['p50_ms']:>9}"
+            f"{websocket['p95_ms']:>9}{websocket['p99_ms']:>9}{websocket['queries_per_message']:>10}"
+        )
+        self.stdout.write(
+            f"WebSocket: {websocket['clients']} клиентов, "
+            f"{websocket['events_per_sec']} доставленных событий/с"
+        )
+        if results.get('websocket_sweep'):
+            self.stdout.write(f"Сокетов и событий/с (потоков БД: {results['meta']['db_workers']}):")
+            self.stdout.write(f"{'сокетов':>9}{'событий/с':>11}{'сообщ./с':>10}{'p50 мс':>9}{'p95 мс':>9}")
+            for row in results['websocket_sweep']:
+                self.stdout.write(
+                    f"{row['clients']:>9}{row['events_per_sec']:>11}{row['throughput_per_sec']:>10}"
+                    f"{row['p50_ms']:>9}{row['p95_ms']:>9}"
+                )
+        if results.get('broadcast'):
+            self.stdout.write(f"{'режим':<12}{'событий/с':>11}{'p50 мс':>9}{'p95 мс':>9}{'доставок слоя/сообщ.':>22}")
+            for name, row in results['broadcast'].items():
+                self.stdout.write(
+                    f"{name:<12}{row['events_per_sec']:>11}{row['p50_ms']:>9}"
+                    f"{row['p95_ms']:>9}{row['layer_sends_per_message']:>22}"
+                )
+
+    def print_comparison(self, previous, current):
+        """Изменения p95 и числа запросов относительно прошлого прогона"""
+        self.stdout.write(f"Сравнение с {previous['meta'].get('commit')}:")
+        scenarios = [(name, previous['http'].get(name), stats) for name, stats in current['http'].items()]
+        scenarios.append(('websocket', previous.get('websocket'), current['websocket']))
+        for name, old, new in scenarios:
+            if not old:
+                continue
+            line = f"  {name:<18} p95 {old['p95_ms']} -> {new['p95_ms']} мс"
+            if 'queries_per_request' in new:
+                line += f", запросов {old['queries_per_request']} -> {new['queries_per_request']}"
+            self.stdout.write(line)
@@ -0,0 +1,92 @@
+import random
+import time
+
+from django.core.management.base import BaseCommand
+
+from messenger.protocol import JsonCodec, MsgpackCodec, msgpack
+
+
+def sample_events(count, users=20):
+    """Синтетический поток событий чата, похожий на реальный"""
+    rng = random.Random(42)
+    events = []
+    for i in range(count):
+        user_id = rng.randint(1, users)
+        kind = rng.random()
+        if kind < 0.6:
+            events.append({
+                'type': 'chat_message',
+                'message': 'Привет! ' * rng.randint(1, 8),
+                'sender_id': user_id,
+                'sender_username': f'user_{user_id}',
+                'timestamp': '2026-02-10T12:49:00.123456+00:00',
+                'message_id': 1000 + i,
+            })
+        elif kind < 0.9:
+            events.append({
+                'type': 'typing',
+                'user_id': user_id,
+                'username': f'user_{user_id}',
+                'is_typing': True,
+            })
+        else:
+            events.append({
+                'type': 'media_message',
+                'sender_id': user_id,
+                'sender_username': f'user_{user_id}',
+                'message_id': 1000 + i,
+                'media': {
+                    'id': 500 + i,
+                    'url': f'/media/chat_1/image/2026/2/1770729008.02194_{user_id}.jpg',
+                    'thumbnail_url': f'/media/thumbnails/chat_1/1770729008.02194.jpg',
+                    'type': 'image',
+                    'name': 'IMG_2026.jpg',
+                    'size': '1.2 MB',
+                },
+                'content': '',
+            })
+    return events
+
+
+class Command(BaseCommand):
+    help = 'Сравнение размера и скорости кодирования протоколов WebSocket'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--events', type=int, default=10000)
+
+    def handle(self, *args, **options):
+        events = sample_events(options['events'])
+
+        codecs = [('json', JsonCodec)]
+        if msgpack is not None:
+            codecs.append(('msgpack', lambda: MsgpackCodec()))
+            codecs.append(('msgpack+deflate', lambda: MsgpackCodec(deflate=True)))
+        else:
+            self.stderr.write('msgpack не установлен, бинарный протокол пропущен')
+
+        self.stdout.write(f"{'протокол':<18}{'байт/событие':>14}{'encode, мкс':>14}{'decode, мкс':>14}")
+        for name, factory in codecs:
+            # Сервер и клиент держат свое состояние (интернирование, deflate)
+            encoder, decoder = factory(), factory()
+
+            started = time.perf_counter()
+            frames = [encoder.encode(event) for event in events]
+            encode_time = time.perf_counter() - started
+
+            started = time.perf_counter()
+            for frame in frames:
+                if isinstance(frame, str):
+                    decoder.decode(text_data=frame)
+                else:
+                    decoder.decode(bytes_data=frame)
+            decode_time = time.perf_counter() - started
+
+            total_bytes = sum(
+                len(frame.encode('utf-8')) if isinstance(frame, str) else len(frame)
+                for frame in frames
+            )
+            self.stdout.write(
+                f"{name:<18}{total_bytes / len(events):>14.1f}"
+                f"{encode_time / len(events) * 1e6:>14.2f}"
+                f"{decode_time / len(events) * 1e6:>14.2f}"
+            )
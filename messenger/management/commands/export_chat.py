@@ -0,0 +1,45 @@
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from messenger import export
+from messenger.models import ChatRoom, Message
+
+
+class Command(BaseCommand):
+    help = 'Потоковый экспорт истории чата в JSON Lines или ZIP с медиафайлами'
+
+    def add_arguments(self, parser):
+        parser.add_argument('chat_id', type=int)
+        parser.add_argument('--format', choices=('jsonl', 'zip'), default='jsonl')
+        parser.add_argument('--after', type=int, help='id сообщения: продолжить выгрузку после него')
+        parser.add_argument('--output', help='файл результата (по умолчанию stdout, только для jsonl)')
+
+    def handle(self, *args, **options):
+        try:
+            chat = ChatRoom.objects.get(id=options['chat_id'])
+        except ChatRoom.DoesNotExist:
+            raise CommandError(f"Чат {options['chat_id']} не найден")
+
+        try:
+            export.export_messages(chat, options['after'])
+        except Message.DoesNotExist as error:
+            raise CommandError(str(error))
+
+        if options['format'] == 'zip':
+            if not options['output']:
+                raise CommandError('Для zip укажите --output')
+            chunks = export.iter_zip(chat, options['after'])
+        else:
+            chunks = export.iter_jsonl(chat, options['after'])
+
+        if options['output']:
+            # При продолжении (--after) дописываем JSON Lines в конец файла
+            mode = 'ab' if options['after'] and options['format'] == 'jsonl' else 'wb'
+            with open(options['output'], mode) as output:
+                written = sum(output.write(chunk) for chunk in chunks)
+            self.stderr.write(self.style.SUCCESS(f"Записано {written} байт в {options['output']}"))
+        else:
+            for chunk in chunks:
+                sys.stdout.buffer.write(chunk)
+            sys.stdout.buffer.flush()
@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+
+from messenger import media_gc
+
+
+class Command(BaseCommand):
+    help = 'Удаляет из хранилища мягко удаленные медиафайлы и файлы-сироты; продолжает с контрольной точки'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--max-files', type=int, default=None, help='остановиться после стольких файлов (с точностью до пачки)')
+        parser.add_argument('--rate', type=float, default=None, help='удалений в секунду (0 - без ограничения)')
+        parser.add_argument('--dry-run', action='store_true', help='только посчитать, ничего не удалять')
+        parser.add_argument('--restart', action='store_true', help='начать проход сначала, забыв контрольные точки')
+
+    def handle(self, *args, **options):
+        if options['restart']:
+            media_gc.save_position(media_gc.DELETED_CHECKPOINT, '')
+            media_gc.save_position(media_gc.ORPHANS_CHECKPOINT, '')
+        report = media_gc.collect(
+            max_files=options['max_files'],
+            files_per_second=options['rate'],
+            dry_run=options['dry_run'],
+        )
+        self.stdout.write(str(report))
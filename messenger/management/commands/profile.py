@@ -0,0 +1,58 @@
+import json
+import os
+import signal
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from messenger import profiling
+
+
+class Command(BaseCommand):
+    help = (
+        'Семплирующий профиль работающего процесса (PROFILER_ENABLED): '
+        'сигнал SIGUSR2 по --pid или подписанная ссылка для /internal/profile/ (--token)'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--pid', type=int, help='процесс Daphne/runserver для съемки')
+        parser.add_argument('--seconds', type=float, default=None, help='длительность окна съемки')
+        parser.add_argument('--interval', type=float, default=None, help='секунд между снимками стеков')
+        parser.add_argument('--output', help='куда записать стеки (collapsed)')
+        parser.add_argument('--token', action='store_true', help='только выдать подписанную ссылку')
+
+    def handle(self, *args, **options):
+        if not getattr(settings, 'PROFILER_ENABLED', False):
+            raise CommandError('Профилировщик выключен (PROFILER_ENABLED = False)')
+
+        seconds = options['seconds'] or getattr(settings, 'PROFILER_DEFAULT_SECONDS', 10)
+        if options['token']:
+            self.stdout.write(f'/internal/profile/?token={profiling.make_token(seconds)}')
+            return
+
+        if not options['pid']:
+            raise CommandError('Укажите --pid процесса или --token')
+        if not hasattr(signal, 'SIGUSR2'):
+            raise CommandError('Запуск по сигналу недоступен на этой платформе, используйте --token')
+
+        output = os.path.abspath(options['output'] or os.path.join(
+            profiling.control_dir(), f"{options['pid']}-{int(time.time())}.folded",
+        ))
+        os.makedirs(profiling.control_dir(), exist_ok=True)
+        os.makedirs(os.path.dirname(output), exist_ok=True)
+        with open(profiling.request_path(options['pid']), 'w', encoding='utf-8') as request_file:
+            json.dump({'seconds': seconds, 'interval': options['interval'], 'output': output}, request_file)
+
+        try:
+            os.kill(options['pid'], signal.SIGUSR2)
+        except ProcessLookupError:
+            raise CommandError(f"Процесс {options['pid']} не найден")
+
+        # Ждем файл с результатом: окно съемки плюс запас на запись
+        deadline = time.monotonic() + min(seconds, getattr(settings, 'PROFILER_MAX_SECONDS', 60)) + 10
+        while not os.path.exists(output):
+            if time.monotonic() > deadline:
+                raise CommandError('Процесс не записал профиль (PROFILER_ENABLED в нем включен?)')
+            time.sleep(0.5)
+        self.stdout.write(self.style.SUCCESS(f'Профиль записан в {output}'))
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from messenger import sync
+
+
+class Command(BaseCommand):
+    help = 'Удаляет записи журнала синхронизации старше SYNC_LOG_RETENTION_DAYS'
+
+    def handle(self, *args, **options):
+        deleted = sync.prune()
+        self.stdout.write(self.style.SUCCESS(f'Удалено записей: {deleted}'))
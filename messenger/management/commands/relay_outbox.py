@@ -0,0 +1,28 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from messenger import outbox
+
+
+class Command(BaseCommand):
+    help = 'Досылает в слой каналов события outbox, не опубликованные после коммита'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help='один проход и выход')
+        parser.add_argument('--interval', type=float, default=2.0, help='секунд между проходами')
+        parser.add_argument('--batch-size', type=int, default=None)
+        parser.add_argument('--retry-dead', action='store_true',
+                            help='вернуть в очередь события, исчерпавшие OUTBOX_MAX_ATTEMPTS')
+
+    def handle(self, *args, **options):
+        if options['retry_dead']:
+            self.stdout.write(f'возвращено в очередь {outbox.retry_dead()}')
+        while True:
+            published, failed = outbox.relay(options['batch_size'])
+            purged = outbox.purge()
+            if published or failed or purged:
+                self.stdout.write(f'опубликовано {published}, ошибок {failed}, удалено старых {purged}')
+            if options['once']:
+                return
+            time.sleep(options['interval'])
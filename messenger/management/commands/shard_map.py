@@ -0,0 +1,50 @@
+from collections import Counter
+
+from django.core.management.base import BaseCommand, CommandError
+
+from messenger import sharding
+from messenger.models import ChatRoom
+
+
+class Command(BaseCommand):
+    help = 'Распределение чатов по шардам и доля переездов при добавлении или удалении шарда'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--shards', help='имена шардов через запятую вместо текущей карты')
+        parser.add_argument('--add', action='append', default=[], help='добавить шард (можно несколько раз)')
+        parser.add_argument('--remove', action='append', default=[], help='убрать шард (можно несколько раз)')
+        parser.add_argument('--chats', type=int, help='считать по id 1..N вместо чатов из базы')
+
+    def handle(self, *args, **options):
+        if options['shards']:
+            shards = [name.strip() for name in options['shards'].split(',') if name.strip()]
+        else:
+            shards = list(sharding.shard_map())
+        if not shards:
+            raise CommandError('Карта шардов пуста: задайте CHAT_SHARDS, CHAT_SHARD_MAP_FILE или --shards')
+
+        if options['chats']:
+            chat_ids = range(1, options['chats'] + 1)
+        else:
+            chat_ids = list(ChatRoom.objects.values_list('id', flat=True))
+        current = sharding.ring({name: '' for name in shards})
+        owners = {chat_id: current.node_for(chat_id) for chat_id in chat_ids}
+        self.print_distribution('Текущая карта', shards, owners)
+
+        if options['add'] or options['remove']:
+            changed = sorted((set(shards) | set(options['add'])) - set(options['remove']))
+            if not changed:
+                raise CommandError('После изменения не останется ни одного шарда')
+            target = sharding.ring({name: '' for name in changed})
+            new_owners = {chat_id: target.node_for(chat_id) for chat_id in chat_ids}
+            self.print_distribution('Новая карта', changed, new_owners)
+            moved = sum(1 for chat_id in chat_ids if owners[chat_id] != new_owners[chat_id])
+            total = len(owners) or 1
+            self.stdout.write(f'Переедет чатов: {moved} из {len(owners)} ({moved * 100 / total:.1f}%)')
+
+    def print_distribution(self, title, shards, owners):
+        counts = Counter(owners.values())
+        total = len(owners) or 1
+        self.stdout.write(f'{title}:')
+        for name in shards:
+            self.stdout.write(f'  {name:<20}{counts[name]:>8}{counts[name] * 100 / total:>8.1f}%')
@@ -0,0 +1,30 @@
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+
+from messenger import quotas
+from messenger.models import ChatRoom
+
+
+class Command(BaseCommand):
+    help = 'Крупнейшие потребители места под медиафайлы (по счетчикам квот)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--scope', choices=['user', 'chat'], default='user')
+        parser.add_argument('--top', type=int, default=20)
+        parser.add_argument('--rebuild', action='store_true', help='пересчитать счетчики по MediaFile (полный агрегат)')
+
+    def handle(self, *args, **options):
+        if options['rebuild']:
+            self.stdout.write(f'Счетчиков пересчитано: {quotas.rebuild()}')
+
+        scope = options['scope']
+        rows = quotas.top(scope, options['top'])
+        model = get_user_model() if scope == 'user' else ChatRoom
+        names = {obj.pk: str(obj) for obj in model.objects.filter(pk__in=[row.object_id for row in rows])}
+        max_bytes, max_files = quotas.limits(scope)
+        for row in rows:
+            share = f'{row.bytes * 100 / max_bytes:5.1f}%' if max_bytes else '     -'
+            self.stdout.write(
+                f'{row.object_id:>8}  {names.get(row.object_id, "(удален)")[:30]:<30}'
+                f'{row.bytes:>16} байт {share}  {row.files:>8} файлов'
+            )
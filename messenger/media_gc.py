@@ -0,0 +1,356 @@
+"""
+Сборщик мусора медиафайлов.
+
+MediaFile.soft_delete только помечает строку, а удаление чатов каскадом
+и неудачные загрузки оставляют на диске файлы без строк. Проход сборщика:
+
+    1. deleted  - строки, удаленные мягко больше MEDIA_GC_GRACE_HOURS назад:
+                  файл и миниатюра удаляются из хранилища, строка - из БД,
+                  а сообщения с этим файлом становятся отметками удаленных;
+    2. orphans  - обход корней хранилища (MEDIA_GC_ROOTS или корни upload_to
+                  всех FileField проекта): файлы старше того же срока, на
+                  которые не ссылается ни одна строка.
+
+Обе фазы идут пачками по MEDIA_GC_BATCH_SIZE и сохраняют позицию
+(Checkpoint) после каждой пачки: прерванный проход продолжается с нее.
+В памяти - одна пачка и список одного каталога. Скорость удаления
+ограничена MEDIA_GC_FILES_PER_SECOND, объем прохода - max_files.
+
+Запуск: manage.py gc_media или фоновая задача schedule() - не чаще
+MEDIA_GC_INTERVAL секунд на весь сервис, ограниченным проходом.
+"""
+import logging
+import os
+import time
+from datetime import timedelta
+from functools import reduce
+from operator import or_
+
+from django.apps import apps
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.db import models, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from . import background, metrics, outbox
+from .events import message_patch_event
+from .models import Checkpoint, MediaFile, Message
+
+logger = logging.getLogger(__name__)
+
+DELETED_CHECKPOINT = 'media_gc.deleted'
+ORPHANS_CHECKPOINT = 'media_gc.orphans'
+RUN_CHECKPOINT = 'media_gc.run'
+
+
+def grace():
+    return timedelta(hours=getattr(settings, 'MEDIA_GC_GRACE_HOURS', 24))
+
+
+def batch_size():
+    return getattr(settings, 'MEDIA_GC_BATCH_SIZE', 500)
+
+
+class Report:
+    """Итог прохода"""
+
+    def __init__(self):
+        self.rows = 0
+        self.files = 0
+        self.orphans = 0
+        self.bytes = 0
+        self.complete = True
+
+    def __str__(self):
+        state = 'проход завершен' if self.complete else 'продолжится с контрольной точки'
+        return (
+            f'строк удалено {self.rows}, файлов {self.files}, сирот {self.orphans}, '
+            f'освобождено {self.bytes} байт ({state})'
+        )
+
+
+class Throttle:
+    """Не больше files_per_second удалений в секунду (0 - без ограничения)"""
+
+    def __init__(self, files_per_second):
+        self.interval = 1 / files_per_second if files_per_second else 0
+        self.next_at = time.monotonic()
+
+    def wait(self, count):
+        if not self.interval:
+            return
+        self.next_at += count * self.interval
+        delay = self.next_at - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        else:
+            self.next_at = time.monotonic()
+
+
+def load_position(name):
+    return Checkpoint.objects.filter(name=name).values_list('position', flat=True).first() or ''
+
+
+def save_position(name, position):
+    Checkpoint.objects.update_or_create(name=name, defaults={'position': position})
+
+
+def remove_file(storage, name, dry_run=False):
+    """Размер удаленного файла (0, если его уже нет)"""
+    try:
+        size = storage.size(name)
+    except (OSError, NotImplementedError):
+        return 0
+    if not dry_run:
+        storage.delete(name)
+    return size
+
+
+# ==================== ФАЗА 1: МЯГКО УДАЛЕННЫЕ ====================
+
+def delete_rows(pks):
+    """
+    Удаляет строки MediaFile. Сообщения с этими файлами в той же транзакции
+    становятся отметками удаленных (иначе media_file стал бы NULL и осталось
+    бы пустое "живое" сообщение); клиентам уходит message_patch.
+    """
+    with transaction.atomic():
+        tombstones = Message.objects.select_related('chat', 'media_file').filter(
+            media_file_id__in=pks,
+            is_deleted=False,
+        )
+        for message in tombstones:
+            message.delete_for_everyone()
+            outbox.enqueue(
+                message.chat.group_name,
+                message_patch_event(message.chat_id, message.id, message.patch_seq, deleted=True),
+            )
+        MediaFile.objects.filter(pk__in=pks).delete()
+
+
+def purge_deleted(report, throttle, max_files=None, dry_run=False):
+    """Удаляет файлы и строки мягко удаленных медиафайлов старше срока"""
+    cutoff = timezone.now() - grace()
+    expired = MediaFile.objects.filter(is_deleted=True).filter(
+        Q(deleted_at__lt=cutoff) | Q(deleted_at__isnull=True, uploaded_at__lt=cutoff)
+    )
+    last_pk = int(load_position(DELETED_CHECKPOINT) or 0)
+    while True:
+        if max_files is not None and report.files >= max_files:
+            report.complete = False
+            return
+        batch = list(expired.filter(pk__gt=last_pk).order_by('pk').values_list('pk', 'file', 'thumbnail')[:batch_size()])
+        if not batch:
+            if not dry_run:
+                save_position(DELETED_CHECKPOINT, '')
+            return
+
+        for pk, file_name, thumbnail_name in batch:
+            for name in (file_name, thumbnail_name):
+                if name:
+                    report.bytes += remove_file(default_storage, name, dry_run)
+                    report.files += 1
+        if not dry_run:
+            delete_rows([pk for pk, _, _ in batch])
+        report.rows += len(batch)
+        last_pk = batch[-1][0]
+        if not dry_run:
+            save_position(DELETED_CHECKPOINT, str(last_pk))
+        throttle.wait(len(batch))
+
+
+# ==================== ФАЗА 2: СИРОТЫ ====================
+
+def path_key(path):
+    """Порядок обхода в глубину по отсортированным каталогам"""
+    return path.split('/')
+
+
+def walk(storage, directory, after=''):
+    """
+    Файлы каталога хранилища рекурсивно, в порядке path_key, строго после
+    after. Каталоги целиком до позиции after не читаются.
+    """
+    try:
+        directories, files = storage.listdir(directory)
+    except (FileNotFoundError, NotADirectoryError):
+        return
+    prefix = f'{directory}/' if directory else ''
+    entries = [(name, True) for name in directories] + [(name, False) for name in files]
+    for name, is_directory in sorted(entries):
+        path = prefix + name
+        if is_directory:
+            inside = after.startswith(path + '/')
+            if not after or inside or path_key(path) > path_key(after):
+                yield from walk(storage, path, after if inside else '')
+        elif not after or path_key(path) > path_key(after):
+            yield path
+
+
+def file_fields():
+    """[(модель, [FileField])] для всех моделей проекта с файлами"""
+    found = []
+    for model in apps.get_models():
+        fields = [field for field in model._meta.concrete_fields if isinstance(field, models.FileField)]
+        if fields:
+            found.append((model, fields))
+    return found
+
+
+def referenced(paths):
+    """
+    Пути из paths, на которые ссылается строка любой модели с FileField
+    (в том числе мягко удаленный MediaFile) или вариант аватара.
+    """
+    from accounts.avatars import referenced_variants
+
+    names = set()
+    for model, fields in file_fields():
+        field_names = [field.attname for field in fields]
+        lookup = reduce(or_, (Q(**{f'{name}__in': paths}) for name in field_names))
+        for row in model._default_manager.filter(lookup).values_list(*field_names):
+            names.update(row)
+    names.update(referenced_variants(paths))
+    return names
+
+
+def sample_instance(model, pk):
+    """Несохраняемый экземпляр с pk и связанными объектами с тем же pk - для upload_to"""
+    instance = model(pk=pk)
+    for field in model._meta.concrete_fields:
+        if field.many_to_one:
+            setattr(instance, field.name, field.related_model(pk=pk))
+    return instance
+
+
+def upload_root(model, field):
+    """
+    Корень каталога, куда field кладет файлы: (имя, True - это префикс имен).
+    Строковый upload_to дает первый сегмент пути; функцию вызываем для двух
+    экземпляров с разными id: совпадающий первый сегмент - каталог,
+    разный (chat_1, chat_2) - общий префикс. None - корень не определить.
+    """
+    upload_to = field.upload_to
+    if not callable(upload_to):
+        root = upload_to.strip('/').split('/')[0]
+        return (root, False) if root and '%' not in root else None
+    try:
+        samples = [upload_to(sample_instance(model, pk), 'file.bin').split('/')[0] for pk in (1, 2)]
+    except Exception:
+        logger.warning('Корень %s.%s не определен', model._meta.label, field.name, exc_info=True)
+        return None
+    if samples[0] == samples[1]:
+        return samples[0], False
+    prefix = os.path.commonprefix(samples)
+    return (prefix, True) if prefix else None
+
+
+def upload_roots():
+    """Корни всех FileField проекта"""
+    roots = {upload_root(model, field) for model, fields in file_fields() for field in fields}
+    roots.discard(None)
+    return roots
+
+
+def top_level(storage):
+    """Корни обхода: MEDIA_GC_ROOTS или каталоги хранилища под upload_roots()"""
+    configured = getattr(settings, 'MEDIA_GC_ROOTS', None)
+    if configured:
+        return sorted(configured)
+    try:
+        directories, _ = storage.listdir('')
+    except FileNotFoundError:
+        return []
+    roots = upload_roots()
+    return sorted(
+        name for name in directories
+        if any(name == root or (is_prefix and name.startswith(root)) for root, is_prefix in roots)
+    )
+
+
+def remove_orphans(report, throttle, max_files=None, dry_run=False):
+    """Удаляет файлы хранилища старше срока, на которые не ссылается ни одна строка"""
+    storage = default_storage
+    cutoff = timezone.now() - grace()
+    position = load_position(ORPHANS_CHECKPOINT)
+
+    def paths():
+        for root in top_level(storage):
+            if not position or position.startswith(root + '/') or path_key(root) > path_key(position):
+                yield from walk(storage, root, position if position.startswith(root + '/') else '')
+
+    batch = []
+
+    def flush():
+        known = referenced(batch)
+        removed = 0
+        for path in batch:
+            if path in known:
+                continue
+            try:
+                modified = storage.get_modified_time(path)
+            except (OSError, NotImplementedError):
+                continue
+            if modified >= cutoff:
+                continue  # возможно, загрузка еще не закоммичена
+            report.bytes += remove_file(storage, path, dry_run)
+            report.orphans += 1
+            report.files += 1
+            removed += 1
+        if not dry_run:
+            save_position(ORPHANS_CHECKPOINT, batch[-1])
+        batch.clear()
+        throttle.wait(removed)
+
+    for path in paths():
+        batch.append(path)
+        if len(batch) >= batch_size():
+            flush()
+            if max_files is not None and report.files >= max_files:
+                report.complete = False
+                return
+    if batch:
+        flush()
+    if not dry_run:
+        save_position(ORPHANS_CHECKPOINT, '')
+
+
+def collect(max_files=None, files_per_second=None, dry_run=False):
+    """Полный или ограниченный (max_files) проход обеих фаз; Report"""
+    if files_per_second is None:
+        files_per_second = getattr(settings, 'MEDIA_GC_FILES_PER_SECOND', 50)
+    report = Report()
+    throttle = Throttle(files_per_second)
+    purge_deleted(report, throttle, max_files, dry_run)
+    if report.complete:
+        remove_orphans(report, throttle, max_files, dry_run)
+    metrics.media_gc_files.inc(report.files)
+    metrics.media_gc_bytes.inc(report.bytes)
+    logger.info('Сборка мусора медиа: %s', report)
+    return report
+
+
+# ==================== ФОНОВАЯ ЗАДАЧА ====================
+
+def claim_run():
+    """Право на фоновый проход: не чаще MEDIA_GC_INTERVAL секунд на все процессы"""
+    _, created = Checkpoint.objects.get_or_create(name=RUN_CHECKPOINT)
+    if created:
+        return True
+    due = timezone.now() - timedelta(seconds=getattr(settings, 'MEDIA_GC_INTERVAL', 3600))
+    return bool(Checkpoint.objects.filter(name=RUN_CHECKPOINT, updated_at__lt=due).update(
+        updated_at=timezone.now(),
+    ))
+
+
+def run_if_due():
+    if claim_run():
+        return collect(max_files=getattr(settings, 'MEDIA_GC_BACKGROUND_MAX_FILES', 1000))
+    return None
+
+
+def schedule():
+    """Ограниченный проход в фоне после коммита, если подошел срок"""
+    if getattr(settings, 'MEDIA_GC_INTERVAL', 3600):
+        background.submit(run_if_due)
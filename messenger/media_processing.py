@@ -0,0 +1,248 @@
+"""
+Метаданные аудио и видео в фоне: ffprobe / ffmpeg.
+
+Для видео - длительность, размеры, кодек и кадр-постер, для голосовых и
+аудио - длительность, кодек и короткая форма волны (MEDIA_WAVEFORM_POINTS
+значений 0..100). Результат записывается в MediaFile и рассылается в чат
+событием media_updated.
+
+Изображения, загруженные прямо в объектное хранилище (messenger.storage),
+сервер не видел: их размеры и заглушка читаются здесь же, без ffmpeg.
+
+Ограничения: одновременно работает не больше BACKGROUND_WORKERS задач,
+каждый процесс ffmpeg получает один поток, nice, лимиты процессора и
+памяти через prlimit (если есть) и таймаут. Форма волны считается
+потоково, без загрузки всего аудио в память.
+"""
+import json
+import logging
+import os
+import shutil
+import subprocess
+import tempfile
+from array import array
+from contextlib import contextmanager
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.utils import timezone
+
+from . import background, placeholders
+
+logger = logging.getLogger(__name__)
+
+PROCESSED_TYPES = ('video', 'audio', 'voice')
+
+# Частота дискретизации для формы волны: огибающей хватает
+WAVEFORM_SAMPLE_RATE = 1000
+# Пик считается по блокам в 0.1 с
+WAVEFORM_BLOCK = WAVEFORM_SAMPLE_RATE // 10
+
+
+class MediaProcessingError(Exception):
+    pass
+
+
+def is_available():
+    return bool(shutil.which(ffmpeg_binary()) and shutil.which(ffprobe_binary()))
+
+
+def ffmpeg_binary():
+    return getattr(settings, 'FFMPEG_BINARY', 'ffmpeg')
+
+
+def ffprobe_binary():
+    return getattr(settings, 'FFPROBE_BINARY', 'ffprobe')
+
+
+def limited(args):
+    """Команда с ограничениями процессора и памяти"""
+    cpu_seconds = getattr(settings, 'MEDIA_PROCESSING_CPU_SECONDS', 60)
+    memory_mb = getattr(settings, 'MEDIA_PROCESSING_MEMORY_MB', 512)
+    prefix = []
+    if shutil.which('prlimit'):
+        prefix += ['prlimit', f'--cpu={cpu_seconds}', f'--as={memory_mb * 1024 * 1024}', '--']
+    if shutil.which('nice'):
+        prefix += ['nice', '-n', '10']
+    return prefix + args
+
+
+def run(args):
+    """Запуск с таймаутом; stdout в байтах"""
+    timeout = getattr(settings, 'MEDIA_PROCESSING_TIMEOUT', 120)
+    try:
+        result = subprocess.run(limited(args), capture_output=True, timeout=timeout, check=False)
+    except subprocess.TimeoutExpired:
+        raise MediaProcessingError(f'{args[0]}: превышено время {timeout} с')
+    if result.returncode != 0:
+        raise MediaProcessingError(f'{args[0]}: {result.stderr.decode(errors="replace")[-500:]}')
+    return result.stdout
+
+
+@contextmanager
+def local_path(field_file):
+    """Путь к файлу на диске; для удаленных хранилищ - временная копия"""
+    try:
+        yield field_file.path
+        return
+    except NotImplementedError:
+        pass
+    suffix = os.path.splitext(field_file.name)[1]
+    with tempfile.NamedTemporaryFile(suffix=suffix) as copy:
+        with field_file.open('rb') as source:
+            shutil.copyfileobj(source, copy)
+        copy.flush()
+        yield copy.name
+
+
+def probe(path):
+    """Длительность (с), размеры и кодек первого видео- или аудиопотока"""
+    output = run([
+        ffprobe_binary(), '-v', 'error', '-print_format', 'json',
+        '-show_format', '-show_streams', path,
+    ])
+    data = json.loads(output or b'{}')
+    streams = data.get('streams', [])
+    video = next((s for s in streams if s.get('codec_type') == 'video'), None)
+    audio = next((s for s in streams if s.get('codec_type') == 'audio'), None)
+    main = video or audio or {}
+
+    duration = data.get('format', {}).get('duration') or main.get('duration')
+    return {
+        'duration': float(duration) if duration not in (None, 'N/A') else None,
+        'width': video.get('width') if video else None,
+        'height': video.get('height') if video else None,
+        'codec': main.get('codec_name', ''),
+        'has_audio': audio is not None,
+    }
+
+
+def extract_poster(path, duration):
+    """Кадр-постер JPEG не шире MEDIA_POSTER_WIDTH"""
+    position = min(1.0, duration / 2) if duration else 0
+    width = getattr(settings, 'MEDIA_POSTER_WIDTH', 640)
+    return run([
+        ffmpeg_binary(), '-v', 'error', '-threads', '1',
+        '-ss', f'{position:.2f}', '-i', path,
+        '-frames:v', '1', '-vf', f"scale='min({width},iw)':-2",
+        '-f', 'image2', '-c:v', 'mjpeg', '-q:v', '4', 'pipe:1',
+    ]) or None
+
+
+def waveform(path, points=None):
+    """
+    Форма волны: points пиков 0..100. Аудио читается из ffmpeg потоком
+    (моно, 16 бит, WAVEFORM_SAMPLE_RATE Гц), в памяти только пики блоков.
+    """
+    points = points or getattr(settings, 'MEDIA_WAVEFORM_POINTS', 64)
+    max_seconds = getattr(settings, 'MEDIA_WAVEFORM_MAX_SECONDS', 3600)
+    process = subprocess.Popen(
+        limited([
+            ffmpeg_binary(), '-v', 'error', '-threads', '1', '-i', path,
+            '-t', str(max_seconds), '-vn', '-ac', '1', '-ar', str(WAVEFORM_SAMPLE_RATE),
+            '-f', 's16le', 'pipe:1',
+        ]),
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+    )
+    peaks = []
+    block_bytes = WAVEFORM_BLOCK * 2
+    try:
+        while True:
+            chunk = process.stdout.read(block_bytes * 64)
+            if not chunk:
+                break
+            samples = array('h', chunk[:len(chunk) - len(chunk) % 2])
+            for start in range(0, len(samples), WAVEFORM_BLOCK):
+                block = samples[start:start + WAVEFORM_BLOCK]
+                peaks.append(max(max(block), -min(block)))
+        process.wait(timeout=getattr(settings, 'MEDIA_PROCESSING_TIMEOUT', 120))
+    finally:
+        if process.poll() is None:
+            process.kill()
+            process.wait()
+    if process.returncode != 0:
+        raise MediaProcessingError(f'ffmpeg: код {process.returncode}')
+    return reduce_peaks(peaks, points)
+
+
+def reduce_peaks(peaks, points):
+    if not peaks:
+        return []
+    buckets = [0] * min(points, len(peaks))
+    for index, peak in enumerate(peaks):
+        bucket = index * len(buckets) // len(peaks)
+        buckets[bucket] = max(buckets[bucket], peak)
+    loudest = max(buckets) or 1
+    return [round(value * 100 / loudest) for value in buckets]
+
+
+def process_media(media_id):
+    """Обрабатывает медиафайл, сохраняет метаданные и рассылает media_updated"""
+    from .models import MediaFile
+
+    media_file = MediaFile.objects.select_related('chat').get(pk=media_id)
+    if media_file.file_type == 'image':
+        process_image(media_file)
+        return
+    if not is_available():
+        logger.warning('ffmpeg/ffprobe не найдены, метаданные %s не извлечены', media_id)
+        return
+
+    updates = {}
+    with local_path(media_file.file) as path:
+        info = probe(path)
+        if info['duration'] is not None:
+            updates['duration'] = round(info['duration'])
+        updates['codec'] = info['codec'][:50]
+        if info['width'] and info['height']:
+            updates['width'], updates['height'] = info['width'], info['height']
+
+        poster = None
+        if media_file.file_type == 'video':
+            poster = extract_poster(path, info['duration'])
+        if media_file.file_type in ('audio', 'voice') and info['has_audio']:
+            updates['waveform'] = waveform(path)
+
+    for field, value in updates.items():
+        setattr(media_file, field, value)
+    media_file.processed_at = timezone.now()
+    fields = list(updates) + ['processed_at']
+    if poster:
+        media_file.thumbnail.save(f'poster_{media_file.pk}.jpg', ContentFile(poster), save=False)
+        fields.append('thumbnail')
+    media_file.save(update_fields=fields)
+    broadcast_update(media_file)
+
+
+def process_image(media_file):
+    """Размеры и заглушка изображения, загруженного в хранилище напрямую"""
+    with media_file.file.open('rb') as source:
+        width, height, placeholder = placeholders.image_info(source)
+    if width is None:
+        return
+    media_file.width, media_file.height, media_file.placeholder = width, height, placeholder
+    media_file.processed_at = timezone.now()
+    media_file.save(update_fields=['width', 'height', 'placeholder', 'processed_at'])
+    broadcast_update(media_file)
+
+
+def broadcast_update(media_file):
+    """Событие media_updated в группу чата"""
+    from .events import media_updated_event
+
+    message = media_file.messages.order_by('id').first()
+    if message is None:
+        return
+    async_to_sync(get_channel_layer().group_send)(
+        media_file.chat.group_name,
+        media_updated_event(message, media_file),
+    )
+
+
+def schedule(media_file):
+    """Поставить извлечение метаданных в фон (после коммита)"""
+    if media_file.file_type in PROCESSED_TYPES or (media_file.file_type == 'image' and media_file.width is None):
+        background.submit(process_media, media_file.pk)
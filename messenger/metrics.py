@@ -0,0 +1,285 @@
+"""
+Метрики процесса в текстовом формате Prometheus.
+
+Наборы меток регистрируются заранее, поэтому в горячем пути остается
+только поиск в словаре и сложение - без блокировок. В CPython сложение
+атрибута почти всегда атомарно под GIL; редкая потеря инкремента при
+гонке потоков для метрик допустима.
+"""
+from bisect import bisect_left
+
+# Границы гистограмм длительностей, секунды
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class _Value:
+    """Одно значение метрики с конкретными метками"""
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+    def set(self, value):
+        self.value = value
+
+
+class _HistogramValue:
+    """Гистограмма с конкретными метками: счетчики по корзинам, сумма, количество"""
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=(), labelsets=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        if not self.labelnames:
+            self._values[()] = self._new_value()
+        for labelset in labelsets:
+            self._values[tuple(labelset)] = self._new_value()
+        REGISTRY.append(self)
+
+    def _new_value(self):
+        return _Value()
+
+    def labels(self, *labelvalues):
+        value = self._values.get(labelvalues)
+        if value is None:
+            # Непредусмотренный набор меток: регистрируем на лету
+            value = self._values.setdefault(labelvalues, self._new_value())
+        return value
+
+    def inc(self, amount=1):
+        self._values[()].inc(amount)
+
+    def samples(self):
+        """Строки экспозиции: (имя, метки, значение)"""
+        for labelvalues, value in self._values.items():
+            yield self.name, dict(zip(self.labelnames, labelvalues)), value.value
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def __init__(self, *args, function=None, **kwargs):
+        # function - значение вычисляется при чтении метрик
+        self.function = function
+        super().__init__(*args, **kwargs)
+
+    def dec(self, amount=1):
+        self._values[()].dec(amount)
+
+    def set(self, value):
+        self._values[()].set(value)
+
+    def samples(self):
+        if self.function is not None:
+            yield self.name, {}, self.function()
+            return
+        yield from super().samples()
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, *args, buckets=DEFAULT_BUCKETS, **kwargs):
+        self.buckets = tuple(buckets)
+        super().__init__(*args, **kwargs)
+
+    def _new_value(self):
+        return _HistogramValue(self.buckets)
+
+    def observe(self, value):
+        self._values[()].observe(value)
+
+    def samples(self):
+        for labelvalues, value in self._values.items():
+            labels = dict(zip(self.labelnames, labelvalues))
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), value.counts):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                yield f'{self.name}_bucket', {**labels, 'le': le}, cumulative
+            yield f'{self.name}_sum', labels, value.sum
+            yield f'{self.name}_count', labels, value.count
+
+
+REGISTRY = []
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    pairs = ','.join(
+        '{}="{}"'.format(key, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for key, value in labels.items()
+    )
+    return '{' + pairs + '}'
+
+
+def render():
+    """Все метрики в текстовом формате Prometheus"""
+    lines = []
+    for metric in REGISTRY:
+        lines.append(f'# HELP {metric.name} {metric.documentation}')
+        lines.append(f'# TYPE {metric.name} {metric.kind}')
+        for name, labels, value in metric.samples():
+            lines.append(f'{name}{_format_labels(labels)} {value}')
+    return '\n'.join(lines) + '\n'
+
+
+def _channel_layer_queue_depth():
+    """Сообщений в очередях слоя каналов (только для InMemoryChannelLayer)"""
+    from channels.layers import get_channel_layer
+
+    layer = get_channel_layer()
+    channels = getattr(layer, 'channels', None)
+    if not isinstance(channels, dict):
+        return float('nan')
+    return sum(queue.qsize() for queue in list(channels.values()))
+
+
+MEDIA_TYPES = [('image',), ('video',), ('audio',), ('document',), ('voice',)]
+
+FRAME_TYPES = (
+    'chat_message', 'media_message', 'voice_message', 'typing',
+    'subscribe', 'unsubscribe', 'credit',
+)
+
+
+def frame_type(value):
+    """Тип кадра клиента как метка: неизвестные типы не плодят наборы меток"""
+    return value if value in FRAME_TYPES else 'other'
+
+
+# ==================== WEBSOCKET ====================
+
+ws_connections = Gauge(
+    'ws_connections',
+    'Открытых WebSocket-соединений в процессе',
+)
+ws_events_received = Counter(
+    'ws_events_received_total',
+    'Кадров, полученных от клиентов',
+    ['type'],
+    [(name,) for name in FRAME_TYPES + ('other',)],
+)
+ws_errors = Counter(
+    'ws_errors_total',
+    'Ошибок при обработке кадров WebSocket',
+)
+ws_group_send_seconds = Histogram(
+    'ws_group_send_seconds',
+    'Длительность group_send в слой каналов',
+    ['type'],
+    [('chat_message',), ('media_message',), ('voice_message',), ('typing',)],
+)
+ws_send_queue_depth = Gauge(
+    'ws_send_queue_depth',
+    'Событий в очередях отправки всех соединений процесса',
+)
+ws_send_queue_dropped = Counter(
+    'ws_send_queue_dropped_total',
+    'Событий, отброшенных из-за медленного клиента',
+    ['reason'],
+    [('typing',), ('collapsed',)],
+)
+ws_resync_notices = Counter(
+    'ws_resync_notices_total',
+    'Отправлено уведомлений resync_required',
+)
+ws_send_buffer_waits = Counter(
+    'ws_send_buffer_waits_total',
+    'Ожиданий, пока клиент прочитает буфер записи транспорта',
+)
+ws_slow_consumer_disconnects = Counter(
+    'ws_slow_consumer_disconnects_total',
+    'Соединений, закрытых из-за переполнения очереди отправки',
+)
+broadcast_events = Counter(
+    'broadcast_events_total',
+    'Событий больших чатов, полученных хабом процесса',
+)
+channel_layer_queue_depth = Gauge(
+    'channel_layer_queue_depth',
+    'Сообщений в очередях слоя каналов процесса',
+    function=_channel_layer_queue_depth,
+)
+
+# ==================== СООБЩЕНИЯ И МЕДИА ====================
+
+messages_persisted = Counter(
+    'messages_persisted_total',
+    'Сохранено сообщений',
+    ['type'],
+    [('text',)] + MEDIA_TYPES,
+)
+upload_bytes = Counter(
+    'upload_bytes_total',
+    'Загружено байт',
+    ['type'],
+    MEDIA_TYPES,
+)
+upload_seconds = Histogram(
+    'upload_seconds',
+    'Длительность обработки загрузки',
+    ['type'],
+    MEDIA_TYPES,
+)
+thumbnail_seconds = Histogram(
+    'thumbnail_seconds',
+    'Длительность создания миниатюры',
+)
+outbox_events = Counter(
+    'outbox_events_total',
+    'Публикаций событий outbox в слой каналов',
+    ['result'],
+    [('published',), ('failed',), ('dead',)],
+)
+media_gc_files = Counter(
+    'media_gc_files_total',
+    'Файлов удалено сборщиком мусора медиа',
+)
+media_gc_bytes = Counter(
+    'media_gc_bytes_total',
+    'Байт освобождено сборщиком мусора медиа',
+)
+
+# ==================== HTTP ====================
+
+fragment_cache_requests = Counter(
+    'fragment_cache_requests_total',
+    'Обращения к кэшу фрагментов',
+    ['kind', 'result'],
+    [(kind, result) for kind in ('chat_row', 'user_card') for result in ('hit_local', 'hit_shared', 'miss')],
+)
+
+http_db_seconds = Histogram(
+    'http_db_seconds',
+    'Время SQL на один HTTP-запрос',
+    ['view'],
+)
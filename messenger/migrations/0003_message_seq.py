@@ -0,0 +1,42 @@
+# Generated by Django 5.2.18 on 2026-10-19 08:37
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+def backfill_seq(apps, schema_editor):
+    """Нумерует существующие сообщения каждого чата по времени"""
+    ChatRoom = apps.get_model('messenger', 'ChatRoom')
+    Message = apps.get_model('messenger', 'Message')
+    for chat in ChatRoom.objects.all().iterator():
+        seq = 0
+        for message in Message.objects.filter(chat=chat).order_by('timestamp', 'id').only('id').iterator():
+            seq += 1
+            Message.objects.filter(pk=message.pk).update(seq=seq)
+        ChatRoom.objects.filter(pk=chat.pk).update(last_seq=seq)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('messenger', '0002_chatroom_last_media_upload_and_more'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatroom',
+            name='last_seq',
+            field=models.BigIntegerField(default=0, verbose_name='Последний номер сообщения'),
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='seq',
+            field=models.BigIntegerField(blank=True, null=True, verbose_name='Порядковый номер в чате'),
+        ),
+        migrations.RunPython(backfill_seq, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='message',
+            constraint=models.UniqueConstraint(fields=('chat', 'seq'), name='unique_message_seq_per_chat'),
+        ),
+    ]
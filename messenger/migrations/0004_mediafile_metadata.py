@@ -0,0 +1,38 @@
+# Generated by Django 5.2.18 on 2026-10-19 08:54
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('messenger', '0003_message_seq'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='mediafile',
+            name='codec',
+            field=models.CharField(blank=True, max_length=50, verbose_name='Кодек'),
+        ),
+        migrations.AddField(
+            model_name='mediafile',
+            name='height',
+            field=models.PositiveIntegerField(blank=True, null=True, verbose_name='Высота'),
+        ),
+        migrations.AddField(
+            model_name='mediafile',
+            name='processed_at',
+            field=models.DateTimeField(blank=True, null=True, verbose_name='Метаданные извлечены'),
+        ),
+        migrations.AddField(
+            model_name='mediafile',
+            name='waveform',
+            field=models.JSONField(blank=True, default=list, help_text='Пики громкости 0..100 для голосовых и аудио', verbose_name='Форма волны'),
+        ),
+        migrations.AddField(
+            model_name='mediafile',
+            name='width',
+            field=models.PositiveIntegerField(blank=True, null=True, verbose_name='Ширина'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-19 08:55
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('messenger', '0004_mediafile_metadata'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='mediafile',
+            name='placeholder',
+            field=models.CharField(blank=True, help_text='Сетка пикселей для мгновенной раскладки (messenger.placeholders)', max_length=64, verbose_name='Заглушка'),
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 5.2.18 on 2026-10-19 09:06
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('messenger', '0005_mediafile_placeholder'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OutboxEvent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('group', models.CharField(max_length=100, verbose_name='Группа каналов')),
+                ('payload', models.JSONField(verbose_name='Событие')),
+                ('key', models.CharField(blank=True, db_index=True, max_length=100)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('published_at', models.DateTimeField(blank=True, null=True)),
+                ('attempts', models.PositiveIntegerField(default=0)),
+            ],
+            options={
+                'verbose_name': 'Событие outbox',
+                'verbose_name_plural': 'События outbox',
+                'indexes': [models.Index(fields=['published_at', 'id'], name='messenger_o_publish_6cc656_idx')],
+            },
+        ),
+    ]
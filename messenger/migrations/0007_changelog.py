@@ -0,0 +1,29 @@
+# Generated by Django 5.2.18 on 2026-10-19 09:08
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('messenger', '0006_outboxevent'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChangeLog',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('scope', models.CharField(max_length=32, verbose_name='Область')),
+                ('kind', models.CharField(choices=[('message', 'Новое сообщение'), ('edit', 'Редактирование'), ('media_deleted', 'Удаление медиафайла'), ('membership', 'Изменение участников'), ('read', 'Прочтение')], max_length=20, verbose_name='Тип изменения')),
+                ('object_id', models.BigIntegerField(blank=True, null=True)),
+                ('data', models.JSONField(blank=True, default=dict)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'verbose_name': 'Изменение',
+                'verbose_name_plural': 'Журнал изменений',
+                'indexes': [models.Index(fields=['scope', 'id'], name='changelog_scope_seq'), models.Index(fields=['created_at'], name='messenger_c_created_788331_idx')],
+            },
+        ),
+    ]
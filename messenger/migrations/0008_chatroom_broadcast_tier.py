@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-19 09:09
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('messenger', '0007_changelog'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatroom',
+            name='broadcast_tier',
+            field=models.BooleanField(default=False, verbose_name='Широковещательный режим'),
+        ),
+    ]
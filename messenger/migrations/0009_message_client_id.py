@@ -0,0 +1,24 @@
+# Generated by Django 5.2.18 on 2026-10-19 09:15
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('messenger', '0008_chatroom_broadcast_tier'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='client_id',
+            field=models.CharField(blank=True, max_length=64, null=True, verbose_name='Id сообщения на клиенте'),
+        ),
+        migrations.AddConstraint(
+            model_name='message',
+            constraint=models.UniqueConstraint(condition=models.Q(('client_id__isnull', False)), fields=('chat', 'sender', 'client_id'), name='unique_message_client_id'),
+        ),
+    ]
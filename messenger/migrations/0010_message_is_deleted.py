@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-19 09:17
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('messenger', '0009_message_client_id'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='is_deleted',
+            field=models.BooleanField(default=False, verbose_name='Удалено'),
+        ),
+        migrations.AlterField(
+            model_name='changelog',
+            name='kind',
+            field=models.CharField(choices=[('message', 'Новое сообщение'), ('edit', 'Редактирование'), ('media_deleted', 'Удаление медиафайла'), ('delete', 'Удаление сообщения'), ('membership', 'Изменение участников'), ('read', 'Прочтение')], max_length=20, verbose_name='Тип изменения'),
+        ),
+    ]
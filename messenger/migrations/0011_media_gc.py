@@ -0,0 +1,45 @@
+# Generated by Django 5.2.18 on 2026-10-19 09:19
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('messenger', '0010_message_is_deleted'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Checkpoint',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=64, unique=True)),
+                ('position', models.TextField(blank=True, default='')),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'verbose_name': 'Контрольная точка',
+                'verbose_name_plural': 'Контрольные точки',
+            },
+        ),
+        migrations.AddField(
+            model_name='mediafile',
+            name='deleted_at',
+            field=models.DateTimeField(blank=True, null=True, verbose_name='Время удаления'),
+        ),
+        migrations.AddIndex(
+            model_name='mediafile',
+            index=models.Index(fields=['is_deleted', 'deleted_at'], name='messenger_m_is_dele_c88262_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='mediafile',
+            index=models.Index(fields=['file'], name='messenger_m_file_136074_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='mediafile',
+            index=models.Index(fields=['thumbnail'], name='messenger_m_thumbna_8258db_idx'),
+        ),
+    ]
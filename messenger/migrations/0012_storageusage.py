@@ -0,0 +1,44 @@
+# Generated by Django 5.2.18 on 2026-10-19 09:23
+
+from django.db import migrations, models
+from django.db.models import Count, Sum
+
+
+def backfill_usage(apps, schema_editor):
+    """Счетчики по уже загруженным (не удаленным) файлам - один раз, дальше они ведутся сами"""
+    MediaFile = apps.get_model('messenger', 'MediaFile')
+    StorageUsage = apps.get_model('messenger', 'StorageUsage')
+    live = MediaFile.objects.filter(is_deleted=False).order_by()
+    for scope, field in (('user', 'sender_id'), ('chat', 'chat_id')):
+        StorageUsage.objects.bulk_create(
+            StorageUsage(scope=scope, object_id=row[field], bytes=row['total'] or 0, files=row['count'])
+            for row in live.values(field).annotate(total=Sum('file_size'), count=Count('id')).iterator()
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('messenger', '0011_media_gc'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StorageUsage',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('scope', models.CharField(choices=[('user', 'Пользователь'), ('chat', 'Чат')], max_length=8, verbose_name='Область')),
+                ('object_id', models.BigIntegerField(verbose_name='Id пользователя или чата')),
+                ('bytes', models.BigIntegerField(default=0, verbose_name='Байт')),
+                ('files', models.IntegerField(default=0, verbose_name='Файлов')),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'verbose_name': 'Занятое место',
+                'verbose_name_plural': 'Занятое место',
+                'indexes': [models.Index(fields=['scope', '-bytes'], name='storage_usage_top')],
+                'constraints': [models.UniqueConstraint(fields=('scope', 'object_id'), name='unique_storage_usage')],
+            },
+        ),
+        migrations.RunPython(backfill_usage, migrations.RunPython.noop),
+    ]
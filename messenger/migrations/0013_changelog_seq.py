@@ -0,0 +1,22 @@
+# Generated by Django 5.2.18 on 2026-10-19 09:36
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('messenger', '0012_storageusage'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='changelog',
+            name='seq',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='changelog',
+            index=models.Index(fields=['scope', 'seq'], name='changelog_scope_chat_seq'),
+        ),
+    ]
@@ -1,8 +1,11 @@
-from django.db import models
+from django.db import IntegrityError, models, transaction
+from django.db.models import F
 from django.conf import settings
 from django.utils import timezone
 import os
 
+from . import metrics
+
 
 def media_upload_path(instance, filename):
     """
@@ -71,6 +74,40 @@ class MediaFile(models.Model):
         verbose_name="Длительность"
     )
 
+    # Извлекается в фоне (messenger.media_processing)
+    width = models.PositiveIntegerField(
+        null=True,
+        blank=True,
+        verbose_name="Ширина"
+    )
+    height = models.PositiveIntegerField(
+        null=True,
+        blank=True,
+        verbose_name="Высота"
+    )
+    placeholder = models.CharField(
+        max_length=64,
+        blank=True,
+        help_text="Сетка пикселей для мгновенной раскладки (messenger.placeholders)",
+        verbose_name="Заглушка"
+    )
+    codec = models.CharField(
+        max_length=50,
+        blank=True,
+        verbose_name="Кодек"
+    )
+    waveform = models.JSONField(
+        default=list,
+        blank=True,
+        help_text="Пики громкости 0..100 для голосовых и аудио",
+        verbose_name="Форма волны"
+    )
+    processed_at = models.DateTimeField(
+        null=True,
+        blank=True,
+        verbose_name="Метаданные извлечены"
+    )
+
     # Миниатюра (для видео и изображений)
     thumbnail = models.ImageField(
         upload_to=thumbnail_upload_path,
@@ -94,6 +131,11 @@ class MediaFile(models.Model):
         default=False,
         verbose_name="Удален"
     )
+    deleted_at = models.DateTimeField(
+        null=True,
+        blank=True,
+        verbose_name="Время удаления"
+    )
 
     # Статистика
     views_count = models.IntegerField(
@@ -113,6 +155,10 @@ class MediaFile(models.Model):
             models.Index(fields=['chat', 'uploaded_at']),
             models.Index(fields=['file_type', 'uploaded_at']),
             models.Index(fields=['sender', 'uploaded_at']),
+            # Сборщик мусора (messenger.media_gc): удаленные по времени и поиск строки по пути файла
+            models.Index(fields=['is_deleted', 'deleted_at']),
+            models.Index(fields=['file']),
+            models.Index(fields=['thumbnail']),
         ]
 
     def __str__(self):
@@ -186,9 +232,21 @@ class MediaFile(models.Model):
         self.save(update_fields=['downloads_count'])
 
     def soft_delete(self):
-        """Мягкое удаление файла"""
-        self.is_deleted = True
-        self.save(update_fields=['is_deleted'])
+        """Мягкое удаление файла (байты на диске удалит messenger.media_gc); счетчик чата - через F"""
+        with transaction.atomic():
+            deleted_at = timezone.now()
+            if not MediaFile.objects.filter(pk=self.pk, is_deleted=False).update(is_deleted=True, deleted_at=deleted_at):
+                self.is_deleted = True
+                return False
+            self.is_deleted = True
+            self.deleted_at = deleted_at
+            ChatRoom.objects.filter(pk=self.chat_id, total_media_files__gt=0).update(
+                total_media_files=F('total_media_files') - 1,
+            )
+            # Квота освобождается сразу, хотя байты удалит сборщик мусора позже
+            StorageUsage.charge(self.sender_id, self.chat_id, -self.file_size, -1)
+            ChangeLog.record(ChangeLog.chat_scope(self.chat_id), 'media_deleted', self.id)
+        return True
 
     @property
     def can_preview(self):
@@ -201,6 +259,11 @@ class MediaFile(models.Model):
         return self.is_video() or self.is_audio() or self.is_voice()
 
 
+def broadcast_group_name(chat_id, broadcast_tier=False):
+    """chat_<id> - группа соединений; broadcast_<id> - группа хабов процессов"""
+    return f'broadcast_{chat_id}' if broadcast_tier else f'chat_{chat_id}'
+
+
 class ChatRoom(models.Model):
     """
     Обновленная модель чата с медиа-статистикой
@@ -237,6 +300,17 @@ class ChatRoom(models.Model):
         verbose_name="Последняя загрузка медиа"
     )
 
+    # Последний выданный порядковый номер сообщения в чате
+    last_seq = models.BigIntegerField(
+        default=0,
+        verbose_name="Последний номер сообщения"
+    )
+    # Большая группа: события идут через хаб процесса (messenger.broadcast)
+    broadcast_tier = models.BooleanField(
+        default=False,
+        verbose_name="Широковещательный режим"
+    )
+
     def __str__(self):
         if self.name:
             return self.name
@@ -245,13 +319,32 @@ class ChatRoom(models.Model):
             return f"Чат между {participants[0]} и {participants[1]}"
         return f"Групповой чат {self.id}"
 
+    @property
+    def group_name(self):
+        """Группа каналов, в которую рассылаются события чата"""
+        return broadcast_group_name(self.pk, self.broadcast_tier)
+
     def update_media_stats(self):
         """Обновляет статистику медиафайлов в чате"""
         self.total_media_files = self.media_files.filter(is_deleted=False).count()
         last_media = self.media_files.filter(is_deleted=False).order_by('-uploaded_at').first()
         if last_media:
             self.last_media_upload = last_media.uploaded_at
-        self.save()
+        self.save(update_fields=['total_media_files', 'last_media_upload', 'updated_at'])
+
+    def next_seq(self):
+        """Выдает следующий порядковый номер сообщения (вызывать внутри транзакции)"""
+        self.last_seq = ChatRoom.allocate_seq(self.pk)
+        return self.last_seq
+
+    @staticmethod
+    def allocate_seq(chat_id):
+        """
+        next_seq без загрузки чата. Тем же запросом сдвигается updated_at:
+        отдельное сохранение чата после каждого сообщения не нужно.
+        """
+        ChatRoom.objects.filter(pk=chat_id).update(last_seq=F('last_seq') + 1, updated_at=timezone.now())
+        return ChatRoom.objects.values_list('last_seq', flat=True).get(pk=chat_id)
 
     class Meta:
         verbose_name = "Чат"
@@ -293,6 +386,17 @@ class Message(models.Model):
     timestamp = models.DateTimeField(
         auto_now_add=True
     )
+    seq = models.BigIntegerField(
+        null=True,
+        blank=True,
+        verbose_name="Порядковый номер в чате"
+    )
+    client_id = models.CharField(
+        max_length=64,
+        null=True,
+        blank=True,
+        verbose_name="Id сообщения на клиенте"
+    )
     read_by = models.ManyToManyField(
         settings.AUTH_USER_MODEL,
         related_name='read_messages',
@@ -306,6 +410,10 @@ class Message(models.Model):
         default=False,
         verbose_name="Редактировано"
     )
+    is_deleted = models.BooleanField(
+        default=False,
+        verbose_name="Удалено"
+    )
     edited_at = models.DateTimeField(
         null=True,
         blank=True,
@@ -337,6 +445,15 @@ class Message(models.Model):
             models.Index(fields=['sender', 'timestamp']),
             models.Index(fields=['message_type', 'timestamp']),
         ]
+        constraints = [
+            models.UniqueConstraint(fields=['chat', 'seq'], name='unique_message_seq_per_chat'),
+            # Повтор отправки с тем же client_id не создает второе сообщение (messenger.idempotency)
+            models.UniqueConstraint(
+                fields=['chat', 'sender', 'client_id'],
+                condition=models.Q(client_id__isnull=False),
+                name='unique_message_client_id',
+            ),
+        ]
 
     def __str__(self):
         if self.media_file:
@@ -345,17 +462,31 @@ class Message(models.Model):
 
     def save(self, *args, **kwargs):
         """Переопределяем сохранение для автоматического определения типа"""
-        if self.media_file:
+        update_fields = kwargs.get('update_fields')
+        # Статистика медиа чата пересчитывается, только если сохраняется сам медиафайл
+        media_changed = update_fields is None or 'media_file' in update_fields
+        if self.is_deleted:
+            pass  # у удаленного сообщения нет ни текста, ни файла
+        elif self.media_file:
             self.message_type = self.media_file.file_type
         elif not self.content.strip():
             raise ValueError("Сообщение должно содержать текст или медиафайл")
         else:
             self.message_type = 'text'
 
-        super().save(*args, **kwargs)
+        adding = self._state.adding
+        with transaction.atomic():
+            if adding and self.seq is None:
+                # Номер выдается в той же транзакции, что и вставка: без дыр и повторов
+                self.seq = ChatRoom.allocate_seq(self.chat_id)
+            super().save(*args, **kwargs)
+            if adding:
+                ChangeLog.record(ChangeLog.chat_scope(self.chat_id), 'message', self.id)
+        if adding:
+            metrics.messages_persisted.labels(self.message_type).inc()
 
         # Обновляем статистику чата если есть медиа
-        if self.media_file:
+        if self.media_file and media_changed:
             self.chat.update_media_stats()
 
     def has_media(self):
@@ -364,21 +495,54 @@ class Message(models.Model):
 
     def mark_as_read(self, user):
         """Пометить сообщение как прочитанное"""
-        if user not in self.read_by.all():
+        if not self.read_by.filter(pk=user.pk).exists():
             self.read_by.add(user)
-            self.is_read = True
-            self.save()
+            if not self.is_read:
+                Message.objects.filter(pk=self.pk).update(is_read=True)
+                self.is_read = True
 
     def edit_message(self, new_content):
         """Редактировать сообщение"""
-        if not self.has_media():  # Текстовые сообщения можно редактировать
+        if not self.has_media() and not self.is_deleted:  # Текстовые сообщения можно редактировать
             self.content = new_content
             self.is_edited = True
             self.edited_at = timezone.now()
-            self.save()
+            with transaction.atomic():
+                self.save(update_fields=['content', 'is_edited', 'edited_at'])
+                self.record_patch('edit')
             return True
         return False
 
+    def delete_for_everyone(self):
+        """Удаление у всех: остается отметка "сообщение удалено", файл удаляется мягко"""
+        if self.is_deleted:
+            return False
+        self.is_deleted = True
+        self.content = ''
+        with transaction.atomic():
+            self.save(update_fields=['is_deleted', 'content'])
+            if self.media_file is not None:
+                self.media_file.soft_delete()
+            self.record_patch('delete', unsent=False)
+        return True
+
+    def unsend(self):
+        """Отзыв сообщения: строка удаляется целиком, без отметки в истории"""
+        with transaction.atomic():
+            if self.media_file is not None:
+                self.media_file.soft_delete()
+            self.record_patch('delete', unsent=True)
+            self.delete()
+
+    def record_patch(self, kind, **data):
+        """
+        Запись изменения в журнал с номером из последовательности чата:
+        message_patch досылается при переподключении наравне с сообщениями.
+        Номер остается в patch_seq для события.
+        """
+        self.patch_seq = ChatRoom.allocate_seq(self.chat_id)
+        ChangeLog.record(ChangeLog.chat_scope(self.chat_id), kind, self.id, seq=self.patch_seq, **data)
+
 
 class Contact(models.Model):
     """Модель контактов (без изменений)"""
@@ -392,4 +556,137 @@ class Contact(models.Model):
         verbose_name_plural = "Контакты"
 
     def __str__(self):
-        return f"{self.user} -> {self.contact}"
\ No newline at end of file
+        return f"{self.user} -> {self.contact}"
+
+
+class OutboxEvent(models.Model):
+    """
+    Событие для группы каналов, записанное в одной транзакции с данными
+    (transactional outbox). Публикуется после коммита; то, что не удалось
+    опубликовать, досылает manage.py relay_outbox (messenger.outbox).
+    """
+    group = models.CharField(max_length=100, verbose_name="Группа каналов")
+    payload = models.JSONField(verbose_name="Событие")
+    # Ключ для проверки "уже опубликовано", например message:<id>
+    key = models.CharField(max_length=100, blank=True, db_index=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    published_at = models.DateTimeField(null=True, blank=True)
+    attempts = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        verbose_name = "Событие outbox"
+        verbose_name_plural = "События outbox"
+        indexes = [
+            models.Index(fields=['published_at', 'id']),
+        ]
+
+    def __str__(self):
+        return f"{self.group}: {self.payload.get('type')}"
+
+
+class ChangeLog(models.Model):
+    """
+    Журнал изменений для дельта-синхронизации (только добавление).
+    Область - кому видно изменение: чат (chat:<id>) или пользователь
+    (user:<id>); номер - id записи, общий для всех областей.
+    """
+    KINDS = [
+        ('message', 'Новое сообщение'),
+        ('edit', 'Редактирование'),
+        ('media_deleted', 'Удаление медиафайла'),
+        ('delete', 'Удаление сообщения'),
+        ('membership', 'Изменение участников'),
+        ('read', 'Прочтение'),
+    ]
+
+    scope = models.CharField(max_length=32, verbose_name="Область")
+    kind = models.CharField(max_length=20, choices=KINDS, verbose_name="Тип изменения")
+    object_id = models.BigIntegerField(null=True, blank=True)
+    data = models.JSONField(default=dict, blank=True)
+    # Номер в последовательности чата (ChatRoom.last_seq) у правок и удалений
+    seq = models.BigIntegerField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        verbose_name = "Изменение"
+        verbose_name_plural = "Журнал изменений"
+        indexes = [
+            models.Index(fields=['scope', 'id'], name='changelog_scope_seq'),
+            models.Index(fields=['scope', 'seq'], name='changelog_scope_chat_seq'),
+            models.Index(fields=['created_at']),
+        ]
+
+    def __str__(self):
+        return f"{self.id} {self.scope} {self.kind}"
+
+    @staticmethod
+    def chat_scope(chat_id):
+        return f'chat:{chat_id}'
+
+    @staticmethod
+    def user_scope(user_id):
+        return f'user:{user_id}'
+
+    @classmethod
+    def record(cls, scope, kind, object_id=None, seq=None, **data):
+        return cls.objects.create(scope=scope, kind=kind, object_id=object_id, seq=seq, data=data)
+
+
+class Checkpoint(models.Model):
+    """Позиция долгой фоновой работы, чтобы продолжить ее после остановки"""
+    name = models.CharField(max_length=64, unique=True)
+    position = models.TextField(blank=True, default='')
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        verbose_name = "Контрольная точка"
+        verbose_name_plural = "Контрольные точки"
+
+    def __str__(self):
+        return f"{self.name}: {self.position}"
+
+
+class StorageUsage(models.Model):
+    """
+    Занятое медиафайлами место: счетчики байт и файлов на пользователя и
+    на чат (messenger.quotas). Обновляются через F в транзакции загрузки
+    или удаления, поэтому проверка квоты - чтение двух строк.
+    """
+    SCOPES = [
+        ('user', 'Пользователь'),
+        ('chat', 'Чат'),
+    ]
+
+    scope = models.CharField(max_length=8, choices=SCOPES, verbose_name="Область")
+    object_id = models.BigIntegerField(verbose_name="Id пользователя или чата")
+    bytes = models.BigIntegerField(default=0, verbose_name="Байт")
+    files = models.IntegerField(default=0, verbose_name="Файлов")
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        verbose_name = "Занятое место"
+        verbose_name_plural = "Занятое место"
+        constraints = [
+            models.UniqueConstraint(fields=['scope', 'object_id'], name='unique_storage_usage'),
+        ]
+        indexes = [
+            # Отчет о крупнейших потребителях - по индексу, без агрегата по MediaFile
+            models.Index(fields=['scope', '-bytes'], name='storage_usage_top'),
+        ]
+
+    def __str__(self):
+        return f"{self.scope}:{self.object_id} {self.bytes} байт"
+
+    @classmethod
+    def charge(cls, user_id, chat_id, size, files):
+        """Изменяет счетчики пользователя и чата (size и files могут быть отрицательными)"""
+        changes = {'bytes': F('bytes') + size, 'files': F('files') + files, 'updated_at': timezone.now()}
+        for scope, object_id in (('user', user_id), ('chat', chat_id)):
+            if cls.objects.filter(scope=scope, object_id=object_id).update(**changes):
+                continue
+            try:
+                with transaction.atomic():
+                    cls.objects.create(scope=scope, object_id=object_id, bytes=size, files=files)
+            except IntegrityError:
+                # Строку создал параллельный запрос - теперь обновление пройдет
+                cls.objects.filter(scope=scope, object_id=object_id).update(**changes)
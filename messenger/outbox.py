@@ -0,0 +1,111 @@
+"""
+Transactional outbox для событий групп каналов.
+
+Представление записывает событие в OutboxEvent в той же транзакции, что
+и сообщение, и публикует его в слой каналов после коммита. Если слой
+недоступен или процесс упал между коммитом и публикацией, событие
+остается неопубликованным, и его досылает relay() (manage.py
+relay_outbox). Доставка "хотя бы один раз": повтор события с тем же
+seq консьюмер отбрасывает, а досланное позже событие с меньшим seq
+доставляет - повтором считается только уже полученный номер
+(replay.SeqWindow в BaseChatConsumer.deliver).
+
+После OUTBOX_MAX_ATTEMPTS неудачных публикаций событие больше не
+досылается (dead letter): оно остается в таблице для разбора, а
+relay_outbox --retry-dead возвращает такие события в очередь.
+"""
+import logging
+from datetime import timedelta
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from . import metrics
+from .models import OutboxEvent
+
+logger = logging.getLogger(__name__)
+
+
+def max_attempts():
+    return getattr(settings, 'OUTBOX_MAX_ATTEMPTS', 10)
+
+
+def message_key(message_id):
+    return f'message:{message_id}'
+
+
+def enqueue(group, event, key=''):
+    """Записывает событие в текущей транзакции и публикует его после коммита"""
+    record = OutboxEvent.objects.create(group=group, payload=event, key=key)
+    transaction.on_commit(lambda: publish(record))
+    return record
+
+
+def publish(record):
+    """Отправка в группу; True, если событие опубликовано"""
+    try:
+        async_to_sync(get_channel_layer().group_send)(record.group, record.payload)
+    except Exception:
+        metrics.outbox_events.labels('failed').inc()
+        OutboxEvent.objects.filter(pk=record.pk).update(attempts=F('attempts') + 1)
+        logger.exception('Не удалось опубликовать событие outbox %s', record.pk)
+        record.attempts += 1
+        if record.attempts >= max_attempts():
+            metrics.outbox_events.labels('dead').inc()
+            logger.error('Событие outbox %s не опубликовано за %s попыток и больше не досылается',
+                         record.pk, record.attempts)
+        return False
+    metrics.outbox_events.labels('published').inc()
+    OutboxEvent.objects.filter(pk=record.pk).update(published_at=timezone.now())
+    return True
+
+
+def relay(batch_size=None):
+    """
+    Досылает неопубликованные события старше OUTBOX_RELAY_DELAY секунд
+    (более свежие еще публикует само представление), кроме исчерпавших
+    OUTBOX_MAX_ATTEMPTS. Возвращает (опубликовано, ошибок).
+    """
+    batch_size = batch_size or getattr(settings, 'OUTBOX_RELAY_BATCH_SIZE', 100)
+    cutoff = timezone.now() - timedelta(seconds=getattr(settings, 'OUTBOX_RELAY_DELAY', 5))
+    pending = OutboxEvent.objects.filter(
+        published_at__isnull=True,
+        created_at__lt=cutoff,
+        attempts__lt=max_attempts(),
+    ).order_by('id')[:batch_size]
+    published = failed = 0
+    for record in pending:
+        if publish(record):
+            published += 1
+        else:
+            failed += 1
+    return published, failed
+
+
+def dead_letters():
+    """События, которые relay() больше не досылает"""
+    return OutboxEvent.objects.filter(published_at__isnull=True, attempts__gte=max_attempts())
+
+
+def retry_dead():
+    """Возвращает dead letters в очередь relay(); сколько возвращено"""
+    return dead_letters().update(attempts=0)
+
+
+def purge():
+    """Удаляет опубликованные события старше OUTBOX_RETENTION_HOURS"""
+    cutoff = timezone.now() - timedelta(hours=getattr(settings, 'OUTBOX_RETENTION_HOURS', 24))
+    deleted, _ = OutboxEvent.objects.filter(published_at__lt=cutoff).delete()
+    return deleted
+
+
+def is_published(message_id):
+    """
+    Сообщение уже разослано сервером (старые клиенты присылают его повторно).
+    Неопубликованное событие не в счет: его рассылка еще не состоялась.
+    """
+    return OutboxEvent.objects.filter(key=message_key(message_id), published_at__isnull=False).exists()
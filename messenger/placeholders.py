@@ -0,0 +1,62 @@
+"""
+Заглушки изображений для мгновенной раскладки (LQIP).
+
+Заглушка - сетка в несколько пикселей (4x3 для альбомной ориентации и
+квадрата, 3x4 для книжной) в виде строки "4x3:<base64 RGB>": 12 пикселей -
+36 байт, 48 символов base64 и 52 с префиксом (не больше 64 символов
+поля MediaFile.placeholder). Клиент рисует ее на canvas и растягивает
+со сглаживанием (static/js/placeholders.js), пока не загрузится
+настоящая миниатюра.
+"""
+import base64
+
+# Длинная сторона сетки в пикселях; короткая - не больше GRID - 1
+GRID = 4
+
+# Значения EXIF Orientation, при которых ширина и высота меняются местами
+ROTATED_ORIENTATIONS = (5, 6, 7, 8)
+
+
+def encode(image):
+    """Заглушка по открытому изображению Pillow (уже в нужной ориентации)"""
+    from PIL import Image
+
+    width, height = image.size
+    if width >= height:
+        grid = (GRID, min(GRID - 1, max(1, round(GRID * height / width))))
+    else:
+        grid = (min(GRID - 1, max(1, round(GRID * width / height))), GRID)
+    pixels = image.convert('RGB').resize(grid, Image.Resampling.BOX).tobytes()
+    return f'{grid[0]}x{grid[1]}:' + base64.b64encode(pixels).decode('ascii').rstrip('=')
+
+
+def decode(placeholder):
+    """(ширина, высота, байты RGB) заглушки - как ее разбирает placeholders.js"""
+    size, _, data = placeholder.partition(':')
+    width, height = (int(side) for side in size.split('x'))
+    pixels = base64.b64decode(data + '=' * (-len(data) % 4))
+    if len(pixels) != width * height * 3:
+        raise ValueError(f'Заглушка {size}: {len(pixels)} байт вместо {width * height * 3}')
+    return width, height, pixels
+
+
+def image_info(file):
+    """
+    (ширина, высота, заглушка) для загруженного файла изображения.
+    Размеры - с учетом поворота из EXIF. Файл возвращается в начало.
+    """
+    from PIL import Image, ImageOps
+
+    try:
+        with Image.open(file) as image:
+            width, height = image.size
+            if image.getexif().get(0x0112) in ROTATED_ORIENTATIONS:
+                width, height = height, width
+            # Для JPEG декодируется уменьшенная копия - это в разы быстрее
+            image.draft('RGB', (64, 64))
+            placeholder = encode(ImageOps.exif_transpose(image))
+        return width, height, placeholder
+    except Exception:
+        return None, None, ''
+    finally:
+        file.seek(0)
@@ -0,0 +1,305 @@
+"""
+Семплирующий профилировщик процесса (по запросу, PROFILER_ENABLED).
+
+Отдельный поток раз в PROFILER_INTERVAL секунд снимает стеки всех потоков
+через sys._current_frames() и копит их в формате collapsed stacks
+(метка;модуль:функция;... число) - его понимают flamegraph.pl и speedscope.
+
+Первый элемент стека - метка: имя представления или тип события WebSocket.
+Метки ставит profiling.tag() только пока идет съемка, поэтому в обычном
+режиме накладные расходы - одна проверка флага.
+
+Запуск:
+    * manage.py profile --pid PID --seconds 30 - сигнал SIGUSR2 процессу;
+    * GET /internal/profile/?token=... - подписанная одноразовая ссылка
+      (manage.py profile --token), ответ - стеки за окно съемки.
+
+Интервал между снимками ограничен INTERVAL_RANGE: 0 превратил бы поток
+в активное ожидание, а отрицательный уронил бы его в time.sleep.
+"""
+import asyncio
+import json
+import logging
+import math
+import os
+import secrets
+import signal
+import sys
+import threading
+import time
+import weakref
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+
+from django.conf import settings
+from django.core import signing
+from django.core.cache import caches
+
+logger = logging.getLogger(__name__)
+
+TOKEN_SALT = 'messenger.profiling'
+MAX_DEPTH = 128
+INTERVAL_RANGE = (0.001, 1.0)  # секунд между снимками стеков
+
+# Метки потоков (синхронные представления, потоки ORM) и задач asyncio (консьюмеры)
+_thread_labels = {}
+_task_labels = weakref.WeakKeyDictionary()
+# Потоки с циклом событий: метку в них берем по текущей задаче цикла
+_loop_threads = {}
+# Метка переходит в потоки database_sync_to_async вместе с контекстом
+_label = ContextVar('profiler_label', default=None)
+
+_lock = threading.Lock()
+_active = None
+
+
+class ProfilerBusy(Exception):
+    pass
+
+
+class Sampler(threading.Thread):
+    """Поток-сборщик стеков на время одной съемки"""
+
+    def __init__(self, seconds, interval):
+        super().__init__(name='messenger-profiler', daemon=True)
+        self.seconds = seconds
+        self.interval = interval
+        self.stacks = Counter()
+        self.samples = 0
+
+    def run(self):
+        own_id = threading.get_ident()
+        deadline = time.monotonic() + self.seconds
+        names = {}
+        while time.monotonic() < deadline:
+            for thread in threading.enumerate():
+                names[thread.ident] = thread.name
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                label = current_label(thread_id) or names.get(thread_id, 'thread')
+                self.stacks[collapse(label, frame)] += 1
+            self.samples += 1
+            time.sleep(self.interval)
+
+    def collapsed(self):
+        """Стеки в формате collapsed, самые частые первыми"""
+        return ''.join(f'{stack} {count}\n' for stack, count in self.stacks.most_common())
+
+
+def current_label(thread_id):
+    label = _thread_labels.get(thread_id)
+    if label is not None:
+        return label
+    loop = _loop_threads.get(thread_id)
+    if loop is not None:
+        task = asyncio.current_task(loop)
+        if task is not None:
+            return _task_labels.get(task)
+    return None
+
+
+def collapse(label, frame):
+    parts = []
+    while frame is not None and len(parts) < MAX_DEPTH:
+        code = frame.f_code
+        name = getattr(code, 'co_qualname', code.co_name)
+        parts.append(f"{frame.f_globals.get('__name__', '?')}:{name}")
+        frame = frame.f_back
+    parts.append(label)
+    return ';'.join(reversed(parts)).replace(' ', '_')
+
+
+@contextmanager
+def tag(label):
+    """Помечает работу текущего потока или задачи asyncio для профилировщика"""
+    if _active is None:
+        yield
+        return
+
+    try:
+        task = asyncio.current_task()
+    except RuntimeError:
+        task = None
+
+    token = _label.set(label)
+    if task is not None:
+        _loop_threads[threading.get_ident()] = task.get_loop()
+        labels, key = _task_labels, task
+    else:
+        labels, key = _thread_labels, threading.get_ident()
+    previous = labels.get(key)
+    labels[key] = label
+    try:
+        yield
+    finally:
+        if previous is None:
+            labels.pop(key, None)
+        else:
+            labels[key] = previous
+        _label.reset(token)
+
+
+def labelled(func):
+    """
+    Обертка для функций, которые выполняются в потоке ORM: метка вызвавшей
+    задачи переносится на этот поток, и время запросов попадает в тот же
+    тип события (messenger.asyncdb).
+    """
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        label = _label.get()
+        if label is None or _active is None:
+            return func(*args, **kwargs)
+        with tag(label):
+            return func(*args, **kwargs)
+
+    return wrapper
+
+
+def bounded(value, default, low, high):
+    """Число value (пустое - default) в пределах [low, high]; ValueError - не число"""
+    if value is None or value == '':
+        value = default
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        raise ValueError(f'Ожидалось число секунд, получено {value!r}') from None
+    if not math.isfinite(number):
+        raise ValueError(f'Ожидалось число секунд, получено {value!r}')
+    return min(max(number, low), high)
+
+
+def start(seconds=None, interval=None):
+    """
+    Запускает съемку в этом процессе; ProfilerBusy, если она уже идет.
+    seconds и interval приводятся к допустимым пределам, ValueError - не числа.
+    """
+    global _active
+    seconds = bounded(
+        seconds,
+        getattr(settings, 'PROFILER_DEFAULT_SECONDS', 10),
+        0,
+        getattr(settings, 'PROFILER_MAX_SECONDS', 60),
+    )
+    interval = bounded(interval, getattr(settings, 'PROFILER_INTERVAL', 0.005), *INTERVAL_RANGE)
+    with _lock:
+        if _active is not None:
+            raise ProfilerBusy('Профилирование уже запущено')
+        _active = Sampler(seconds, interval)
+        sampler = _active
+    sampler.start()
+    return sampler
+
+
+def finish(sampler):
+    """Ждет конца съемки и снимает метки"""
+    global _active
+    sampler.join()
+    with _lock:
+        if _active is sampler:
+            _active = None
+    _thread_labels.clear()
+    _task_labels.clear()
+    _loop_threads.clear()
+    return sampler
+
+
+def profile(seconds=None, interval=None):
+    """Съемка с ожиданием результата: возвращает Sampler"""
+    return finish(start(seconds, interval))
+
+
+# ==================== ПОДПИСАННЫЕ ССЫЛКИ ====================
+
+def make_token(seconds):
+    """Подписанная ссылка на одну съемку: длительность и случайный nonce"""
+    return signing.TimestampSigner(salt=TOKEN_SALT).sign(f'{seconds}:{secrets.token_urlsafe(12)}')
+
+
+def check_token(token):
+    """
+    Длительность съемки из подписанного токена; BadSignature, если он
+    недействителен, просрочен или уже использован. Nonce запоминается в кэше
+    PROFILER_TOKEN_CACHE на срок жизни токена: с кэшем в памяти процесса
+    повтор отсекается только в том же процессе.
+    """
+    max_age = getattr(settings, 'PROFILER_TOKEN_MAX_AGE', 300)
+    value = signing.TimestampSigner(salt=TOKEN_SALT).unsign(token, max_age=max_age)
+    seconds, _, nonce = value.partition(':')
+    if not nonce:
+        raise signing.BadSignature('Токен без nonce')
+    cache = caches[getattr(settings, 'PROFILER_TOKEN_CACHE', 'default')]
+    if not cache.add(f'profiling.token.{nonce}', True, timeout=max_age):
+        raise signing.BadSignature('Токен уже использован')
+    return float(seconds)
+
+
+# ==================== ЗАПУСК ПО СИГНАЛУ ====================
+
+def control_dir():
+    return str(getattr(settings, 'PROFILER_OUTPUT_DIR', os.path.join(settings.BASE_DIR, 'profiles')))
+
+
+def request_path(pid):
+    return os.path.join(control_dir(), f'{pid}.request.json')
+
+
+def _run_requested():
+    path = request_path(os.getpid())
+    try:
+        with open(path, encoding='utf-8') as request_file:
+            request = json.load(request_file)
+        os.remove(path)
+    except (OSError, ValueError):
+        request = {}
+    try:
+        sampler = profile(request.get('seconds'), request.get('interval'))
+    except ProfilerBusy:
+        logger.warning('Профилирование уже запущено, сигнал пропущен')
+        return
+    except ValueError as e:
+        logger.warning('Неверный запрос профилирования: %s', e)
+        return
+    output = request.get('output') or os.path.join(
+        control_dir(), f'{os.getpid()}-{int(time.time())}.folded',
+    )
+    with open(output, 'w', encoding='utf-8') as output_file:
+        output_file.write(sampler.collapsed())
+    logger.info('Профиль записан в %s (%s замеров)', output, sampler.samples)
+
+
+def _handle_signal(signum, frame):
+    # Обработчик сигнала должен вернуться быстро: съемка идет в своем потоке
+    threading.Thread(target=_run_requested, name='messenger-profiler-request', daemon=True).start()
+
+
+def install_signal_handler():
+    """SIGUSR2 запускает съемку; только главный поток и только POSIX"""
+    if not getattr(settings, 'PROFILER_ENABLED', False) or not hasattr(signal, 'SIGUSR2'):
+        return
+    if threading.current_thread() is not threading.main_thread():
+        return
+    signal.signal(signal.SIGUSR2, _handle_signal)
+
+
+class ProfilerMiddleware:
+    """Метка представления для семплов синхронного HTTP-запроса"""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if _active is None:
+            return self.get_response(request)
+        with tag('http'):
+            return self.get_response(request)
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        # Уточняем метку, поставленную в __call__, когда маршрут уже известен
+        thread_id = threading.get_ident()
+        if thread_id in _thread_labels:
+            _thread_labels[thread_id] = request.resolver_match.view_name
+        return None
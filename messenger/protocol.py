@@ -0,0 +1,245 @@
+"""
+Кодеки протокола WebSocket для ChatConsumer.
+
+По умолчанию используется JSON (как и раньше). Клиент может запросить
+компактный бинарный протокол через WebSocket subprotocol:
+
+    tax.msgpack.v1          - MessagePack с целочисленными кодами типов и ключей
+    tax.msgpack.v1+deflate  - то же самое, каждый кадр сжат deflate
+                              (общий словарь на всё соединение, как в permessage-deflate)
+
+В компактном протоколе имя пользователя передается только в первом событии
+от этого пользователя, дальше клиент берет его из своего кэша по id.
+
+Кадр клиента больше CHAT_MAX_FRAME_SIZE байт (для deflate - после
+распаковки) не разбирается: decode бросает FrameTooLarge, и соединение
+закрывается с кодом 1009. Испорченный поток deflate - FrameError и 1007:
+общий словарь соединения после ошибки уже не восстановить.
+"""
+import json
+import zlib
+
+from django.conf import settings
+
+try:
+    import msgpack
+except ImportError:  # msgpack - необязательная зависимость
+    msgpack = None
+
+
+SUBPROTOCOL_MSGPACK = 'tax.msgpack.v1'
+SUBPROTOCOL_MSGPACK_DEFLATE = 'tax.msgpack.v1+deflate'
+
+# Коды типов событий. Новые типы добавлять только в конец!
+TYPE_CODES = {
+    'chat_message': 1,
+    'media_message': 2,
+    'voice_message': 3,
+    'typing': 4,
+    'error': 5,
+    'resync_required': 6,
+    'subscribe': 7,
+    'unsubscribe': 8,
+    'subscribed': 9,
+    'credit': 10,
+    'media_updated': 11,
+    'wrong_shard': 12,
+    'message_ack': 13,
+    'message_patch': 14,
+    'edit_message': 15,
+    'delete_message': 16,
+    'unsend_message': 17,
+}
+TYPE_NAMES = {code: name for name, code in TYPE_CODES.items()}
+
+# Коды ключей. Неизвестные ключи передаются как есть (строкой)
+FIELD_CODES = {
+    'type': 0,
+    'message': 1,
+    'sender_id': 2,
+    'sender_username': 3,
+    'timestamp': 4,
+    'message_id': 5,
+    'media': 6,
+    'voice': 7,
+    'content': 8,
+    'user_id': 9,
+    'username': 10,
+    'is_typing': 11,
+    'id': 12,
+    'url': 13,
+    'thumbnail_url': 14,
+    'name': 15,
+    'size': 16,
+    'duration': 17,
+    'caption': 18,
+    'code': 19,
+    'error': 20,
+    'seq': 21,
+    'last_seq': 22,
+    'chat_id': 23,
+    'window': 24,
+    'credit': 25,
+    'retry_after': 26,
+    'width': 27,
+    'height': 28,
+    'poster_url': 29,
+    'waveform': 30,
+    'placeholder': 31,
+    'shard': 32,
+    'client_id': 33,
+    'duplicate': 34,
+    'is_edited': 35,
+    'edited_at': 36,
+    'deleted': 37,
+    'unsent': 38,
+}
+FIELD_NAMES = {code: name for name, code in FIELD_CODES.items()}
+
+# Коды закрытия WebSocket (RFC 6455)
+INVALID_FRAME_CLOSE_CODE = 1007
+FRAME_TOO_LARGE_CLOSE_CODE = 1009
+
+# Пары (id, имя), имя в которых интернируется
+INTERNED_USER_FIELDS = [
+    ('sender_id', 'sender_username'),
+    ('user_id', 'username'),
+]
+
+
+class FrameError(ValueError):
+    """Кадр клиента нельзя разобрать, соединение закрывается с close_code"""
+    close_code = INVALID_FRAME_CLOSE_CODE
+
+
+class FrameTooLarge(FrameError):
+    """Кадр клиента (после распаковки) больше CHAT_MAX_FRAME_SIZE"""
+    close_code = FRAME_TOO_LARGE_CLOSE_CODE
+
+
+def max_frame_size():
+    return getattr(settings, 'CHAT_MAX_FRAME_SIZE', 256 * 1024)
+
+
+def check_size(data):
+    if data is not None and len(data) > max_frame_size():
+        raise FrameTooLarge(f'кадр больше {max_frame_size()} байт')
+
+
+class JsonCodec:
+    """Исходный JSON-протокол (текстовые кадры)"""
+    subprotocol = None
+    binary = False
+
+    def encode(self, event):
+        return json.dumps(event)
+
+    def decode(self, text_data=None, bytes_data=None):
+        check_size(text_data if bytes_data is None else bytes_data)
+        if text_data is None:
+            text_data = bytes_data.decode('utf-8')
+        return json.loads(text_data)
+
+
+class MsgpackCodec:
+    """
+    Бинарный протокол на MessagePack.
+    Создается отдельный экземпляр на каждое соединение: он хранит
+    интернированных пользователей и состояние deflate.
+    """
+    binary = True
+
+    def __init__(self, deflate=False):
+        self.deflate = deflate
+        self.subprotocol = SUBPROTOCOL_MSGPACK_DEFLATE if deflate else SUBPROTOCOL_MSGPACK
+        self._known_users = set()
+        if deflate:
+            self._compressor = zlib.compressobj(wbits=-zlib.MAX_WBITS)
+            self._decompressor = zlib.decompressobj(wbits=-zlib.MAX_WBITS)
+
+    def encode(self, event):
+        event = dict(event)
+        for id_field, name_field in INTERNED_USER_FIELDS:
+            user_id = event.get(id_field)
+            if user_id is None or name_field not in event:
+                continue
+            if user_id in self._known_users:
+                del event[name_field]
+            else:
+                self._known_users.add(user_id)
+
+        data = msgpack.packb(_compact(event), use_bin_type=True)
+        if self.deflate:
+            data = self._compressor.compress(data) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+            # Как в permessage-deflate: хвост 00 00 ff ff не передаем
+            data = data[:-4]
+        return data
+
+    def decode(self, text_data=None, bytes_data=None):
+        check_size(text_data if bytes_data is None else bytes_data)
+        if bytes_data is None:
+            # Старый клиент прислал текст в бинарном соединении
+            return json.loads(text_data)
+        if self.deflate:
+            bytes_data = self._inflate(bytes_data)
+        return _expand(msgpack.unpackb(bytes_data, raw=False, strict_map_key=False))
+
+    def _inflate(self, data):
+        """
+        Распаковка не больше max_frame_size() байт: остаток сжатых данных
+        в unconsumed_tail означает, что кадр больше - дальше не распаковываем.
+        """
+        limit = max_frame_size()
+        try:
+            data = self._decompressor.decompress(data + b'\x00\x00\xff\xff', limit)
+        except zlib.error as error:
+            raise FrameError(f'испорченный поток deflate: {error}') from error
+        if self._decompressor.unconsumed_tail:
+            raise FrameTooLarge(f'кадр после распаковки больше {limit} байт')
+        return data
+
+
+def _compact(value):
+    if isinstance(value, dict):
+        result = {}
+        for key, item in value.items():
+            if key == 'type' and item in TYPE_CODES:
+                item = TYPE_CODES[item]
+            result[FIELD_CODES.get(key, key)] = _compact(item)
+        return result
+    if isinstance(value, list):
+        return [_compact(item) for item in value]
+    return value
+
+
+def _expand(value):
+    if isinstance(value, dict):
+        result = {}
+        for key, item in value.items():
+            key = FIELD_NAMES.get(key, key)
+            if key == 'type' and isinstance(item, int):
+                item = TYPE_NAMES.get(item, item)
+            result[key] = _expand(item)
+        return result
+    if isinstance(value, list):
+        return [_expand(item) for item in value]
+    return value
+
+
+def available_subprotocols():
+    """Поддерживаемые subprotocol в порядке предпочтения"""
+    if msgpack is None:
+        return []
+    return [SUBPROTOCOL_MSGPACK_DEFLATE, SUBPROTOCOL_MSGPACK]
+
+
+def negotiate(requested):
+    """
+    Выбирает кодек по списку subprotocol из запроса клиента.
+    Если ничего не подошло - обычный JSON.
+    """
+    for subprotocol in requested or []:
+        if subprotocol not in available_subprotocols():
+            continue
+        return MsgpackCodec(deflate=subprotocol == SUBPROTOCOL_MSGPACK_DEFLATE)
+    return JsonCodec()
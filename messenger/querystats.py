@@ -0,0 +1,130 @@
+"""
+Учет SQL-запросов на HTTP-запрос и на событие WebSocket.
+
+Обертка выполнения запросов ставится на каждое соединение с БД
+(см. MessengerConfig.ready) и пишет в текущий QueryStats, если он есть.
+Текущий QueryStats хранится в contextvar, поэтому он виден и в потоках
+database_sync_to_async / sync_to_async.
+"""
+import logging
+import time
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.conf import settings
+
+from . import metrics
+
+logger = logging.getLogger('messenger.queries')
+
+_current = ContextVar('query_stats', default=None)
+
+
+class QueryBudgetExceeded(Exception):
+    pass
+
+
+class QueryStats:
+    def __init__(self, label='', parent=None):
+        self.label = label
+        # Вложенный учет (например, тест вокруг middleware) виден и внешнему
+        self.parent = parent
+        self.count = 0
+        self.time = 0.0
+        self.statements = Counter()
+
+    def add(self, sql, elapsed):
+        self.count += 1
+        self.time += elapsed
+        self.statements[sql] += 1
+        if self.parent is not None:
+            self.parent.add(sql, elapsed)
+
+    @property
+    def duplicates(self):
+        """Сколько запросов повторяют уже выполненный SQL (признак N+1)"""
+        return sum(count - 1 for count in self.statements.values() if count > 1)
+
+    def most_duplicated(self, limit=3):
+        return [(sql, count) for sql, count in self.statements.most_common(limit) if count > 1]
+
+    def as_dict(self):
+        return {
+            'label': self.label,
+            'queries': self.count,
+            'sql_time_ms': round(self.time * 1000, 2),
+            'duplicates': self.duplicates,
+        }
+
+
+def execute_wrapper(execute, sql, params, many, context):
+    stats = _current.get()
+    if stats is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        stats.add(sql, time.perf_counter() - started)
+
+
+def install(sender, connection, **kwargs):
+    """Обработчик connection_created: подключает учет к новому соединению"""
+    if execute_wrapper not in connection.execute_wrappers:
+        connection.execute_wrappers.append(execute_wrapper)
+
+
+@contextmanager
+def track_queries(label=''):
+    """Считает запросы внутри блока: with track_queries('chat_list') as stats: ..."""
+    stats = QueryStats(label, parent=_current.get())
+    token = _current.set(stats)
+    try:
+        yield stats
+    finally:
+        _current.reset(token)
+
+
+def check_budget(stats):
+    """
+    Сравнивает число запросов с settings.QUERY_BUDGETS[label].
+    При QUERY_BUDGET_STRICT превышение - исключение, иначе предупреждение в лог.
+    """
+    budget = getattr(settings, 'QUERY_BUDGETS', {}).get(stats.label)
+    if budget is None or stats.count <= budget:
+        return
+    message = (
+        f'{stats.label}: {stats.count} запросов при бюджете {budget} '
+        f'(повторов: {stats.duplicates}, чаще всего: {stats.most_duplicated()})'
+    )
+    if getattr(settings, 'QUERY_BUDGET_STRICT', False):
+        raise QueryBudgetExceeded(message)
+    logger.warning(message)
+
+
+class QueryStatsMiddleware:
+    """
+    Число запросов, время SQL и повторы на каждый HTTP-запрос:
+    структурированный лог, заголовки X-DB-* (QUERY_STATS_HEADERS)
+    и проверка бюджета представления.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        with track_queries() as stats:
+            response = self.get_response(request)
+
+        match = request.resolver_match
+        stats.label = match.view_name if match else request.path
+        # Путь без маршрута в метку не берем: иначе число наборов меток не ограничено
+        metrics.http_db_seconds.labels(match.view_name if match else 'unresolved').observe(stats.time)
+        logger.info('http', extra={'query_stats': stats.as_dict()})
+        if getattr(settings, 'QUERY_STATS_HEADERS', settings.DEBUG):
+            response['X-DB-Queries'] = str(stats.count)
+            response['X-DB-Time-Ms'] = f'{stats.time * 1000:.2f}'
+            response['X-DB-Duplicates'] = str(stats.duplicates)
+        check_budget(stats)
+        return response
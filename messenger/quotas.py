@@ -0,0 +1,97 @@
+"""
+Квоты на медиафайлы: байты и файлы на пользователя и на чат.
+
+Счетчики StorageUsage ведутся по ходу работы (через F, в транзакции
+изменения):
+
+    загрузка        - post_save MediaFile (created);
+    мягкое удаление - MediaFile.soft_delete (место освобождается сразу);
+    удаление строки - post_delete MediaFile, если она не была удалена мягко
+                      (каскад при удалении чата или пользователя); строки,
+                      которые удаляет сборщик мусора, уже списаны.
+
+Проверка перед загрузкой - чтение двух строк, без суммирования по
+MediaFile. Лимиты STORAGE_QUOTA_* (None - без ограничения). Проверка и
+учет не атомарны вместе: параллельные загрузки могут превысить квоту
+на размер одного файла.
+"""
+from django.conf import settings
+from django.db.models import Count, Sum
+
+from .models import ChatRoom, MediaFile, StorageUsage
+
+
+def limits(scope):
+    """(байт, файлов) для области 'user' или 'chat'"""
+    prefix = f'STORAGE_QUOTA_{scope.upper()}'
+    return getattr(settings, f'{prefix}_BYTES', None), getattr(settings, f'{prefix}_FILES', None)
+
+
+def usage(user_id, chat_id):
+    """{область: (байт, файлов)} одним запросом"""
+    rows = StorageUsage.objects.filter(
+        scope='user', object_id=user_id,
+    ) | StorageUsage.objects.filter(
+        scope='chat', object_id=chat_id,
+    )
+    current = {'user': (0, 0), 'chat': (0, 0)}
+    for scope, used_bytes, files in rows.values_list('scope', 'bytes', 'files'):
+        current[scope] = (used_bytes, files)
+    return current
+
+
+def check(user_id, chat_id, size):
+    """None - файл размером size помещается; иначе текст ошибки для клиента"""
+    for scope, (used_bytes, files) in usage(user_id, chat_id).items():
+        max_bytes, max_files = limits(scope)
+        owner = 'вашего хранилища' if scope == 'user' else 'хранилища чата'
+        if max_bytes is not None and used_bytes + size > max_bytes:
+            return f'Превышена квота {owner}: свободно {max(max_bytes - used_bytes, 0)} байт'
+        if max_files is not None and files + 1 > max_files:
+            return f'Превышена квота {owner}: не больше {max_files} файлов'
+    return None
+
+
+def top(scope, limit=20):
+    """Крупнейшие потребители области - по индексу storage_usage_top"""
+    return list(StorageUsage.objects.filter(scope=scope).order_by('-bytes')[:limit])
+
+
+def rebuild():
+    """
+    Пересчет счетчиков по MediaFile (полный агрегат - только для ручного
+    восстановления, например после правок базы в обход модели).
+    """
+    live = MediaFile.objects.filter(is_deleted=False).order_by()
+    StorageUsage.objects.all().delete()
+    created = 0
+    for scope, field in (('user', 'sender_id'), ('chat', 'chat_id')):
+        created += len(StorageUsage.objects.bulk_create(
+            StorageUsage(scope=scope, object_id=row[field], bytes=row['total'] or 0, files=row['count'])
+            for row in live.values(field).annotate(total=Sum('file_size'), count=Count('id')).iterator()
+        ))
+    return created
+
+
+# ==================== СОБЫТИЯ ====================
+
+def media_saved(sender, instance, created, raw=False, **kwargs):
+    if created and not raw and not instance.is_deleted:
+        StorageUsage.charge(instance.sender_id, instance.chat_id, instance.file_size, 1)
+
+
+def media_deleted(sender, instance, **kwargs):
+    if not instance.is_deleted:
+        StorageUsage.charge(instance.sender_id, instance.chat_id, -instance.file_size, -1)
+
+
+def chat_deleted(sender, instance, **kwargs):
+    StorageUsage.objects.filter(scope='chat', object_id=instance.pk).delete()
+
+
+def connect_signals():
+    from django.db.models.signals import post_delete, post_save
+
+    post_save.connect(media_saved, sender=MediaFile, dispatch_uid='quotas.media_saved')
+    post_delete.connect(media_deleted, sender=MediaFile, dispatch_uid='quotas.media_deleted')
+    post_delete.connect(chat_deleted, sender=ChatRoom, dispatch_uid='quotas.chat_deleted')
@@ -0,0 +1,144 @@
+"""
+Ограничение частоты действий (token bucket).
+
+Лимиты задаются в settings.RATE_LIMITS по типу действия и области:
+
+    RATE_LIMITS = {
+        'message': {'user': (2, 20), 'room': (20, 100)},
+        ...
+    }
+
+(rate, burst): rate - токенов в секунду, burst - емкость ведра.
+Хранилище ведер - settings.RATE_LIMIT_BACKEND: в памяти процесса
+или общий кэш Django (для нескольких процессов).
+"""
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+from django.utils.module_loading import import_string
+
+
+class LocalBackend:
+    """Ведра в памяти процесса"""
+
+    def __init__(self, max_keys=100000):
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def consume(self, key, rate, burst, cost=1):
+        """
+        Забирает cost токенов. Возвращает None, если можно,
+        иначе - через сколько секунд хватит токенов.
+        """
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated_at = self._buckets.pop(key, (burst, now))
+            tokens = min(burst, tokens + (now - updated_at) * rate)
+            if tokens >= cost:
+                tokens -= cost
+                retry_after = None
+            else:
+                retry_after = (cost - tokens) / rate
+            self._buckets[key] = (tokens, now)
+            if len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        return retry_after
+
+    def refund(self, key, burst, cost=1):
+        """Возвращает cost токенов, но не больше емкости ведра"""
+        with self._lock:
+            if key in self._buckets:
+                tokens, updated_at = self._buckets[key]
+                self._buckets[key] = (min(burst, tokens + cost), updated_at)
+
+
+class CacheBackend:
+    """
+    Ведра в кэше Django (например, Redis), общие для всех процессов.
+    Чтение и запись не атомарны: при гонке лимит может быть чуть превышен.
+    """
+
+    def __init__(self, alias='default'):
+        self.alias = alias
+
+    def consume(self, key, rate, burst, cost=1):
+        cache = caches[self.alias]
+        now = time.time()
+        tokens, updated_at = cache.get(key, (burst, now))
+        tokens = min(burst, tokens + (now - updated_at) * rate)
+        if tokens >= cost:
+            tokens -= cost
+            retry_after = None
+        else:
+            retry_after = (cost - tokens) / rate
+        # Полное ведро восстанавливается за burst / rate секунд - дольше хранить незачем
+        cache.set(key, (tokens, now), timeout=int(burst / rate) + 1)
+        return retry_after
+
+    def refund(self, key, burst, cost=1):
+        """Возвращает cost токенов, но не больше емкости ведра"""
+        cache = caches[self.alias]
+        value = cache.get(key)
+        if value is not None:
+            tokens, updated_at = value
+            cache.set(key, (min(burst, tokens + cost), updated_at))
+
+
+_backend = None
+
+
+def get_backend():
+    global _backend
+    if _backend is None:
+        backend_path = getattr(settings, 'RATE_LIMIT_BACKEND', 'messenger.ratelimit.LocalBackend')
+        _backend = import_string(backend_path)()
+    return _backend
+
+
+def scopes(action, limits, user_id, chat_id):
+    """[(ключ ведра, (rate, burst))] областей действия, для которых задан лимит"""
+    buckets = []
+    for scope, scope_id in (('user', user_id), ('room', chat_id)):
+        if scope not in limits or scope_id is None:
+            continue
+        buckets.append((f'ratelimit:{action}:{scope}:{scope_id}', limits[scope]))
+    return buckets
+
+
+def check(action, user_id, chat_id=None, cost=1):
+    """
+    Проверяет лимиты действия для пользователя и чата и списывает токены.
+    Возвращает None, если действие разрешено, иначе Retry-After в секундах.
+    """
+    limits = getattr(settings, 'RATE_LIMITS', {}).get(action)
+    if not limits:
+        return None
+
+    backend = get_backend()
+    consumed = []
+    for key, (rate, burst) in scopes(action, limits, user_id, chat_id):
+        retry_after = backend.consume(key, rate, burst, cost)
+        if retry_after is not None:
+            # Не наказываем другие области за отклоненное действие
+            for consumed_key, consumed_burst in consumed:
+                backend.refund(consumed_key, consumed_burst, cost)
+            return retry_after
+        consumed.append((key, burst))
+    return None
+
+
+def refund(action, user_id, chat_id=None, cost=1):
+    """
+    Возвращает токены, списанные check() с теми же аргументами:
+    действие все-таки отклонено по другому лимиту.
+    """
+    limits = getattr(settings, 'RATE_LIMITS', {}).get(action)
+    if not limits:
+        return
+    backend = get_backend()
+    for key, (_, burst) in scopes(action, limits, user_id, chat_id):
+        backend.refund(key, burst, cost)
@@ -0,0 +1,113 @@
+"""
+Кольцевые буферы последних событий чатов для восстановления после переподключения.
+
+Каждое сохраненное сообщение и каждая его правка или удаление получают
+порядковый номер в чате (Message.seq, ChangeLog.seq).
+Клиент при переподключении передает last_seq, и ему досылается только
+пропущенное: сначала из буфера в памяти, остальное - из базы. Номера
+могут прийти не по порядку, поэтому повторы определяет SeqWindow, а не
+сравнение с наибольшим полученным номером.
+"""
+from bisect import bisect_right, insort
+from collections import OrderedDict
+
+from django.conf import settings
+
+
+class SeqWindow:
+    """
+    Полученные номера одного чата: last_seq - все номера до него включительно
+    уже были, ahead - полученные сверх него. Номера выдаются по порядку, но
+    group_send конкурентных отправителей может доставить N+1 раньше N:
+    такое N - не повтор, и его нельзя отбрасывать по максимуму.
+    """
+
+    def __init__(self, last_seq=None):
+        self.last_seq = last_seq
+        self.ahead = set()
+
+    def add(self, seq):
+        """True - номер новый, False - повтор"""
+        if self.last_seq is None:
+            self.last_seq = seq
+            return True
+        if seq <= self.last_seq or seq in self.ahead:
+            return False
+        self.ahead.add(seq)
+        self.advance()
+        return True
+
+    def advance(self):
+        while self.last_seq + 1 in self.ahead:
+            self.last_seq += 1
+            self.ahead.remove(self.last_seq)
+
+    @property
+    def has_gap(self):
+        return bool(self.ahead)
+
+    def settle(self, until):
+        """Пропуски до until включительно окончательные (номер занят удаленной строкой)"""
+        if self.last_seq is None or until <= self.last_seq:
+            return
+        self.ahead = {seq for seq in self.ahead if seq > until}
+        self.last_seq = until
+        self.advance()
+
+
+class ReplayBuffer:
+    """Последние события одного чата по seq; опоздавшее событие встает на свое место"""
+
+    def __init__(self, size):
+        self.size = size
+        self.seqs = []
+        self.events = {}
+
+    @property
+    def first_seq(self):
+        return self.seqs[0] if self.seqs else None
+
+    @property
+    def last_seq(self):
+        return self.seqs[-1] if self.seqs else None
+
+    def append(self, event):
+        seq = event['seq']
+        if seq in self.events:
+            return  # уже есть (событие пришло нескольким соединениям)
+        if len(self.seqs) >= self.size and seq < self.seqs[0]:
+            return  # старше всего буфера
+        insort(self.seqs, seq)
+        self.events[seq] = event
+        if len(self.seqs) > self.size:
+            del self.events[self.seqs.pop(0)]
+
+    def since(self, last_seq):
+        """
+        События last_seq + 1, last_seq + 2, ... до первого пропуска в буфере
+        (остальное - из базы). None - буфер начинается позже last_seq + 1.
+        """
+        if not self.seqs or self.first_seq > last_seq + 1:
+            return None
+        events = []
+        for seq in self.seqs[bisect_right(self.seqs, last_seq):]:
+            if seq != last_seq + len(events) + 1:
+                break
+            events.append(self.events[seq])
+        return events
+
+
+_buffers = OrderedDict()
+
+
+def get_buffer(chat_id):
+    """Буфер чата; самые давно не используемые буферы вытесняются"""
+    buffer = _buffers.get(chat_id)
+    if buffer is None:
+        buffer = ReplayBuffer(getattr(settings, 'CHAT_REPLAY_BUFFER_SIZE', 200))
+        _buffers[chat_id] = buffer
+        if len(_buffers) > getattr(settings, 'CHAT_REPLAY_MAX_ROOMS', 1000):
+            _buffers.popitem(last=False)
+    else:
+        _buffers.move_to_end(chat_id)
+    return buffer
@@ -3,4 +3,5 @@ from . import consumers
 
 websocket_urlpatterns = [
     path('ws/chat/<int:chat_id>/', consumers.ChatConsumer.as_asgi()),
+    path('ws/chats/', consumers.MultiplexChatConsumer.as_asgi()),
 ]
\ No newline at end of file
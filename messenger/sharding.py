@@ -0,0 +1,124 @@
+"""
+Шардирование чатов по рабочим процессам (по желанию).
+
+Карта шардов - {имя: адрес WebSocket процесса} из CHAT_SHARDS или из
+JSON-файла CHAT_SHARD_MAP_FILE (его можно менять на ходу: добавили или
+убрали процесс). Владелец чата выбирается согласованным хэшированием
+(HashRing, CHAT_SHARD_VNODES виртуальных узлов на шард): при изменении
+карты переезжает около 1/N чатов.
+
+Процесс CHAT_SHARD_NAME принимает соединения только своих чатов:
+соединению чужого чата отправляется wrong_shard с адресом владельца и
+оно закрывается с кодом 4009. Так же закрываются соединения чатов,
+переехавших при изменении карты. Клиент переподключается к новому
+владельцу с last_seq, и пропущенное досылается из базы (номера выдает
+БД, а не процесс), поэтому сообщения при перебалансировке не теряются.
+
+Поиск владельца без WebSocket: GET /chat/<id>/shard/.
+Распределение и переезды: manage.py shard_map.
+"""
+import bisect
+import hashlib
+import json
+import logging
+import os
+import time
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# Код закрытия WebSocket: чат принадлежит другому шарду
+WRONG_SHARD_CLOSE_CODE = 4009
+
+
+def _hash(value):
+    return int.from_bytes(hashlib.blake2b(value.encode(), digest_size=8).digest(), 'big')
+
+
+class HashRing:
+    """Кольцо согласованного хэширования с виртуальными узлами"""
+
+    def __init__(self, nodes, vnodes=128):
+        self.nodes = sorted(nodes)
+        points = sorted(
+            (_hash(f'{node}#{replica}'), node)
+            for node in self.nodes
+            for replica in range(vnodes)
+        )
+        self._hashes = [point for point, _ in points]
+        self._owners = [node for _, node in points]
+
+    def node_for(self, key):
+        if not self._hashes:
+            return None
+        index = bisect.bisect(self._hashes, _hash(str(key))) % len(self._hashes)
+        return self._owners[index]
+
+
+_map_cache = {'checked': 0.0, 'mtime': None, 'shards': {}}
+_ring_cache = {}
+
+
+def shard_map():
+    """{имя шарда: адрес WebSocket}; файл карты перечитывается при изменении"""
+    path = getattr(settings, 'CHAT_SHARD_MAP_FILE', '')
+    if not path:
+        return getattr(settings, 'CHAT_SHARDS', {})
+
+    now = time.monotonic()
+    if now - _map_cache['checked'] >= getattr(settings, 'CHAT_SHARD_MAP_CHECK_INTERVAL', 1.0):
+        _map_cache['checked'] = now
+        try:
+            mtime = os.stat(path).st_mtime
+            if mtime != _map_cache['mtime']:
+                with open(path, encoding='utf-8') as source:
+                    _map_cache['shards'] = json.load(source)
+                _map_cache['mtime'] = mtime
+                logger.info('Карта шардов: %s', ', '.join(sorted(_map_cache['shards'])))
+        except (OSError, ValueError):
+            # Битый или пропавший файл - работаем по последней прочитанной карте
+            logger.exception('Не удалось прочитать карту шардов %s', path)
+    return _map_cache['shards']
+
+
+def ring(shards=None):
+    shards = shard_map() if shards is None else shards
+    key = tuple(sorted(shards))
+    if key not in _ring_cache:
+        _ring_cache.clear()
+        _ring_cache[key] = HashRing(key, getattr(settings, 'CHAT_SHARD_VNODES', 128))
+    return _ring_cache[key]
+
+
+def local_shard():
+    return getattr(settings, 'CHAT_SHARD_NAME', '')
+
+
+def enabled():
+    return bool(local_shard() and shard_map())
+
+
+def owner(chat_id):
+    """Имя шарда-владельца чата; None, если шардирование выключено"""
+    if not enabled():
+        return None
+    return ring().node_for(chat_id)
+
+
+def is_local(chat_id):
+    """Чат обслуживается этим процессом (без шардирования - всегда)"""
+    shard = owner(chat_id)
+    return shard is None or shard == local_shard()
+
+
+def chat_url(chat_id, shard=None):
+    """Адрес WebSocket чата на шарде-владельце"""
+    shard = shard or owner(chat_id)
+    base = shard_map().get(shard, '').rstrip('/')
+    return f'{base}/ws/chat/{chat_id}/'
+
+
+def redirect_event(chat_id):
+    shard = owner(chat_id)
+    return {'type': 'wrong_shard', 'chat_id': chat_id, 'shard': shard, 'url': chat_url(chat_id, shard)}
@@ -0,0 +1,139 @@
+"""
+Статика: имена с хэшем содержимого, заранее сжатые копии и долгий кэш.
+
+CompressedManifestStaticFilesStorage (STORAGES['staticfiles']) при
+collectstatic пишет файлы с хэшем в имени (chat.3f2a9c.js, манифест
+staticfiles.json) и рядом - .gz и, если установлен brotli (необязательная
+зависимость), .br для текстовых файлов, если сжатие того стоит.
+
+serve() отдает STATIC_ROOT без nginx: выбирает сжатую копию по
+Accept-Encoding, файлам с хэшем ставит Cache-Control на
+STATIC_CACHE_MAX_AGE с immutable (новое содержимое - новое имя), остальные
+браузер перепроверяет (no-cache + Last-Modified). За nginx то же самое
+дают gzip_static/brotli_static и expires max для имен из манифеста;
+тогда STATIC_SERVE = False.
+"""
+import gzip
+import mimetypes
+import os
+import posixpath
+from functools import lru_cache
+
+from django.conf import settings
+from django.contrib.staticfiles.storage import ManifestStaticFilesStorage, staticfiles_storage
+from django.core.exceptions import SuspiciousFileOperation
+from django.core.files.base import ContentFile
+from django.http import FileResponse, Http404, HttpResponseNotModified
+from django.utils._os import safe_join
+from django.utils.cache import patch_vary_headers
+from django.utils.http import http_date
+from django.views.static import was_modified_since
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESSIBLE_EXTENSIONS = ('.css', '.js', '.mjs', '.json', '.map', '.svg', '.txt', '.html', '.xml')
+# Сжатая копия сохраняется, только если она меньше оригинала хотя бы на 5%
+MIN_COMPRESSION_RATIO = 0.95
+
+
+def compressors():
+    """[(Content-Encoding, суффикс, функция сжатия)] в порядке предпочтения"""
+    available = []
+    if brotli is not None:
+        available.append(('br', '.br', lambda data: brotli.compress(data, quality=11)))
+    # mtime=0 - одинаковый .gz при одинаковом содержимом
+    available.append(('gzip', '.gz', lambda data: gzip.compress(data, compresslevel=9, mtime=0)))
+    return available
+
+
+class CompressedManifestStaticFilesStorage(ManifestStaticFilesStorage):
+    """Манифест с хэшами плюс .gz/.br рядом с текстовыми файлами"""
+
+    def post_process(self, paths, dry_run=False, **options):
+        processed_names = set()
+        for name, hashed_name, processed in super().post_process(paths, dry_run, **options):
+            if not isinstance(processed, Exception):
+                processed_names.add(hashed_name or name)
+            yield name, hashed_name, processed
+        if dry_run:
+            return
+
+        # Исходные имена нужны в DEBUG, когда {% static %} дает их без хэша
+        for name in sorted(processed_names | set(paths)):
+            if not name.endswith(COMPRESSIBLE_EXTENSIONS):
+                continue
+            with self.open(name) as source:
+                data = source.read()
+            for _, suffix, compress in compressors():
+                compressed = compress(data)
+                if len(compressed) > len(data) * MIN_COMPRESSION_RATIO:
+                    continue
+                if self.exists(name + suffix):
+                    self.delete(name + suffix)
+                self._save(name + suffix, ContentFile(compressed))
+                yield name, name + suffix, True
+
+
+@lru_cache(maxsize=None)
+def hashed_names():
+    """Имена файлов с хэшем из манифеста (пусто без ManifestStaticFilesStorage)"""
+    return frozenset(getattr(staticfiles_storage, 'hashed_files', {}).values())
+
+
+def cache_max_age():
+    return getattr(settings, 'STATIC_CACHE_MAX_AGE', 365 * 24 * 3600)
+
+
+def accepted_encodings(header):
+    """Кодировки из Accept-Encoding, кроме явно запрещенных (q=0)"""
+    accepted = set()
+    for item in header.split(','):
+        token, _, params = item.strip().partition(';')
+        quality = params.strip()
+        if quality.startswith('q='):
+            try:
+                if float(quality[2:]) == 0:
+                    continue
+            except ValueError:
+                continue
+        if token:
+            accepted.add(token.strip().lower())
+    return accepted
+
+
+def serve(request, path):
+    """Файл из STATIC_ROOT: сжатая копия по Accept-Encoding и заголовки кэширования"""
+    name = posixpath.normpath(path).lstrip('/')
+    try:
+        full_path = safe_join(settings.STATIC_ROOT, name)
+    except SuspiciousFileOperation:
+        raise Http404
+    if not os.path.isfile(full_path):
+        raise Http404
+
+    content_type, _ = mimetypes.guess_type(full_path)
+    chosen, encoding = full_path, None
+    accepted = accepted_encodings(request.headers.get('Accept-Encoding', ''))
+    for candidate, suffix, _ in compressors():
+        if candidate in accepted and os.path.isfile(full_path + suffix):
+            chosen, encoding = full_path + suffix, candidate
+            break
+
+    stat = os.stat(chosen)
+    if not was_modified_since(request.headers.get('If-Modified-Since'), stat.st_mtime):
+        response = HttpResponseNotModified()
+    else:
+        response = FileResponse(open(chosen, 'rb'), content_type=content_type or 'application/octet-stream')
+        response['Last-Modified'] = http_date(stat.st_mtime)
+        if encoding:
+            response['Content-Encoding'] = encoding
+
+    if name in hashed_names():
+        response['Cache-Control'] = f'public, max-age={cache_max_age()}, immutable'
+    else:
+        response['Cache-Control'] = 'no-cache'
+    patch_vary_headers(response, ('Accept-Encoding',))
+    return response
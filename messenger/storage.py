@@ -0,0 +1,81 @@
+"""
+Хранилище медиафайлов: локальный диск или S3-совместимое хранилище.
+
+Бэкенд выбирается в STORAGES['default'] (MEDIA_STORAGE=s3 в окружении -
+storages.backends.s3.S3Storage из django-storages, необязательная
+зависимость вместе с boto3; AWS_S3_ENDPOINT_URL указывает на MinIO или
+другой локальный сервер для разработки и тестов).
+
+С объектным хранилищем байты не идут через Django:
+
+    presigned_upload()  - подписанная форма для загрузки прямо в бакет,
+                          клиент потом подтверждает метаданные;
+    signed_url()        - короткоживущая ссылка на скачивание: права
+                          проверяет представление, отдает бакет.
+
+На локальном диске прямой загрузки нет, а скачивание можно отдать nginx
+через X-Accel-Redirect (MEDIA_ACCEL_REDIRECT_PREFIX).
+"""
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.utils.http import content_disposition_header
+
+
+def signed_url_seconds():
+    return getattr(settings, 'MEDIA_SIGNED_URL_SECONDS', 300)
+
+
+def presigned_upload_seconds():
+    return getattr(settings, 'MEDIA_PRESIGNED_UPLOAD_SECONDS', 600)
+
+
+def is_object_store(storage=None):
+    """Хранилище - бакет S3 (django-storages)"""
+    storage = storage or default_storage
+    return hasattr(storage, 'bucket_name') and hasattr(storage, 'connection')
+
+
+def object_key(storage, name):
+    """Ключ объекта в бакете с учетом AWS_LOCATION"""
+    return storage._normalize_name(name)
+
+
+def signed_url(field_file, file_name, mime_type, inline=False):
+    """Подписанная ссылка на файл на MEDIA_SIGNED_URL_SECONDS; None - хранилище не умеет"""
+    storage = field_file.storage
+    if not is_object_store(storage):
+        return None
+    return storage.url(field_file.name, expire=signed_url_seconds(), parameters={
+        'ResponseContentDisposition': content_disposition_header(not inline, file_name),
+        'ResponseContentType': mime_type,
+    })
+
+
+def accel_redirect(field_file):
+    """Внутренний путь для X-Accel-Redirect; None - отдает сам Django"""
+    prefix = getattr(settings, 'MEDIA_ACCEL_REDIRECT_PREFIX', '')
+    if not prefix or is_object_store(field_file.storage):
+        return None
+    return f"{prefix.rstrip('/')}/{field_file.name}"
+
+
+def presigned_upload(name, content_type, size):
+    """
+    Форма для загрузки одного объекта прямо в бакет: {'url', 'fields'}.
+    Бакет примет только объект ровно size байт с этим Content-Type.
+    None - хранилище не поддерживает прямую загрузку.
+    """
+    storage = default_storage
+    if not is_object_store(storage):
+        return None
+    client = storage.connection.meta.client
+    return client.generate_presigned_post(
+        Bucket=storage.bucket_name,
+        Key=object_key(storage, name),
+        Fields={'Content-Type': content_type},
+        Conditions=[
+            {'Content-Type': content_type},
+            ['content-length-range', size, size],
+        ],
+        ExpiresIn=presigned_upload_seconds(),
+    )
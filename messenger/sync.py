@@ -0,0 +1,240 @@
+"""
+Дельта-синхронизация для офлайн- и мобильных клиентов.
+
+Клиент хранит непрозрачный токен и запрашивает GET /sync/?token=...:
+в ответ - изменения во всех его чатах после токена и новый токен.
+Без токена возвращается только токен текущей позиции (после полной
+загрузки чатов клиент синхронизируется от него).
+
+Изменения берутся из ChangeLog (только добавление, индекс scope+id):
+записи областей чатов пользователя и его собственной области. Для
+сообщений отдается текущее состояние, повторы одного сообщения в
+странице схлопываются. Страница ограничена SYNC_PAGE_SIZE записями и
+SYNC_MAX_BYTES байтами JSON; has_more - есть продолжение.
+
+Номер записи (id) выдается при вставке, а коммит приходит позже: запись
+с меньшим id может стать видимой после записи с большим, уже отданной
+клиенту. Поэтому курсор - не только номер: каждый запрос заново
+просматривает записи не старше SYNC_RESCAN_SECONDS с id не больше номера,
+а токен хранит id уже отданных из этого окна (recent). Поздний коммит
+отдается следующим запросом. Теряется только запись транзакции, открытой
+дольше SYNC_RESCAN_SECONDS: к ее коммиту запись уже вне окна.
+
+Токен подписан и действует SYNC_LOG_RETENTION_DAYS: журнал хранится
+столько же, поэтому просроченный токен означает полную перезагрузку.
+"""
+import json
+from datetime import timedelta
+
+from django.conf import settings
+from django.core import signing
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils import timezone
+
+from .events import message_event
+from .models import ChangeLog, ChatRoom, Message
+
+TOKEN_SALT = 'messenger.sync'
+
+
+def retention():
+    return timedelta(days=getattr(settings, 'SYNC_LOG_RETENTION_DAYS', 30))
+
+
+def rescan_since():
+    """Записи, созданные позже, просматриваются заново: их транзакция могла еще не закоммититься"""
+    return timezone.now() - timedelta(seconds=getattr(settings, 'SYNC_RESCAN_SECONDS', 60))
+
+
+def make_token(user_id, seq, recent=()):
+    return signing.dumps({'user': user_id, 'seq': seq, 'recent': sorted(recent)}, salt=TOKEN_SALT, compress=True)
+
+
+def read_token(token, user_id):
+    """
+    (номер, отданные id окна) из токена; SignatureExpired - журнал мог быть
+    очищен, BadSignature - чужой или испорченный
+    """
+    data = signing.loads(token, salt=TOKEN_SALT, max_age=retention())
+    if data.get('user') != user_id:
+        raise signing.BadSignature('Токен выдан другому пользователю')
+    return int(data['seq']), [int(entry_id) for entry_id in data.get('recent', ())]
+
+
+def user_scopes(user):
+    chat_ids = ChatRoom.objects.filter(participants=user).values_list('id', flat=True)
+    return [ChangeLog.user_scope(user.id)] + [ChangeLog.chat_scope(chat_id) for chat_id in chat_ids]
+
+
+def window_ids(scopes, seq):
+    """id записей областей scopes не больше seq, которые еще просматриваются заново"""
+    return set(ChangeLog.objects.filter(
+        scope__in=scopes,
+        id__lte=seq,
+        created_at__gte=rescan_since(),
+    ).values_list('id', flat=True))
+
+
+def current_position(user):
+    """(номер, id окна) конца журнала: клиент только что загрузил всё, что уже видно"""
+    seq = ChangeLog.objects.order_by('-id').values_list('id', flat=True).first() or 0
+    return seq, window_ids(user_scopes(user), seq)
+
+
+def scope_chat_id(scope):
+    kind, _, value = scope.partition(':')
+    return int(value) if kind == 'chat' else None
+
+
+def render_change(entry, messages):
+    """Изменение для клиента; None - объект уже удален"""
+    change = {'seq': entry.id, 'kind': entry.kind}
+    chat_id = scope_chat_id(entry.scope)
+    if chat_id is not None:
+        change['chat_id'] = chat_id
+
+    if entry.kind in ('message', 'edit'):
+        message = messages.get(entry.object_id)
+        if message is None:
+            return None
+        change['message'] = message_event(message)
+        change['message']['is_edited'] = message.is_edited
+        change['message']['edited_at'] = message.edited_at
+    elif entry.kind == 'media_deleted':
+        change['media_id'] = entry.object_id
+    elif entry.kind == 'delete':
+        change['message_id'] = entry.object_id
+        change.update(entry.data)
+    else:
+        change.update(entry.data)
+    return change
+
+
+def changes_since(user, seq, recent=(), limit=None, max_bytes=None):
+    """
+    (изменения, номер и id окна для следующего токена, есть ли еще).
+    Сначала поздние записи окна (id не больше seq, еще не отданы), затем новые.
+    """
+    limit = limit or getattr(settings, 'SYNC_PAGE_SIZE', 200)
+    max_bytes = max_bytes or getattr(settings, 'SYNC_MAX_BYTES', 256 * 1024)
+    since = rescan_since()
+
+    scopes = user_scopes(user)
+    window = window_ids(scopes, seq)
+    # Отданные записи, вышедшие из окна, больше не нужны
+    recent = window & set(recent)
+    late = list(ChangeLog.objects.filter(id__in=window - recent).order_by('id'))
+    entries = list(ChangeLog.objects.filter(
+        scope__in=scopes,
+        id__gt=seq,
+    ).order_by('id')[:limit + 1])
+    has_more = len(entries) > limit
+    entries = late + entries[:limit]
+
+    message_ids = {entry.object_id for entry in entries if entry.kind in ('message', 'edit')}
+    messages = Message.objects.select_related('sender', 'media_file').in_bulk(message_ids)
+
+    changes = []
+    size = 0
+    sent_messages = set()
+    for entry in entries:
+        # Отдается текущее состояние: второй раз то же сообщение не нужно
+        repeated = entry.kind in ('message', 'edit') and entry.object_id in sent_messages
+        if not repeated:
+            if entry.kind in ('message', 'edit'):
+                sent_messages.add(entry.object_id)
+            change = render_change(entry, messages)
+            if change is not None:
+                encoded = len(json.dumps(change, cls=DjangoJSONEncoder, ensure_ascii=False).encode())
+                if changes and size + encoded > max_bytes:
+                    has_more = True
+                    break
+                size += encoded
+                changes.append(change)
+        seq = max(seq, entry.id)
+        if entry.created_at >= since:
+            recent.add(entry.id)
+    return changes, seq, recent, has_more
+
+
+def prune():
+    """Удаляет записи старше SYNC_LOG_RETENTION_DAYS (токены такого возраста уже не действуют)"""
+    deleted, _ = ChangeLog.objects.filter(created_at__lt=timezone.now() - retention()).delete()
+    return deleted
+
+
+# ==================== СОБЫТИЯ ====================
+
+def membership_entries(pairs, action):
+    """Записи об изменении участников: в области чата и в области пользователя"""
+    entries = []
+    for chat_id, user_id in pairs:
+        data = {'chat_id': chat_id, 'user_id': user_id, 'action': action}
+        entries.append(ChangeLog(scope=ChangeLog.chat_scope(chat_id), kind='membership', object_id=chat_id, data=data))
+        entries.append(ChangeLog(scope=ChangeLog.user_scope(user_id), kind='membership', object_id=chat_id, data=data))
+    return entries
+
+
+def participants_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if action == 'pre_clear':
+        # После очистки список уже не узнать
+        if reverse:
+            instance._sync_cleared = list(instance.chatrooms.values_list('id', flat=True))
+        else:
+            instance._sync_cleared = list(instance.participants.values_list('id', flat=True))
+        return
+    if action == 'post_clear':
+        pk_set = getattr(instance, '_sync_cleared', ())
+        action = 'post_remove'
+    if action not in ('post_add', 'post_remove'):
+        return
+
+    if reverse:
+        pairs = [(chat_id, instance.pk) for chat_id in pk_set]
+    else:
+        pairs = [(instance.pk, user_id) for user_id in pk_set]
+    ChangeLog.objects.bulk_create(membership_entries(pairs, 'added' if action == 'post_add' else 'removed'))
+
+
+def read_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if action != 'post_add' or not pk_set:
+        return
+    if reverse:
+        # Пользователь прочитал несколько сообщений: по записи на чат
+        by_chat = {}
+        for message_id, chat_id in Message.objects.filter(pk__in=pk_set).values_list('id', 'chat_id'):
+            by_chat.setdefault(chat_id, []).append(message_id)
+        entries = [
+            ChangeLog(
+                scope=ChangeLog.chat_scope(chat_id),
+                kind='read',
+                data={'user_id': instance.pk, 'message_ids': sorted(message_ids)},
+            )
+            for chat_id, message_ids in by_chat.items()
+        ]
+    else:
+        entries = [
+            ChangeLog(
+                scope=ChangeLog.chat_scope(instance.chat_id),
+                kind='read',
+                object_id=instance.pk,
+                data={'user_id': user_id, 'message_ids': [instance.pk]},
+            )
+            for user_id in pk_set
+        ]
+    ChangeLog.objects.bulk_create(entries)
+
+
+def connect_signals():
+    from django.db.models.signals import m2m_changed
+
+    m2m_changed.connect(
+        participants_changed,
+        sender=ChatRoom.participants.through,
+        dispatch_uid='sync.participants_changed',
+    )
+    m2m_changed.connect(
+        read_changed,
+        sender=Message.read_by.through,
+        dispatch_uid='sync.read_changed',
+    )
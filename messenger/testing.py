@@ -0,0 +1,53 @@
+"""
+Помощники для тестов: бюджеты запросов к БД.
+
+    class ChatListTests(QueryBudgetMixin, TestCase):
+        def test_chat_list(self):
+            with self.assertQueryBudget('chat_list'):
+                self.client.get(reverse('chat_list'))
+
+События WebSocket считаются в задаче консьюмера, поэтому для них
+assertEventQueryBudget берет число запросов из лога messenger.queries:
+
+        with self.assertEventQueryBudget('ws:chat_message'):
+            await communicator.send_json_to({'type': 'chat_message', ...})
+            await communicator.receive_json_from()
+
+Бюджет берется из settings.QUERY_BUDGETS или передается явно.
+"""
+from contextlib import contextmanager
+
+from django.conf import settings
+
+from .querystats import logger, track_queries
+
+
+class QueryBudgetMixin:
+
+    @contextmanager
+    def assertQueryBudget(self, label, budget=None):
+        if budget is None:
+            budget = settings.QUERY_BUDGETS[label]
+        with track_queries(label) as stats:
+            yield stats
+        if stats.count > budget:
+            details = '\n'.join(f'  {count}x {sql}' for sql, count in stats.most_duplicated(10))
+            self.fail(
+                f'{label}: {stats.count} запросов при бюджете {budget}, '
+                f'повторов {stats.duplicates}\n{details}'
+            )
+
+    @contextmanager
+    def assertEventQueryBudget(self, label, budget=None):
+        if budget is None:
+            budget = settings.QUERY_BUDGETS[label]
+        with self.assertLogs(logger, 'INFO') as logs:
+            yield
+        counted = [
+            record.query_stats['queries'] for record in logs.records
+            if getattr(record, 'query_stats', {}).get('label') == label
+        ]
+        if not counted:
+            self.fail(f'{label}: событие не обработано')
+        if max(counted) > budget:
+            self.fail(f'{label}: {max(counted)} запросов при бюджете {budget}')
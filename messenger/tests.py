@@ -1,3 +1,1422 @@
-from django.test import TestCase
+import asyncio
+import base64
+import io
+import json
+import logging
+import os
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zipfile
+import zlib
+from datetime import timedelta
+from unittest import mock, skipUnless
 
-# Create your tests here.
+from asgiref.sync import async_to_sync
+from channels.layers import InMemoryChannelLayer, get_channel_layer
+from channels.routing import URLRouter
+from channels.db import database_sync_to_async
+from channels.testing import ChannelsLiveServerTestCase, WebsocketCommunicator
+from django.core import signing
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import IntegrityError, connection, transaction
+from django.test import AsyncClient, Client, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from accounts.models import CustomUser
+
+from . import broadcast, idempotency, media_gc, metrics, outbox, placeholders, profiling, protocol, quotas, ratelimit, replay, sharding, sync
+from .consumers import ChatConsumer
+from .events import message_event
+from .models import ChangeLog, ChatRoom, MediaFile, Message, StorageUsage, broadcast_group_name
+from .routing import websocket_urlpatterns
+from .testing import QueryBudgetMixin
+from .views import check_upload_rate
+
+# Объектное хранилище проверяется на локальном сервере moto
+# (необязательные зависимости, как и django-storages с boto3)
+try:
+    import boto3
+    import requests
+    import storages.backends.s3  # noqa: F401
+    from moto.server import ThreadedMotoServer
+except ImportError:
+    ThreadedMotoServer = None
+
+TEST_SETTINGS = {
+    'RATE_LIMITS': {},
+    'CHANNEL_LAYERS': {'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}},
+    # Без collectstatic: манифеста с хэшами в тестах нет
+    'STORAGES': {
+        'default': {'BACKEND': 'django.core.files.storage.FileSystemStorage'},
+        'staticfiles': {'BACKEND': 'django.contrib.staticfiles.storage.StaticFilesStorage'},
+    },
+}
+
+
+class WebsocketTestCase(TransactionTestCase):
+    """Консьюмеры работают с БД из других потоков, поэтому TransactionTestCase"""
+
+    def setUp(self):
+        replay._buffers.clear()
+        idempotency.recent_ids.clear()
+        self.alice = CustomUser.objects.create_user('alice', password='x')
+        self.bob = CustomUser.objects.create_user('bob', password='x')
+        self.chat = ChatRoom.objects.create()
+        self.chat.participants.add(self.alice, self.bob)
+
+    async def connect(self, user, path=None):
+        communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), path or f'/ws/chat/{self.chat.id}/')
+        communicator.scope['user'] = user
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator
+
+
+@override_settings(**TEST_SETTINGS)
+class ReplayPatchTests(WebsocketTestCase):
+    """Правки и удаления досылаются при переподключении с last_seq"""
+
+    def test_edit_is_replayed_after_reconnect(self):
+        async_to_sync(self.edit_and_reconnect)()
+
+    async def edit_and_reconnect(self):
+        socket = await self.connect(self.alice)
+        await socket.send_json_to({'type': 'chat_message', 'message': 'hello'})
+        message = await socket.receive_json_from()
+        await socket.send_json_to({'type': 'edit_message', 'message_id': message['message_id'], 'message': 'hello2'})
+        patch = await socket.receive_json_from()
+        self.assertEqual(patch['type'], 'message_patch')
+        self.assertEqual(patch['seq'], message['seq'] + 1)
+        await socket.disconnect()
+
+        # Из буфера процесса и (после его очистки) из базы
+        for clear_buffer in (False, True):
+            if clear_buffer:
+                replay._buffers.clear()
+            socket = await self.connect(self.alice, f"/ws/chat/{self.chat.id}/?last_seq={message['seq']}")
+            replayed = await socket.receive_json_from()
+            self.assertEqual(replayed['type'], 'message_patch')
+            self.assertEqual(replayed['content'], 'hello2')
+            self.assertTrue(await socket.receive_nothing())
+            await socket.disconnect()
+
+    def test_unsend_is_replayed_from_database(self):
+        async_to_sync(self.unsend_and_reconnect)()
+
+    async def unsend_and_reconnect(self):
+        socket = await self.connect(self.alice)
+        await socket.send_json_to({'type': 'chat_message', 'message': 'oops'})
+        message = await socket.receive_json_from()
+        await socket.send_json_to({'type': 'unsend_message', 'message_id': message['message_id']})
+        await socket.receive_json_from()
+        await socket.disconnect()
+
+        replay._buffers.clear()
+        socket = await self.connect(self.bob, '/ws/chat/%d/?last_seq=0' % self.chat.id)
+        replayed = await socket.receive_json_from()
+        self.assertEqual(replayed, {
+            'type': 'message_patch',
+            'chat_id': self.chat.id,
+            'message_id': message['message_id'],
+            'seq': message['seq'] + 1,
+            'unsent': True,
+        })
+        await socket.disconnect()
+
+
+def chat_event(chat, sender, seq, message_id=None):
+    """Событие chat_message группы чата с номером seq"""
+    return {
+        'type': 'chat_message',
+        'chat_id': chat.id,
+        'message': f'сообщение {seq}',
+        'sender_id': sender.id,
+        'sender_username': sender.username,
+        'timestamp': '2026-01-01T00:00:00+00:00',
+        'message_id': message_id or seq,
+        'seq': seq,
+    }
+
+
+@override_settings(CHAT_SEQ_GAP_TIMEOUT=0.1, **TEST_SETTINGS)
+class OutOfOrderDeliveryTests(WebsocketTestCase):
+    """Конкурентные отправители: seq N может прийти в группу после N+1"""
+
+    def test_late_event_is_delivered_and_buffered(self):
+        async_to_sync(self.send_out_of_order)()
+
+    async def send_out_of_order(self):
+        socket = await self.connect(self.alice)
+        layer = get_channel_layer()
+        group = f'chat_{self.chat.id}'
+        await layer.group_send(group, chat_event(self.chat, self.bob, 2))
+        await layer.group_send(group, chat_event(self.chat, self.bob, 1))
+        await layer.group_send(group, chat_event(self.chat, self.bob, 2))
+        received = [(await socket.receive_json_from())['seq'] for _ in range(2)]
+        self.assertEqual(received, [2, 1])
+        self.assertTrue(await socket.receive_nothing(0.3))
+        await socket.disconnect()
+
+        # Буфер тоже принял опоздавшее событие: переподключение досылает оба
+        self.assertEqual([event['seq'] for event in replay.get_buffer(self.chat.id).since(0)], [1, 2])
+
+    def test_missing_event_is_fetched_from_database(self):
+        async_to_sync(self.fill_gap)()
+
+    async def fill_gap(self):
+        socket = await self.connect(self.alice)
+        first = await database_sync_to_async(Message.objects.create)(chat=self.chat, sender=self.bob, content='первое')
+        # Событие первого сообщения потерялось, второе пришло
+        await get_channel_layer().group_send(f'chat_{self.chat.id}', chat_event(self.chat, self.bob, first.seq + 1))
+        self.assertEqual((await socket.receive_json_from())['seq'], first.seq + 1)
+        fetched = await socket.receive_json_from(1)
+        self.assertEqual((fetched['seq'], fetched['message']), (first.seq, 'первое'))
+        await socket.disconnect()
+
+
+class BrokenLayer:
+    """Слой каналов, который недоступен"""
+
+    async def group_send(self, group, message):
+        raise ConnectionError('слой недоступен')
+
+
+@override_settings(OUTBOX_RELAY_DELAY=0, OUTBOX_MAX_ATTEMPTS=2, CHAT_SEQ_GAP_TIMEOUT=60, **TEST_SETTINGS)
+class OutboxRelayTests(WebsocketTestCase):
+    """Событие, не опубликованное после коммита, relay() доставляет подключенному клиенту"""
+
+    def save_message(self, content, broken=False):
+        with mock.patch.object(outbox, 'get_channel_layer', BrokenLayer if broken else get_channel_layer):
+            with transaction.atomic():
+                message = Message.objects.create(chat=self.chat, sender=self.bob, content=content)
+                outbox.enqueue(self.chat.group_name, message_event(message), key=outbox.message_key(message.id))
+        return message
+
+    def test_relayed_event_reaches_client(self):
+        async_to_sync(self.relay_late_event)()
+
+    async def relay_late_event(self):
+        socket = await self.connect(self.alice)
+        with self.assertLogs('messenger.outbox', 'ERROR'):
+            lost = await database_sync_to_async(self.save_message)('потерянное', broken=True)
+        await database_sync_to_async(self.save_message)('следующее')
+        self.assertEqual((await socket.receive_json_from())['seq'], lost.seq + 1)
+        self.assertFalse(await database_sync_to_async(outbox.is_published)(lost.id))
+
+        # Досланное позже событие с меньшим seq - не повтор
+        self.assertEqual(await database_sync_to_async(outbox.relay)(), (1, 0))
+        relayed = await socket.receive_json_from()
+        self.assertEqual((relayed['seq'], relayed['message']), (lost.seq, 'потерянное'))
+        self.assertTrue(await database_sync_to_async(outbox.is_published)(lost.id))
+        await socket.disconnect()
+
+    def test_attempts_are_capped(self):
+        with self.assertLogs('messenger.outbox', 'ERROR') as logs:
+            self.save_message('потерянное', broken=True)
+            with mock.patch.object(outbox, 'get_channel_layer', BrokenLayer):
+                self.assertEqual(outbox.relay(), (0, 1))
+                self.assertEqual(outbox.relay(), (0, 0))
+        self.assertIn('больше не досылается', logs.output[-1])
+        self.assertEqual(outbox.dead_letters().count(), 1)
+        self.assertEqual(outbox.retry_dead(), 1)
+        self.assertEqual(outbox.relay(), (1, 0))
+
+
+@override_settings(**TEST_SETTINGS)
+class IdempotentSendTests(WebsocketTestCase):
+    """Повтор chat_message с тем же client_id возвращает исходное сообщение"""
+
+    def test_duplicate_returns_original(self):
+        async_to_sync(self.send_twice)()
+
+    async def send_twice(self):
+        alice = await self.connect(self.alice)
+        bob = await self.connect(self.bob)
+        frame = {'type': 'chat_message', 'message': 'привет', 'client_id': 'c1'}
+
+        await alice.send_json_to(frame)
+        event = await alice.receive_json_from()
+        self.assertEqual((event['type'], event['client_id']), ('chat_message', 'c1'))
+        self.assertEqual((await bob.receive_json_from())['message_id'], event['message_id'])
+
+        # Повтор из LRU процесса, затем - из базы (другой процесс LRU не видел)
+        for forget in (False, True):
+            if forget:
+                idempotency.recent_ids.clear()
+            await alice.send_json_to(frame)
+            ack = await alice.receive_json_from()
+            self.assertEqual(
+                (ack['type'], ack['duplicate'], ack['message_id'], ack['timestamp']),
+                ('message_ack', True, event['message_id'], event['timestamp']),
+            )
+        self.assertTrue(await bob.receive_nothing())
+        self.assertEqual(await Message.objects.filter(chat=self.chat).acount(), 1)
+        await alice.disconnect()
+        await bob.disconnect()
+
+    def test_concurrent_duplicates_hit_unique_constraint(self):
+        barrier = threading.Barrier(2)
+        results = []
+
+        def send():
+            try:
+                barrier.wait()
+                results.append(idempotency.create_message(self.chat.id, self.alice, client_id='c2', content='привет'))
+            finally:
+                connection.close()
+
+        with mock.patch.object(idempotency, 'find', wraps=idempotency.find) as find:
+            threads = [threading.Thread(target=send) for _ in range(2)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        self.assertEqual(sorted(created for _, created in results), [False, True])
+        self.assertEqual(len({message.id for message, _ in results}), 1)
+        # Проигравший поток получил IntegrityError и нашел исходное сообщение
+        find.assert_called_once_with(self.chat.id, self.alice.id, 'c2')
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            Message.objects.create(chat=self.chat, sender=self.alice, client_id='c2', content='еще раз')
+
+
+class RawWebSocket:
+    """
+    Минимальный клиент WebSocket на голом сокете: можно не читать входящие
+    кадры и уменьшить приемный буфер, чтобы сервер уперся в медленного клиента.
+    """
+
+    def __init__(self, host, port, path, cookies, receive_buffer=None):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        if receive_buffer:
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, receive_buffer)
+        self.sock.connect((host, port))
+        self.sock.settimeout(10)
+        key = base64.b64encode(os.urandom(16)).decode()
+        cookie = '; '.join(f'{name}={morsel.value}' for name, morsel in cookies.items())
+        self.sock.sendall((
+            f'GET {path} HTTP/1.1\r\nHost: {host}:{port}\r\nUpgrade: websocket\r\n'
+            f'Connection: Upgrade\r\nSec-WebSocket-Key: {key}\r\n'
+            f'Sec-WebSocket-Version: 13\r\nCookie: {cookie}\r\n\r\n'
+        ).encode())
+        response = b''
+        while b'\r\n\r\n' not in response:
+            response += self.sock.recv(1)
+        assert response.startswith(b'HTTP/1.1 101'), response
+
+    def read_exactly(self, size):
+        data = b''
+        while len(data) < size:
+            chunk = self.sock.recv(size - len(data))
+            if not chunk:
+                raise ConnectionError('соединение закрыто')
+            data += chunk
+        return data
+
+    def send_json(self, data):
+        payload = json.dumps(data).encode()
+        header = bytes([0x81])
+        if len(payload) < 126:
+            header += bytes([0x80 | len(payload)])
+        elif len(payload) < 65536:
+            header += bytes([0x80 | 126]) + struct.pack('!H', len(payload))
+        else:
+            header += bytes([0x80 | 127]) + struct.pack('!Q', len(payload))
+        mask = os.urandom(4)
+        self.sock.sendall(header + mask + bytes(byte ^ mask[index % 4] for index, byte in enumerate(payload)))
+
+    def receive(self):
+        """(опкод, данные) следующего кадра сервера"""
+        first, second = self.read_exactly(2)
+        size = second & 0x7f
+        if size == 126:
+            size, = struct.unpack('!H', self.read_exactly(2))
+        elif size == 127:
+            size, = struct.unpack('!Q', self.read_exactly(8))
+        return first & 0x0f, self.read_exactly(size)
+
+    def receive_json(self):
+        opcode, payload = self.receive()
+        assert opcode == 0x1, opcode
+        return json.loads(payload)
+
+    def close(self):
+        self.sock.close()
+
+
+@override_settings(
+    CHAT_SEND_QUEUE_HIGH_WATERMARK=5,
+    CHAT_SEND_QUEUE_LOW_WATERMARK=2,
+    CHAT_SEND_QUEUE_MAX=10,
+    CHAT_SEND_STALL_TIMEOUT=0,
+    CHAT_SEND_BUFFER_HIGH=32 * 1024,
+    CHAT_SEND_BUFFER_LOW=16 * 1024,
+    **TEST_SETTINGS,
+)
+class SlowConsumerTests(ChannelsLiveServerTestCase):
+    """
+    Медленный клиент на настоящем сервере Daphne: send() не ждет сокет,
+    очередь растет по замеру буфера транспорта - набор текста отбрасывается,
+    очередь схлопывается в resync_required, соединение закрывается с 4008.
+    """
+
+    serve_static = False
+
+    def setUp(self):
+        self.alice = CustomUser.objects.create_user('alice', password='x')
+        self.bob = CustomUser.objects.create_user('bob', password='x')
+        self.chat = ChatRoom.objects.create()
+        self.chat.participants.add(self.alice, self.bob)
+
+    def open_socket(self, user, **kwargs):
+        client = Client()
+        client.force_login(user)
+        socket_client = RawWebSocket(self.host, self._port, f'/ws/chat/{self.chat.id}/', client.cookies, **kwargs)
+        self.addCleanup(socket_client.close)
+        return socket_client
+
+    def test_stalled_reader(self):
+        # Алиса читает медленно и принимает по 4 КБ: буфер записи сервера растет
+        alice = self.open_socket(self.alice, receive_buffer=4096)
+        bob = self.open_socket(self.bob)
+        received = []
+        result = {}
+
+        def read_slowly():
+            try:
+                while True:
+                    opcode, payload = alice.receive()
+                    if opcode == 0x8:
+                        result['close_code'], = struct.unpack('!H', payload[:2])
+                        return
+                    received.append(json.loads(payload))
+                    time.sleep(0.02)
+            except OSError as error:
+                result['error'] = error
+
+        reader = threading.Thread(target=read_slowly)
+        reader.start()
+        text = 'x' * 16 * 1024
+        sent = 0
+        while reader.is_alive() and sent < 300:
+            bob.send_json({'type': 'chat_message', 'message': f'{sent} {text}'})
+            sent += 1
+            # Боб читает свое (и свой набор текста): он не медленный
+            while bob.receive_json()['type'] != 'chat_message':
+                pass
+            bob.send_json({'type': 'typing', 'is_typing': True})
+        reader.join(10)
+        types = [event['type'] for event in received]
+
+        # Сервер закрыл соединение сам, до конца отправки: кадр закрытия 4008
+        # стоит в буфере за непрочитанным, и autobahn через closeHandshakeTimeout
+        # рвет TCP - хвост буфера (и resync_required) может не дойти
+        self.assertFalse(reader.is_alive())
+        self.assertLess(sent, 300)
+        self.assertTrue(
+            result.get('close_code') == 4008 or isinstance(result.get('error'), ConnectionResetError),
+            result,
+        )
+        self.assertLess(types.count('chat_message'), sent)
+        self.assertLess(types.count('typing'), sent)
+        if 'resync_required' in types:
+            self.assertEqual(types[-1], 'resync_required')
+            delivered = [event['seq'] for event in received if event['type'] == 'chat_message']
+            self.assertEqual(received[-1]['last_seq'], max(delivered))
+
+
+def populate(owner, chats=5, members=3, messages=10, media=3):
+    """Чаты owner с несколькими участниками, сообщениями и медиафайлами"""
+    rooms = []
+    for chat_index in range(chats):
+        chat = ChatRoom.objects.create(name=f'Группа {chat_index}' if members > 1 else '', is_group=members > 1)
+        others = [
+            CustomUser.objects.create_user(f'user{chat_index}_{index}', password='x')
+            for index in range(members)
+        ]
+        chat.participants.add(owner, *others)
+        senders = [owner] + others
+        for index in range(messages):
+            Message.objects.create(chat=chat, sender=senders[index % len(senders)], content=f'сообщение {index}')
+        for index in range(media):
+            media_file = MediaFile.objects.create(
+                chat=chat,
+                sender=senders[index % len(senders)],
+                file=f'chat_{chat.id}/image/{index}.jpg',
+                file_type='image',
+                file_name=f'{index}.jpg',
+                file_size=1000,
+                mime_type='image/jpeg',
+                width=640,
+                height=480,
+            )
+            Message.objects.create(chat=chat, sender=media_file.sender, media_file=media_file)
+        rooms.append(chat)
+    return rooms
+
+
+@override_settings(**TEST_SETTINGS)
+class QueryBudgetTests(QueryBudgetMixin, TestCase):
+    """Число запросов не растет с числом чатов, сообщений и медиафайлов (QUERY_BUDGETS)"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = CustomUser.objects.create_user('owner', password='x')
+        cls.chats = populate(cls.user)
+
+    def setUp(self):
+        self.client.force_login(self.user)
+
+    def test_chat_list(self):
+        with self.assertQueryBudget('chat_list'):
+            response = self.client.get(reverse('chat_list'))
+        self.assertEqual(response.status_code, 200)
+
+    def test_chat_detail(self):
+        with self.assertQueryBudget('chat_detail'):
+            response = self.client.get(reverse('chat_detail', args=[self.chats[0].id]))
+        self.assertEqual(response.status_code, 200)
+
+    def test_get_chat_media(self):
+        with self.assertQueryBudget('get_chat_media'):
+            response = self.client.get(reverse('get_chat_media', args=[self.chats[0].id]))
+        self.assertEqual(len(response.json()['media']), 3)
+
+
+@override_settings(**TEST_SETTINGS)
+class SyncTests(QueryBudgetMixin, TestCase):
+    """Дельта-синхронизация: страницы, повторный просмотр окна, поздний коммит"""
+
+    def setUp(self):
+        self.alice = CustomUser.objects.create_user('alice', password='x')
+        self.bob = CustomUser.objects.create_user('bob', password='x')
+        self.chat = ChatRoom.objects.create()
+        self.chat.participants.add(self.alice, self.bob)
+        self.client.force_login(self.alice)
+        self.token = self.client.get(reverse('sync')).json()['token']
+
+    def sync(self):
+        response = self.client.get(reverse('sync'), {'token': self.token})
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.token = data['token']
+        return data
+
+    def send(self, content):
+        return Message.objects.create(chat=self.chat, sender=self.bob, content=content)
+
+    def contents(self, data):
+        return [change['message']['message'] for change in data['changes'] if change['kind'] == 'message']
+
+    def test_pages_and_window_without_repeats(self):
+        for index in range(3):
+            self.send(f'сообщение {index}')
+        with self.settings(SYNC_PAGE_SIZE=2):
+            first = self.sync()
+            self.assertEqual((self.contents(first), first['has_more']), (['сообщение 0', 'сообщение 1'], True))
+            second = self.sync()
+            self.assertEqual((self.contents(second), second['has_more']), (['сообщение 2'], False))
+        # Записи еще в окне повторного просмотра, но уже отданы
+        with self.assertQueryBudget('sync'):
+            self.assertEqual(self.sync()['changes'], [])
+
+    def late_commit(self):
+        """Запись первого сообщения становится видна после второго (коммит позже)"""
+        first, second = self.send('раньше'), self.send('позже')
+        entry = ChangeLog.objects.get(kind='message', object_id=first.id)
+        entry_id = entry.id
+        entry.delete()
+        self.assertEqual(self.contents(self.sync()), ['позже'])
+        entry.id = entry_id
+        entry.save(force_insert=True)
+        self.assertLess(entry.id, ChangeLog.objects.get(kind='message', object_id=second.id).id)
+        return entry
+
+    def test_late_commit_is_delivered(self):
+        self.late_commit()
+        self.assertEqual(self.contents(self.sync()), ['раньше'])
+        self.assertEqual(self.sync()['changes'], [])
+
+    def test_commit_older_than_window_is_lost(self):
+        # Ограничение: транзакция, открытая дольше SYNC_RESCAN_SECONDS
+        entry = self.late_commit()
+        ChangeLog.objects.filter(pk=entry.pk).update(created_at=timezone.now() - timedelta(seconds=61))
+        self.assertEqual(self.sync()['changes'], [])
+
+    def test_foreign_token_is_rejected(self):
+        self.client.force_login(self.bob)
+        self.assertEqual(self.client.get(reverse('sync'), {'token': self.token}).status_code, 400)
+        self.assertEqual(sync.read_token(sync.make_token(self.bob.id, 5, {3, 1}), self.bob.id), (5, [1, 3]))
+
+
+@override_settings(**TEST_SETTINGS)
+class WebsocketQueryBudgetTests(QueryBudgetMixin, WebsocketTestCase):
+
+    def test_chat_message(self):
+        async_to_sync(self.send_message)()
+
+    async def send_message(self):
+        socket = await self.connect(self.alice)
+        with self.assertEventQueryBudget('ws:chat_message'):
+            await socket.send_json_to({'type': 'chat_message', 'message': 'привет', 'client_id': 'c1'})
+            event = await socket.receive_json_from()
+        self.assertEqual(event['message'], 'привет')
+        await socket.disconnect()
+
+
+SHARDS = {'a': 'ws://127.0.0.1:8001', 'b': 'ws://127.0.0.1:8002', 'c': 'ws://127.0.0.1:8003'}
+
+
+def reset_shard_map():
+    sharding._map_cache.update(checked=0.0, mtime=None, shards={})
+    sharding._ring_cache.clear()
+
+
+class HashRingTests(SimpleTestCase):
+
+    def test_processes_agree_on_owner(self):
+        """Владелец не зависит от процесса: хэш не меняется от PYTHONHASHSEED"""
+        script = (
+            'import json, sys; from messenger.sharding import HashRing; '
+            'ring = HashRing(sys.argv[1:]); print(json.dumps([ring.node_for(key) for key in range(500)]))'
+        )
+        ring = sharding.HashRing(sorted(SHARDS))
+        expected = [ring.node_for(key) for key in range(500)]
+        for seed in ('1', '2'):
+            output = subprocess.run(
+                [sys.executable, '-c', script, *sorted(SHARDS, reverse=True)],
+                capture_output=True, check=True, text=True,
+                env={**os.environ, 'PYTHONHASHSEED': seed},
+            ).stdout
+            self.assertEqual(json.loads(output), expected)
+
+    def test_new_shard_takes_about_one_nth(self):
+        before = sharding.HashRing(['a', 'b', 'c'])
+        after = sharding.HashRing(['a', 'b', 'c', 'd'])
+        moved = [key for key in range(2000) if before.node_for(key) != after.node_for(key)]
+        self.assertTrue(0.15 < len(moved) / 2000 < 0.35, len(moved))
+        # Переезжают только на новый шард
+        self.assertEqual({after.node_for(key) for key in moved}, {'d'})
+
+
+@override_settings(CHAT_SHARDS=SHARDS, CHAT_SHARD_MAP_FILE='', **TEST_SETTINGS)
+class ShardRoutingTests(WebsocketTestCase):
+    """Несколько процессов-шардов: каждый со своим CHAT_SHARD_NAME"""
+
+    def setUp(self):
+        super().setUp()
+        reset_shard_map()
+        self.owner = sharding.HashRing(sorted(SHARDS)).node_for(self.chat.id)
+        self.other = next(name for name in sorted(SHARDS) if name != self.owner)
+
+    def test_wrong_shard_redirects_with_4009(self):
+        async_to_sync(self.connect_to_wrong_shard)()
+
+    async def connect_to_wrong_shard(self):
+        with self.settings(CHAT_SHARD_NAME=self.other):
+            socket = WebsocketCommunicator(URLRouter(websocket_urlpatterns), f'/ws/chat/{self.chat.id}/')
+            socket.scope['user'] = self.alice
+            connected, _ = await socket.connect()
+            self.assertTrue(connected)
+            self.assertEqual(await socket.receive_json_from(), {
+                'type': 'wrong_shard',
+                'chat_id': self.chat.id,
+                'shard': self.owner,
+                'url': f'{SHARDS[self.owner]}/ws/chat/{self.chat.id}/',
+            })
+            self.assertEqual(await socket.receive_output(), {'type': 'websocket.close', 'code': 4009})
+
+        with self.settings(CHAT_SHARD_NAME=self.owner):
+            socket = await self.connect(self.alice)
+            await socket.send_json_to({'type': 'chat_message', 'message': 'привет'})
+            self.assertEqual((await socket.receive_json_from())['message'], 'привет')
+            await socket.disconnect()
+
+    def test_multiplex_subscribe_on_wrong_shard(self):
+        async_to_sync(self.subscribe_on_wrong_shard)()
+
+    async def subscribe_on_wrong_shard(self):
+        with self.settings(CHAT_SHARD_NAME=self.other):
+            socket = await self.connect(self.alice, '/ws/chats/')
+            await socket.send_json_to({'type': 'subscribe', 'chat_id': self.chat.id})
+            error = await socket.receive_json_from()
+            self.assertEqual((error['code'], error['shard']), ('wrong_shard', self.owner))
+            await socket.disconnect()
+
+
+@override_settings(CHAT_SHARD_MAP_CHECK_INTERVAL=0, CHAT_SHARD_WATCH_INTERVAL=0.05, **TEST_SETTINGS)
+class ShardMapWatchTests(WebsocketTestCase):
+    """Файл карты изменили на ходу: соединения переехавших чатов закрываются"""
+
+    def setUp(self):
+        super().setUp()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.map_file = os.path.join(directory.name, 'shards.json')
+        self.write_map({'a': SHARDS['a']}, mtime=1_000_000)
+        reset_shard_map()
+        self.addCleanup(reset_shard_map)
+
+    def write_map(self, shards, mtime):
+        with open(self.map_file, 'w', encoding='utf-8') as target:
+            json.dump(shards, target)
+        os.utime(self.map_file, (mtime, mtime))
+
+    def test_moved_chat_is_closed(self):
+        async_to_sync(self.move_chat)()
+
+    async def move_chat(self):
+        with self.settings(CHAT_SHARD_NAME='a', CHAT_SHARD_MAP_FILE=self.map_file):
+            socket = await self.connect(self.alice)
+            # Шард a выведен из карты: все его чаты переезжают на b
+            self.write_map({'b': SHARDS['b']}, mtime=2_000_000)
+            redirect = await socket.receive_json_from(timeout=2)
+            self.assertEqual(redirect['type'], 'wrong_shard')
+            self.assertEqual(redirect['shard'], 'b')
+            self.assertEqual(await socket.receive_output(timeout=2), {'type': 'websocket.close', 'code': 4009})
+            await socket.disconnect()
+
+
+S3_BUCKET = 'tax-media-test'
+
+
+@skipUnless(ThreadedMotoServer is not None, 'нужны moto[server], boto3 и django-storages')
+class ObjectStorageTests(TestCase):
+    """Прямая загрузка в бакет и подписанное скачивание на локальном S3 (moto)"""
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        logging.getLogger('werkzeug').setLevel(logging.ERROR)
+        cls.server = ThreadedMotoServer(ip_address='127.0.0.1', port=0, verbose=False)
+        cls.server.start()
+        cls.addClassCleanup(cls.server.stop)
+        host, port = cls.server.get_host_and_port()
+        cls.endpoint_url = f'http://{host}:{port}'
+        boto3.client(
+            's3',
+            endpoint_url=cls.endpoint_url,
+            region_name='us-east-1',
+            aws_access_key_id='testing',
+            aws_secret_access_key='testing',
+        ).create_bucket(Bucket=S3_BUCKET)
+
+    def setUp(self):
+        storages_setting = {
+            'default': {
+                'BACKEND': 'storages.backends.s3.S3Storage',
+                'OPTIONS': {
+                    'bucket_name': S3_BUCKET,
+                    'endpoint_url': self.endpoint_url,
+                    'region_name': 'us-east-1',
+                    'access_key': 'testing',
+                    'secret_key': 'testing',
+                    'signature_version': 's3v4',
+                    'default_acl': None,
+                    'file_overwrite': False,
+                },
+            },
+            'staticfiles': {'BACKEND': 'django.contrib.staticfiles.storage.StaticFilesStorage'},
+        }
+        overrides = override_settings(
+            STORAGES=storages_setting,
+            RATE_LIMITS={},
+            MEDIA_PROCESSING_ENABLED=False,
+            BACKGROUND_TASKS_EAGER=True,
+            CHANNEL_LAYERS=TEST_SETTINGS['CHANNEL_LAYERS'],
+        )
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+
+        self.user = CustomUser.objects.create_user('alice', password='x')
+        self.chat = ChatRoom.objects.create()
+        self.chat.participants.add(self.user)
+        self.client = Client(enforce_csrf_checks=True)
+        self.client.force_login(self.user)
+        self.client.get(f'/chat/{self.chat.id}/')
+        self.csrf_token = self.client.cookies['csrftoken'].value
+
+    def post(self, path, data):
+        return self.client.post(path, data, HTTP_X_CSRFTOKEN=self.csrf_token)
+
+    def test_presign_upload_confirm_download(self):
+        body = 'отчет за квартал\n'.encode() * 100
+        response = self.post(f'/chat/{self.chat.id}/upload-url/', {
+            'file_name': 'report.txt',
+            'file_size': len(body),
+            'caption': 'отчет',
+            'client_id': 'upload-1',
+        })
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertTrue(data['upload']['url'].startswith(self.endpoint_url))
+
+        # Байты идут прямо в бакет по подписанной форме
+        stored = requests.post(data['upload']['url'], data=data['upload']['fields'], files={'file': ('report.txt', body)})
+        self.assertIn(stored.status_code, (200, 201, 204))
+
+        confirmed = self.post(f'/chat/{self.chat.id}/upload-confirm/', {'token': data['token']})
+        self.assertEqual(confirmed.status_code, 200)
+        message = Message.objects.select_related('media_file').get(pk=confirmed.json()['message_id'])
+        self.assertEqual(message.content, 'отчет')
+        self.assertEqual(message.media_file.file_size, len(body))
+        self.assertEqual(message.media_file.file_type, 'document')
+
+        # Повторное подтверждение не создает второе сообщение
+        again = self.post(f'/chat/{self.chat.id}/upload-confirm/', {'token': data['token']})
+        self.assertTrue(again.json()['duplicate'])
+        self.assertEqual(MediaFile.objects.count(), 1)
+
+        # Скачивание: права проверяет Django, байты отдает бакет по подписанной ссылке
+        download = self.client.get(f'/media/{message.media_file.id}/download/')
+        self.assertEqual(download.status_code, 302)
+        self.assertIn('X-Amz-Signature', download['Location'])
+        fetched = requests.get(download['Location'])
+        self.assertEqual(fetched.status_code, 200)
+        self.assertEqual(fetched.content, body)
+        self.assertIn('attachment', fetched.headers['Content-Disposition'])
+
+    def test_confirm_without_object_is_rejected(self):
+        data = self.post(f'/chat/{self.chat.id}/upload-url/', {'file_name': 'a.txt', 'file_size': 10}).json()
+        response = self.post(f'/chat/{self.chat.id}/upload-confirm/', {'token': data['token']})
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(Message.objects.exists())
+
+    def test_csrf_is_required(self):
+        response = self.client.post(f'/chat/{self.chat.id}/upload-url/', {'file_name': 'a.txt', 'file_size': 10})
+        self.assertEqual(response.status_code, 403)
+
+
+@override_settings(**TEST_SETTINGS)
+class MediaGcTests(TestCase):
+    """Сборщик мусора: отметки удаленных сообщений и корни из upload_to"""
+
+    def setUp(self):
+        media_root = tempfile.TemporaryDirectory()
+        self.addCleanup(media_root.cleanup)
+        overrides = override_settings(MEDIA_ROOT=media_root.name, MEDIA_GC_ROOTS=None, MEDIA_GC_FILES_PER_SECOND=0)
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+        self.media_root = media_root.name
+        self.user = CustomUser.objects.create_user('alice', password='x')
+        self.chat = ChatRoom.objects.create()
+        self.chat.participants.add(self.user)
+
+    def put(self, name, age_hours=48):
+        """Файл в MEDIA_ROOT с mtime age_hours назад"""
+        path = os.path.join(self.media_root, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as handle:
+            handle.write(b'x' * 10)
+        old = time.time() - age_hours * 3600
+        os.utime(path, (old, old))
+        return name
+
+    def exists(self, name):
+        return os.path.exists(os.path.join(self.media_root, name))
+
+    def test_purged_media_leaves_tombstone(self):
+        name = self.put(f'chat_{self.chat.id}/document/2026/1/a.txt')
+        media = MediaFile.objects.create(
+            chat=self.chat, sender=self.user, file=name, file_type='document',
+            file_name='a.txt', file_size=10, is_deleted=True,
+            deleted_at=timezone.now() - timedelta(days=2),
+        )
+        message = Message.objects.create(chat=self.chat, sender=self.user, content='подпись', media_file=media)
+
+        media_gc.collect()
+
+        message.refresh_from_db()
+        self.assertTrue(message.is_deleted)
+        self.assertEqual(message.content, '')
+        self.assertFalse(MediaFile.objects.exists())
+        self.assertFalse(self.exists(name))
+        entry = ChangeLog.objects.get(kind='delete', object_id=message.id)
+        self.assertIsNotNone(entry.seq)
+
+    def test_orphans_collected_under_every_upload_root(self):
+        self.assertEqual(
+            media_gc.upload_roots(),
+            {('chat_', True), ('thumbnails', False), ('avatars', False)},
+        )
+        current = self.put('avatars/current.png')
+        replaced = self.put('avatars/replaced.png')
+        variant = self.put('avatars/v/abc.webp')
+        stale_variant = self.put('avatars/v/old.webp')
+        fresh = self.put('avatars/fresh.png', age_hours=0)
+        chat_orphan = self.put(f'chat_{self.chat.id}/image/2026/1/lost.jpg')
+        self.put('unrelated/keep.txt')
+        CustomUser.objects.filter(pk=self.user.pk).update(
+            avatar=current,
+            avatar_variants={'128': {'webp': variant}},
+        )
+
+        report = media_gc.collect()
+
+        self.assertEqual(report.orphans, 3)
+        for name in (current, variant, fresh, 'unrelated/keep.txt'):
+            self.assertTrue(self.exists(name), name)
+        for name in (replaced, stale_variant, chat_orphan):
+            self.assertFalse(self.exists(name), name)
+
+
+@override_settings(
+    STORAGE_QUOTA_USER_BYTES=2500,
+    STORAGE_QUOTA_USER_FILES=None,
+    STORAGE_QUOTA_CHAT_BYTES=None,
+    STORAGE_QUOTA_CHAT_FILES=3,
+    **TEST_SETTINGS,
+)
+class QuotaTests(TestCase):
+    """Счетчики StorageUsage: загрузка, мягкое и полное удаление, отказ по квоте"""
+
+    def setUp(self):
+        self.alice = CustomUser.objects.create_user('alice', password='x')
+        self.bob = CustomUser.objects.create_user('bob', password='x')
+        self.chat = ChatRoom.objects.create()
+        self.chat.participants.add(self.alice, self.bob)
+
+    def media(self, sender, size=1000):
+        return MediaFile.objects.create(
+            chat=self.chat,
+            sender=sender,
+            file=f'chat_{self.chat.id}/document/{size}.bin',
+            file_type='document',
+            file_name='file.bin',
+            file_size=size,
+            mime_type='application/octet-stream',
+        )
+
+    def usage(self):
+        return quotas.usage(self.alice.id, self.chat.id)
+
+    def test_soft_delete_credits_usage_back(self):
+        first, second = self.media(self.alice), self.media(self.alice, 500)
+        self.assertEqual(self.usage(), {'user': (1500, 2), 'chat': (1500, 2)})
+
+        self.assertTrue(first.soft_delete())
+        self.assertEqual(self.usage(), {'user': (500, 1), 'chat': (500, 1)})
+        # Повторное мягкое удаление и удаление строки сборщиком не списывают еще раз
+        self.assertFalse(MediaFile.objects.get(pk=first.pk).soft_delete())
+        MediaFile.objects.filter(pk=first.pk).delete()
+        self.assertEqual(self.usage(), {'user': (500, 1), 'chat': (500, 1)})
+        # Каскад (строка не удалена мягко) освобождает место
+        second.delete()
+        self.assertEqual(self.usage(), {'user': (0, 0), 'chat': (0, 0)})
+
+    def test_quota_rejection(self):
+        self.media(self.alice, 2000)
+        self.assertIsNone(quotas.check(self.alice.id, self.chat.id, 500))
+        self.assertIn('вашего хранилища', quotas.check(self.alice.id, self.chat.id, 501))
+        # Квота чата по числу файлов общая для участников
+        self.media(self.bob, 10)
+        self.media(self.bob, 10)
+        self.assertIn('не больше 3 файлов', quotas.check(self.bob.id, self.chat.id, 10))
+
+        self.client.force_login(self.alice)
+        response = self.client.post(
+            reverse('upload_media', args=[self.chat.id]),
+            {'file': SimpleUploadedFile('big.txt', b'x' * 600, content_type='text/plain')},
+        )
+        self.assertEqual(response.status_code, 413)
+        self.assertIn('Превышена квота', response.json()['error'])
+        self.assertEqual(MediaFile.objects.filter(chat=self.chat).count(), 3)
+
+    def test_storage_usage_command(self):
+        self.media(self.alice, 2000)
+        self.media(self.bob, 500)
+        # Счетчики разошлись с MediaFile (правка базы в обход модели)
+        StorageUsage.objects.filter(scope='user', object_id=self.alice.id).update(bytes=1, files=9)
+
+        output = io.StringIO()
+        call_command('storage_usage', '--rebuild', stdout=output)
+        lines = output.getvalue().splitlines()
+        self.assertEqual(lines[0], 'Счетчиков пересчитано: 3')
+        self.assertEqual([line.split()[:3] for line in lines[1:]], [
+            [str(self.alice.id), 'alice', '2000'],
+            [str(self.bob.id), 'bob', '500'],
+        ])
+        self.assertIn('80.0%', lines[1])
+
+        output = io.StringIO()
+        call_command('storage_usage', '--scope', 'chat', '--top', '1', stdout=output)
+        self.assertIn('2500 байт', output.getvalue())
+        self.assertIn(' 2 файлов', output.getvalue())
+
+
+@override_settings(EXPORT_BUFFER_SIZE=64, EXPORT_CHUNK_SIZE=2, **TEST_SETTINGS)
+class ExportTests(TestCase):
+    """Выгрузка чата: формат JSON Lines и ZIP, продолжение после after, поток под WSGI и ASGI"""
+
+    def setUp(self):
+        media_root = tempfile.TemporaryDirectory()
+        self.addCleanup(media_root.cleanup)
+        overrides = override_settings(MEDIA_ROOT=media_root.name)
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+        self.alice = CustomUser.objects.create_user('alice', password='x')
+        self.bob = CustomUser.objects.create_user('bob', password='x')
+        self.chat = ChatRoom.objects.create()
+        self.chat.participants.add(self.alice, self.bob)
+        self.messages = [
+            Message.objects.create(chat=self.chat, sender=self.bob, content=f'сообщение {index}')
+            for index in range(3)
+        ]
+        Message.objects.create(chat=self.chat, sender=self.bob, content='удалено').delete_for_everyone()
+        self.media_file = MediaFile.objects.create(
+            chat=self.chat,
+            sender=self.alice,
+            file=default_storage.save(f'chat_{self.chat.id}/document/отчет.pdf', ContentFile(b'%PDF' * 100)),
+            file_type='document',
+            file_name='отчет.pdf',
+            file_size=400,
+            mime_type='application/pdf',
+        )
+        self.messages.append(Message.objects.create(chat=self.chat, sender=self.alice, media_file=self.media_file))
+        self.client.force_login(self.alice)
+        self.url = reverse('export_chat', args=[self.chat.id])
+
+    def export(self, **params):
+        response = self.client.get(self.url, params)
+        self.assertEqual(response.status_code, 200)
+        # WSGI: обычный генератор, не собранный заранее
+        self.assertFalse(response.is_async)
+        chunks = list(response.streaming_content)
+        self.assertGreater(len(chunks), 1)
+        return response, b''.join(chunks)
+
+    def test_jsonl(self):
+        response, content = self.export()
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        self.assertEqual(response['Content-Disposition'], f'attachment; filename="chat_{self.chat.id}.jsonl"')
+        records = [json.loads(line) for line in content.decode().splitlines()]
+        self.assertEqual([record['id'] for record in records], [message.id for message in self.messages])
+        self.assertEqual([record['seq'] for record in records], sorted(record['seq'] for record in records))
+        self.assertEqual((records[0]['sender'], records[0]['content'], records[0]['type']), ('bob', 'сообщение 0', 'text'))
+        self.assertEqual(records[-1]['media']['url'], self.media_file.file.url)
+        self.assertNotIn('path', records[-1]['media'])
+
+        _, content = self.export(after=self.messages[1].id)
+        self.assertEqual([json.loads(line)['id'] for line in content.splitlines()], [self.messages[2].id, self.messages[3].id])
+
+    def test_zip(self):
+        response, content = self.export(format='zip')
+        self.assertEqual(response['Content-Type'], 'application/zip')
+        with zipfile.ZipFile(io.BytesIO(content)) as archive:
+            self.assertIsNone(archive.testzip())
+            path = f'media/{self.media_file.id}_отчет.pdf'
+            self.assertEqual(archive.namelist(), ['messages.jsonl', path])
+            self.assertEqual(archive.read(path), b'%PDF' * 100)
+            records = [json.loads(line) for line in archive.read('messages.jsonl').splitlines()]
+        self.assertEqual(len(records), 4)
+        self.assertEqual(records[-1]['media']['path'], path)
+        self.assertNotIn('url', records[-1]['media'])
+
+    def test_bad_requests(self):
+        self.assertEqual(self.client.get(self.url, {'format': 'tar'}).status_code, 400)
+        self.assertEqual(self.client.get(self.url, {'after': 'abc'}).status_code, 400)
+        self.assertEqual(self.client.get(self.url, {'after': 10 ** 9}).status_code, 400)
+        self.client.force_login(CustomUser.objects.create_user('eve', password='x'))
+        self.assertEqual(self.client.get(self.url).status_code, 404)
+
+    def test_asgi_streams_async_iterator(self):
+        async_to_sync(self.export_async)()
+
+    async def export_async(self):
+        client = AsyncClient()
+        await client.aforce_login(self.alice)
+        response = await client.get(self.url)
+        self.assertTrue(response.is_async)
+        chunks = [chunk async for chunk in response.streaming_content]
+        self.assertGreater(len(chunks), 1)
+        self.assertEqual(len(b''.join(chunks).splitlines()), 4)
+
+
+class PlaceholderTests(SimpleTestCase):
+    """Заглушки: сетка по ориентации, разбор обратно, длина в пределах поля"""
+
+    def image(self, width, height, left=(255, 0, 0), right=(0, 0, 255)):
+        from PIL import Image
+
+        image = Image.new('RGB', (width, height), left)
+        image.paste(right, (width // 2, 0, width, height))
+        return image
+
+    def test_landscape(self):
+        placeholder = placeholders.encode(self.image(400, 300))
+        self.assertTrue(placeholder.startswith('4x3:'))
+        self.assertEqual(len(placeholder), 52)
+        width, height, pixels = placeholders.decode(placeholder)
+        self.assertEqual((width, height, len(pixels)), (4, 3, 36))
+        # Левая половина красная, правая синяя - в каждой строке сетки
+        for row in range(3):
+            self.assertEqual(tuple(pixels[row * 12:row * 12 + 3]), (255, 0, 0))
+            self.assertEqual(tuple(pixels[row * 12 + 9:row * 12 + 12]), (0, 0, 255))
+
+    def test_portrait(self):
+        placeholder = placeholders.encode(self.image(300, 400))
+        self.assertTrue(placeholder.startswith('3x4:'))
+        width, height, pixels = placeholders.decode(placeholder)
+        self.assertEqual((width, height, len(pixels)), (3, 4, 36))
+        self.assertEqual(tuple(pixels[:3]), (255, 0, 0))
+
+    def test_length_fits_field(self):
+        max_length = MediaFile._meta.get_field('placeholder').max_length
+        for size in ((100, 100), (1000, 10), (10, 1000), (640, 600)):
+            placeholder = placeholders.encode(self.image(*size))
+            self.assertLessEqual(len(placeholder), max_length, size)
+            placeholders.decode(placeholder)
+
+    def test_exif_rotation(self):
+        from PIL import Image
+
+        exif = Image.Exif()
+        exif[0x0112] = 6  # снято боком: хранится 400x300, показывается 300x400
+        upload = io.BytesIO()
+        self.image(400, 300).save(upload, 'JPEG', exif=exif)
+        upload.seek(0)
+        width, height, placeholder = placeholders.image_info(upload)
+        self.assertEqual((width, height), (300, 400))
+        self.assertTrue(placeholder.startswith('3x4:'))
+        self.assertEqual(upload.tell(), 0)
+
+
+class FlakyLayer(InMemoryChannelLayer):
+    """Слой, у которого первый receive падает, и со счетчиком group_add"""
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.failures = 1
+        self.group_adds = 0
+
+    async def receive(self, channel):
+        if self.failures:
+            self.failures -= 1
+            raise ConnectionError('слой недоступен')
+        return await super().receive(channel)
+
+    async def group_add(self, group, channel):
+        self.group_adds += 1
+        return await super().group_add(group, channel)
+
+
+@override_settings(CHAT_BROADCAST_GROUP_REFRESH=0.05)
+class BroadcastHubTests(SimpleTestCase):
+    """Хаб переживает сбои слоя и испорченные события и продлевает группы"""
+
+    def test_hub_survives_failures_and_refreshes_groups(self):
+        async def scenario():
+            layer = FlakyLayer()
+            hub = broadcast.BroadcastHub(layer)
+            room = await hub.join(1)
+            group = broadcast_group_name(1, True)
+            try:
+                # Первый receive падает: цикл перезапускается и восстанавливает группу
+                await asyncio.sleep(broadcast.RESTART_DELAY + 0.2)
+                await layer.group_send(group, {'type': 'chat_message', 'chat_id': ['испорчено']})
+                await layer.group_send(group, {'type': 'chat_message', 'chat_id': 1, 'id': 7})
+                await asyncio.wait_for(room.wait(0), timeout=2)
+                events, _ = room.read(0)
+                self.assertEqual([event['id'] for event in events], [7])
+                self.assertGreaterEqual(layer.group_adds, 3)
+            finally:
+                hub.task.cancel()
+                hub.refresh_task.cancel()
+
+        with self.assertLogs('messenger.broadcast', 'ERROR'):
+            async_to_sync(scenario)()
+
+
+@override_settings(**TEST_SETTINGS)
+class MultiplexFrameTests(WebsocketTestCase):
+    """Кадры ws/chats/: chat_id, window, credit и last_seq проверяются и приводятся к int"""
+
+    def test_frames_are_validated(self):
+        async_to_sync(self.send_frames)()
+
+    async def send_frames(self):
+        socket = await self.connect(self.alice, '/ws/chats/')
+
+        for frame, field in (
+            ({'type': 'subscribe', 'chat_id': 'abc'}, 'chat_id'),
+            ({'type': 'subscribe'}, 'chat_id'),
+            ({'type': 'subscribe', 'chat_id': self.chat.id, 'window': 'много'}, 'window'),
+            ({'type': 'subscribe', 'chat_id': self.chat.id, 'last_seq': -1}, 'last_seq'),
+            ({'type': 'credit', 'chat_id': self.chat.id, 'credit': [1]}, 'credit'),
+        ):
+            await socket.send_json_to(frame)
+            error = await socket.receive_json_from()
+            self.assertEqual((error['type'], error['code'], error['field']), ('error', 'invalid_frame', field))
+
+        # chat_id строкой и window: null - подписка без окна, кредит ее не ломает
+        await socket.send_json_to({'type': 'subscribe', 'chat_id': str(self.chat.id), 'window': None})
+        self.assertEqual(await socket.receive_json_from(), {'type': 'subscribed', 'chat_id': self.chat.id})
+        await socket.send_json_to({'type': 'credit', 'chat_id': self.chat.id, 'credit': '5'})
+        await socket.send_json_to({'type': 'chat_message', 'chat_id': self.chat.id, 'message': 'привет'})
+        self.assertEqual((await socket.receive_json_from())['message'], 'привет')
+        await socket.disconnect()
+
+
+def client_deflate(data):
+    """Сжатие кадра, как у клиента tax.msgpack.v1+deflate: без хвоста 00 00 ff ff"""
+    compressor = zlib.compressobj(wbits=-zlib.MAX_WBITS)
+    return (compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH))[:-4]
+
+
+@override_settings(CHAT_MAX_FRAME_SIZE=1024)
+class CodecTests(SimpleTestCase):
+    """Кодеки: туда и обратно, сжатие, испорченные и слишком большие кадры"""
+
+    event = {'type': 'chat_message', 'chat_id': 7, 'message': 'привет', 'custom': [1, {'seq': 2}]}
+
+    def test_json_round_trip(self):
+        codec = protocol.JsonCodec()
+        self.assertEqual(codec.decode(codec.encode(self.event)), self.event)
+        with self.assertRaises(protocol.FrameTooLarge):
+            codec.decode(json.dumps({'message': 'x' * 2000}))
+
+    @skipUnless(protocol.msgpack is not None, 'нужен msgpack')
+    def test_msgpack_round_trip(self):
+        client, server = protocol.MsgpackCodec(), protocol.MsgpackCodec()
+        self.assertEqual(server.decode(bytes_data=client.encode(self.event)), self.event)
+        # Текст в бинарном соединении - по-прежнему JSON
+        self.assertEqual(server.decode(text_data=json.dumps(self.event)), self.event)
+
+    @skipUnless(protocol.msgpack is not None, 'нужен msgpack')
+    def test_deflate_shares_dictionary_between_frames(self):
+        client, server = protocol.MsgpackCodec(deflate=True), protocol.MsgpackCodec(deflate=True)
+        frames = [client.encode(self.event) for _ in range(3)]
+        # Повтор кадра сжимается ссылками на словарь соединения
+        self.assertLess(len(frames[1]), len(frames[0]))
+        for frame in frames:
+            self.assertEqual(server.decode(bytes_data=frame), self.event)
+
+    @skipUnless(protocol.msgpack is not None, 'нужен msgpack')
+    def test_deflate_bomb_is_rejected(self):
+        server = protocol.MsgpackCodec(deflate=True)
+        bomb = client_deflate(protocol.msgpack.packb({'message': 'x' * 10 ** 6}))
+        self.assertLess(len(bomb), 1024)
+        with self.assertRaises(protocol.FrameTooLarge):
+            server.decode(bytes_data=bomb)
+
+    @skipUnless(protocol.msgpack is not None, 'нужен msgpack')
+    def test_malformed_frames(self):
+        with self.assertRaises(protocol.FrameError) as raised:
+            protocol.MsgpackCodec(deflate=True).decode(bytes_data=b'\xff\xfe\xfd')
+        self.assertEqual(raised.exception.close_code, 1007)
+        with self.assertRaises(ValueError):
+            protocol.MsgpackCodec().decode(bytes_data=b'\xc1')
+
+
+@skipUnless(protocol.msgpack is not None, 'нужен msgpack')
+@override_settings(CHAT_MAX_FRAME_SIZE=1024, **TEST_SETTINGS)
+class FrameLimitTests(WebsocketTestCase):
+    """Кадр больше CHAT_MAX_FRAME_SIZE после распаковки закрывает соединение"""
+
+    def test_deflate_bomb_closes_connection(self):
+        async_to_sync(self.send_bomb)()
+
+    async def send_bomb(self):
+        communicator = WebsocketCommunicator(
+            URLRouter(websocket_urlpatterns),
+            f'/ws/chat/{self.chat.id}/',
+            subprotocols=[protocol.SUBPROTOCOL_MSGPACK_DEFLATE],
+        )
+        communicator.scope['user'] = self.alice
+        connected, subprotocol = await communicator.connect()
+        self.assertEqual((connected, subprotocol), (True, protocol.SUBPROTOCOL_MSGPACK_DEFLATE))
+
+        await communicator.send_to(bytes_data=client_deflate(protocol.msgpack.packb({'message': 'x' * 10 ** 6})))
+        self.assertEqual(await communicator.receive_output(), {'type': 'websocket.close', 'code': 1009})
+        self.assertFalse(await Message.objects.filter(chat=self.chat).aexists())
+
+
+@override_settings(RATE_LIMITS={
+    'upload': {'user': (0.001, 1)},
+    'upload_bytes': {'user': (0.001, 100)},
+})
+class UploadRateTests(SimpleTestCase):
+    """Отказ по объему не тратит токен числа загрузок"""
+
+    def setUp(self):
+        ratelimit._backend = None
+        self.addCleanup(setattr, ratelimit, '_backend', None)
+
+    def test_bytes_rejection_refunds_upload_token(self):
+        self.assertIsNotNone(check_upload_rate(1, 2, 1000))
+        self.assertIsNone(check_upload_rate(1, 2, 10))
+        self.assertIsNotNone(check_upload_rate(1, 2, 10))
+
+    def test_refund_is_capped_at_burst(self):
+        for backend in (ratelimit.LocalBackend(), ratelimit.CacheBackend()):
+            key = f'ratelimit:test:{type(backend).__name__}'
+            self.assertIsNone(backend.consume(key, 0.001, 2))
+            # Повторные возвраты не поднимают ведро выше емкости
+            for _ in range(5):
+                backend.refund(key, 2)
+            self.assertIsNone(backend.consume(key, 0.001, 2))
+            self.assertIsNone(backend.consume(key, 0.001, 2))
+            self.assertIsNotNone(backend.consume(key, 0.001, 2))
+
+
+class MetricsRenderTests(SimpleTestCase):
+    """Текстовый формат Prometheus: счетчики с метками, вычисляемые датчики, гистограммы"""
+
+    def test_render(self):
+        with mock.patch.object(metrics, 'REGISTRY', []):
+            counter = metrics.Counter('events_total', 'События', ['kind'], [('a',)])
+            gauge = metrics.Gauge('depth', 'Глубина', function=lambda: 3)
+            histogram = metrics.Histogram('duration_seconds', 'Длительность', buckets=(0.1, 1))
+            counter.labels('a').inc(2)
+            counter.labels('b"\n').inc()
+            histogram.observe(0.05)
+            histogram.observe(5)
+            text = metrics.render()
+
+        self.assertEqual(text, '\n'.join([
+            '# HELP events_total События',
+            '# TYPE events_total counter',
+            'events_total{kind="a"} 2',
+            'events_total{kind="b\\"\\n"} 1',
+            '# HELP depth Глубина',
+            '# TYPE depth gauge',
+            'depth 3',
+            '# HELP duration_seconds Длительность',
+            '# TYPE duration_seconds histogram',
+            'duration_seconds_bucket{le="0.1"} 1',
+            'duration_seconds_bucket{le="1"} 1',
+            'duration_seconds_bucket{le="+Inf"} 2',
+            'duration_seconds_sum 5.05',
+            'duration_seconds_count 2',
+        ]) + '\n')
+
+
+@override_settings(METRICS_TOKEN='collector-secret', **TEST_SETTINGS)
+class MetricsViewTests(TestCase):
+    """/internal/metrics/ - по bearer-токену или персоналу, адресу клиента не доверяем"""
+
+    def setUp(self):
+        self.url = reverse('metrics')
+
+    def test_loopback_without_token_is_forbidden(self):
+        self.assertEqual(self.client.get(self.url, REMOTE_ADDR='127.0.0.1').status_code, 403)
+        self.assertEqual(self.client.get(self.url, HTTP_AUTHORIZATION='Bearer other').status_code, 403)
+        self.assertEqual(self.client.get(self.url, HTTP_AUTHORIZATION='Basic collector-secret').status_code, 403)
+
+    def test_bearer_token(self):
+        response = self.client.get(self.url, HTTP_AUTHORIZATION='Bearer collector-secret')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['Content-Type'].startswith('text/plain; version=0.0.4'))
+        self.assertIn(b'# TYPE ws_connections', response.content)
+
+    @override_settings(METRICS_TOKEN='')
+    def test_empty_token_disables_collector_access(self):
+        self.assertEqual(self.client.get(self.url, HTTP_AUTHORIZATION='Bearer ').status_code, 403)
+
+    def test_staff(self):
+        staff = CustomUser.objects.create_user('admin', password='x', is_staff=True)
+        self.client.force_login(staff)
+        self.assertEqual(self.client.get(self.url).status_code, 200)
+
+
+@override_settings(PROFILER_ENABLED=True, **TEST_SETTINGS)
+class ProfilerTests(SimpleTestCase):
+    """Интервал съемки приводится к пределам, ссылка на съемку одноразовая"""
+
+    def setUp(self):
+        self.url = reverse('profile_process')
+
+    def test_interval_is_clamped(self):
+        for interval, expected in ((0, 0.001), (-1, 0.001), ('5', 1.0), (None, 0.005)):
+            sampler = profiling.profile(0.01, interval)
+            self.assertEqual(sampler.interval, expected)
+        for interval in ('abc', 'nan', [1]):
+            with self.assertRaises(ValueError):
+                profiling.start(0.01, interval)
+        self.assertIsNone(profiling._active)
+
+    def test_bad_interval_is_400(self):
+        response = self.client.get(self.url, {'token': profiling.make_token(0.01), 'interval': 'abc'})
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(response.json()['success'])
+
+    def test_token_is_single_use(self):
+        token = profiling.make_token(0.05)
+        response = self.client.get(self.url, {'token': token, 'interval': '0.01'})
+        self.assertEqual(response.status_code, 200)
+        self.assertGreater(int(response['X-Profile-Samples']), 0)
+        self.assertEqual(self.client.get(self.url, {'token': token}).status_code, 403)
+        # Старый формат без nonce и чужая подпись не принимаются
+        legacy = signing.TimestampSigner(salt=profiling.TOKEN_SALT).sign('0.05')
+        self.assertEqual(self.client.get(self.url, {'token': legacy}).status_code, 403)
+        self.assertEqual(self.client.get(self.url, {'token': token + 'x'}).status_code, 403)
+
+
+@override_settings(**TEST_SETTINGS)
+class ChatRowCacheTests(TestCase):
+    """Строка группового чата зависит от автора последнего сообщения"""
+
+    def test_group_row_follows_last_sender_rename(self):
+        alice = CustomUser.objects.create_user('alice', password='x')
+        bob = CustomUser.objects.create_user('bob', password='x')
+        chat = ChatRoom.objects.create(is_group=True, name='команда')
+        chat.participants.add(alice, bob)
+        Message.objects.create(chat=chat, sender=bob, content='привет')
+        self.client.force_login(alice)
+
+        self.assertContains(self.client.get(reverse('chat_list')), 'bob: привет')
+        with self.captureOnCommitCallbacks(execute=True):
+            bob.username = 'robert'
+            bob.save()
+        self.assertContains(self.client.get(reverse('chat_list')), 'robert: привет')
+
+
+@override_settings(AVATAR_JSON_SIZE=40, AVATAR_DENSITY=2, **TEST_SETTINGS)
+class JsonAvatarTests(TestCase):
+    """JSON и события отдают готовый вариант аватара, а не исходный файл"""
+
+    def setUp(self):
+        self.user = CustomUser.objects.create_user(
+            'alice',
+            password='x',
+            avatar='avatars/original.png',
+            avatar_variants={
+                '64': {'webp': 'avatars/v/small.webp', 'jpeg': 'avatars/v/small.jpeg'},
+                '128': {'webp': 'avatars/v/medium.webp', 'jpeg': 'avatars/v/medium.jpeg'},
+            },
+        )
+        self.chat = ChatRoom.objects.create()
+        self.chat.participants.add(self.user)
+
+    def test_message_event_uses_variant(self):
+        message = Message.objects.create(chat=self.chat, sender=self.user, content='привет')
+        event = message_event(Message.objects.select_related('sender', 'media_file').get(pk=message.pk))
+        self.assertTrue(event['sender_avatar'].endswith('avatars/v/medium.webp'))
+
+    def test_chat_media_sender_uses_variant(self):
+        MediaFile.objects.create(
+            chat=self.chat, sender=self.user, file='chat_1/image/a.jpg',
+            file_type='image', file_name='a.jpg', file_size=1,
+        )
+        self.client.force_login(self.user)
+        response = self.client.get(reverse('get_chat_media', args=[self.chat.id]))
+        sender = response.json()['media'][0]['sender']
+        self.assertTrue(sender['avatar'].endswith('avatars/v/medium.webp'))
+
+    def test_without_variants_or_avatar(self):
+        CustomUser.objects.filter(pk=self.user.pk).update(avatar_variants={})
+        self.user.refresh_from_db()
+        message = Message.objects.create(chat=self.chat, sender=self.user, content='привет')
+        self.assertTrue(message_event(message)['sender_avatar'].endswith('avatars/original.png'))
+        CustomUser.objects.filter(pk=self.user.pk).update(avatar='')
+        message.sender.refresh_from_db()
+        self.assertIsNone(message_event(message)['sender_avatar'])
@@ -13,6 +13,18 @@ urlpatterns = [
     path('search/', views.search_users, name='search_users'),
     path('unread-count/', views.get_unread_count, name='unread_count'),
 
+    # ==================== СООБЩЕНИЯ ====================
+    # Правка, удаление у всех и отзыв отправленного сообщения
+    path('message/<int:message_id>/edit/',
+         views.edit_message,
+         name='edit_message'),
+    path('message/<int:message_id>/delete/',
+         views.delete_message,
+         name='delete_message'),
+    path('message/<int:message_id>/unsend/',
+         views.unsend_message,
+         name='unsend_message'),
+
     # ==================== MEDIA URLS ====================
     # Загрузка медиафайлов
     path('chat/<int:chat_id>/upload-media/',
@@ -24,6 +36,14 @@ urlpatterns = [
          views.upload_voice_message,
          name='upload_voice'),
 
+    # Прямая загрузка в объектное хранилище: подписанная форма и подтверждение
+    path('chat/<int:chat_id>/upload-url/',
+         views.upload_url,
+         name='upload_url'),
+    path('chat/<int:chat_id>/upload-confirm/',
+         views.confirm_upload,
+         name='confirm_upload'),
+
     # Получение медиафайлов чата (API)
     path('chat/<int:chat_id>/media/',
          views.get_chat_media,
@@ -48,6 +68,32 @@ urlpatterns = [
     path('chat/<int:chat_id>/gallery/',
          views.media_gallery,
          name='media_gallery'),
+
+    # Дельта-синхронизация по токену
+    path('sync/',
+         views.sync_changes,
+         name='sync'),
+
+    # Шард-владелец чата (при шардировании по процессам)
+    path('chat/<int:chat_id>/shard/',
+         views.chat_shard,
+         name='chat_shard'),
+
+    # Экспорт истории чата (JSON Lines / ZIP с медиа)
+    path('chat/<int:chat_id>/export/',
+         views.export_chat,
+         name='export_chat'),
+
+    # ==================== СЛУЖЕБНЫЕ URL ====================
+    # Метрики Prometheus
+    path('internal/metrics/',
+         views.metrics_view,
+         name='metrics'),
+
+    # Профиль процесса по подписанной ссылке
+    path('internal/profile/',
+         views.profile_view,
+         name='profile_process'),
 ]
 
 # Добавляем маршруты для медиафайлов в режиме DEBUG
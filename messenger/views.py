@@ -1,12 +1,19 @@
 from django.shortcuts import render, redirect, get_object_or_404
 from django.contrib.auth.decorators import login_required
-from django.http import JsonResponse, HttpResponse, FileResponse
-from django.db.models import Q, Max, Count
+from django.http import JsonResponse, HttpResponse, HttpResponseRedirect, FileResponse, StreamingHttpResponse
+from django.db import IntegrityError, transaction
+from django.db.models import Q, Max, Count, OuterRef, Subquery
 from django.contrib.auth import get_user_model
 from django.views.decorators.csrf import csrf_exempt
 from django.conf import settings
 from django.utils import timezone
+from django.utils.functional import SimpleLazyObject
+from django.core import signing
+from django.core.files.storage import default_storage
+from asgiref.sync import sync_to_async
+import hmac
 import json
+import math
 import os
 import mimetypes
 import io
@@ -14,23 +21,37 @@ import subprocess
 import tempfile
 from pathlib import Path
 import struct
+import time
 
-from .models import ChatRoom, Message, Contact, MediaFile
+from PIL import Image
+
+from .models import ChatRoom, Message, Contact, MediaFile, media_upload_path
+from .events import message_event
+from . import editing, export, fragment_cache, idempotency, media_gc, media_processing, metrics, outbox, placeholders, profiling, quotas, ratelimit, sharding, storage, sync
+from accounts.avatars import json_avatar_url
 from accounts.models import CustomUser
 
 User = get_user_model()
 
+VOICE_MESSAGE_TEXT = '🎤 Голосовое сообщение'
+UPLOAD_TOKEN_SALT = 'messenger.upload'
+
 
 # ==================== ОСНОВНЫЕ VIEWS ====================
 
 @login_required
 def chat_list(request):
     """Список чатов пользователя"""
-    chats = ChatRoom.objects.filter(participants=request.user).annotate(
-        last_message_time=Max('messages__timestamp')
-    ).order_by('-last_message_time', '-updated_at')
+    chats = list(ChatRoom.objects.filter(participants=request.user).annotate(
+        last_message_time=Max('messages__timestamp'),
+        last_message_id=Max('messages__id'),
+        # Имя автора последнего сообщения входит в строку группового чата
+        last_sender_id=Subquery(
+            Message.objects.filter(chat=OuterRef('pk')).order_by('-id').values('sender_id')[:1]
+        ),
+    ).order_by('-last_message_time', '-updated_at').prefetch_related('participants'))
 
-    return render(request, 'messenger/chat_list.html', {'chats': chats})
+    return render(request, 'messenger/chat_list.html', {'rows': chat_list_rows(request.user, chats)})
 
 
 @login_required
@@ -39,10 +60,18 @@ def chat_detail(request, chat_id):
     chat = get_object_or_404(ChatRoom, id=chat_id, participants=request.user)
     messages = chat.messages.select_related('sender', 'media_file').order_by('timestamp')
 
+    max_file_size = 50 * 1024 * 1024  # 50MB
     return render(request, 'messenger/chat_detail.html', {
         'chat': chat,
         'messages': messages,
-        'max_file_size': 50 * 1024 * 1024,  # 50MB
+        # Параметры для static/js/chat.js
+        'chat_config': {
+            'chat_id': chat.id,
+            'user_id': request.user.id,
+            'username': request.user.username,
+            'max_file_size': max_file_size,
+            'last_seq': chat.last_seq,
+        },
     })
 
 
@@ -127,6 +156,52 @@ def get_unread_count(request):
     return JsonResponse({'unread_count': unread_count})
 
 
+# ==================== СООБЩЕНИЯ ====================
+
+@login_required
+def edit_message(request, message_id):
+    """Новый текст сообщения (POST content)"""
+    return change_message(request, message_id, 'edit')
+
+
+@login_required
+def delete_message(request, message_id):
+    """Удаление сообщения у всех участников"""
+    return change_message(request, message_id, 'delete')
+
+
+@login_required
+def unsend_message(request, message_id):
+    """Отзыв недавно отправленного сообщения"""
+    return change_message(request, message_id, 'unsend')
+
+
+def change_message(request, message_id, action):
+    """
+    Действие messenger.editing; событие message_patch публикуется
+    через outbox после коммита той же транзакции.
+    """
+    if request.method not in ['DELETE', 'POST'] or (action == 'edit' and request.method != 'POST'):
+        return JsonResponse({
+            'success': False,
+            'error': 'Метод не разрешен'
+        }, status=405)
+
+    try:
+        with transaction.atomic():
+            group_name, event = editing.perform(request.user, message_id, action, request.POST.get('content', ''))
+            outbox.enqueue(group_name, event)
+            if action != 'edit':
+                media_gc.schedule()
+    except editing.EditRejected as error:
+        return JsonResponse({
+            'success': False,
+            'error': error.code
+        }, status=error.status)
+
+    return JsonResponse({'success': True, **event})
+
+
 # ==================== MEDIA VIEWS ====================
 
 @login_required
@@ -141,6 +216,7 @@ def upload_media(request, chat_id):
             'error': 'Метод не разрешен'
         }, status=405)
 
+    started = time.perf_counter()
     try:
         chat = get_object_or_404(ChatRoom, id=chat_id, participants=request.user)
 
@@ -153,6 +229,12 @@ def upload_media(request, chat_id):
         uploaded_file = request.FILES['file']
         caption = request.POST.get('caption', '').strip()
 
+        # Повтор после таймаута: второй раз файл не сохраняем
+        client_id = idempotency.clean(request.POST.get('client_id'))
+        ack = previous_upload(chat.id, request.user.id, client_id)
+        if ack is not None:
+            return duplicate_upload_response(ack)
+
         # Проверка размера файла (макс 50MB)
         max_size = 50 * 1024 * 1024
         if uploaded_file.size > max_size:
@@ -161,6 +243,14 @@ def upload_media(request, chat_id):
                 'error': f'Файл слишком большой. Максимальный размер: 50MB'
             }, status=400)
 
+        retry_after = check_upload_rate(request.user.id, chat.id, uploaded_file.size)
+        if retry_after is not None:
+            return rate_limited_response(retry_after)
+
+        quota_error = quotas.check(request.user.id, chat.id, uploaded_file.size)
+        if quota_error:
+            return quota_exceeded_response(quota_error)
+
         # Определяем тип файла по расширению
         file_type, mime_type = determine_file_type_by_extension(uploaded_file.name)
 
@@ -170,34 +260,36 @@ def upload_media(request, chat_id):
                 'error': 'Тип файла не поддерживается'
             }, status=400)
 
-        # Создаем миниатюру для изображений
+        # Создаем миниатюру, размеры и заглушку для изображений
         thumbnail = None
+        width = height = None
+        placeholder = ''
         if file_type == 'image':
             thumbnail = create_image_thumbnail(uploaded_file)
+            width, height, placeholder = placeholders.image_info(uploaded_file)
 
-        # Создаем запись в базе данных
-        media_file = MediaFile.objects.create(
-            chat=chat,
-            sender=request.user,
+        # Создаем запись в базе данных и сообщение с медиафайлом
+        message, ack = save_media_message(
+            chat, request.user, client_id, caption,
             file=uploaded_file,
             file_type=file_type,
             file_name=uploaded_file.name,
             file_size=uploaded_file.size,
             mime_type=mime_type,
             caption=caption,
-            thumbnail=thumbnail
-        )
-
-        # Создаем сообщение с медиафайлом
-        message = Message.objects.create(
-            chat=chat,
-            sender=request.user,
-            content=caption,
-            media_file=media_file
+            thumbnail=thumbnail,
+            width=width,
+            height=height,
+            placeholder=placeholder,
         )
+        if ack is not None:
+            return duplicate_upload_response(ack)
+        media_file = message.media_file
 
         # Обновляем статистику чата
         chat.update_media_stats()
+        observe_upload(file_type, uploaded_file.size, started)
+        media_processing.schedule(media_file)
 
         # Подготавливаем данные для ответа
         response_data = {
@@ -207,6 +299,7 @@ def upload_media(request, chat_id):
                 'id': message.id,
                 'sender_id': request.user.id,
                 'sender_username': request.user.username,
+                'sender_avatar': json_avatar_url(request.user),
                 'content': caption,
                 'timestamp': message.timestamp.isoformat(),
                 'message_type': file_type,
@@ -220,6 +313,9 @@ def upload_media(request, chat_id):
                 'name': media_file.file_name,
                 'size': media_file.get_file_size_display(),
                 'caption': caption,
+                'width': width,
+                'height': height,
+                'placeholder': placeholder,
             }
         }
 
@@ -244,6 +340,7 @@ def upload_voice_message(request, chat_id):
             'error': 'Метод не разрешен'
         }, status=405)
 
+    started = time.perf_counter()
     try:
         chat = get_object_or_404(ChatRoom, id=chat_id, participants=request.user)
 
@@ -256,6 +353,11 @@ def upload_voice_message(request, chat_id):
         audio_file = request.FILES['voice']
         duration = int(request.POST.get('duration', 0))
 
+        client_id = idempotency.clean(request.POST.get('client_id'))
+        ack = previous_upload(chat.id, request.user.id, client_id)
+        if ack is not None:
+            return duplicate_upload_response(ack)
+
         # Проверка размера (макс 10MB для голосовых)
         if audio_file.size > 10 * 1024 * 1024:
             return JsonResponse({
@@ -263,15 +365,22 @@ def upload_voice_message(request, chat_id):
                 'error': 'Голосовое сообщение слишком большое'
             }, status=400)
 
+        retry_after = check_upload_rate(request.user.id, chat.id, audio_file.size)
+        if retry_after is not None:
+            return rate_limited_response(retry_after)
+
+        quota_error = quotas.check(request.user.id, chat.id, audio_file.size)
+        if quota_error:
+            return quota_exceeded_response(quota_error)
+
         # Создаем уникальное имя файла
         original_name = audio_file.name
         if not original_name.lower().endswith(('.webm', '.mp3', '.wav', '.ogg', '.m4a')):
             original_name = f"voice_{int(timezone.now().timestamp())}.webm"
 
-        # Создаем запись в базе данных
-        media_file = MediaFile.objects.create(
-            chat=chat,
-            sender=request.user,
+        # Создаем запись в базе данных и сообщение
+        message, ack = save_media_message(
+            chat, request.user, client_id, VOICE_MESSAGE_TEXT,
             file=audio_file,
             file_type='voice',
             file_name=original_name,
@@ -279,17 +388,15 @@ def upload_voice_message(request, chat_id):
             mime_type='audio/webm',
             duration=duration
         )
-
-        # Создаем сообщение
-        message = Message.objects.create(
-            chat=chat,
-            sender=request.user,
-            content='🎤 Голосовое сообщение',
-            media_file=media_file
-        )
+        if ack is not None:
+            return duplicate_upload_response(ack)
+        media_file = message.media_file
 
         # Обновляем статистику чата
         chat.update_media_stats()
+        observe_upload('voice', audio_file.size, started)
+        # Длительность от клиента - предварительная, точную даст ffprobe
+        media_processing.schedule(media_file)
 
         return JsonResponse({
             'success': True,
@@ -298,7 +405,8 @@ def upload_voice_message(request, chat_id):
                 'id': message.id,
                 'sender_id': request.user.id,
                 'sender_username': request.user.username,
-                'content': '🎤 Голосовое сообщение',
+                'sender_avatar': json_avatar_url(request.user),
+                'content': VOICE_MESSAGE_TEXT,
                 'timestamp': message.timestamp.isoformat(),
                 'message_type': 'voice',
                 'has_media': True,
@@ -318,6 +426,175 @@ def upload_voice_message(request, chat_id):
         }, status=500)
 
 
+@login_required
+def upload_url(request, chat_id):
+    """
+    Прямая загрузка в объектное хранилище, шаг 1: подписанная форма для
+    бакета и токен для подтверждения (messenger.storage).
+    POST: file_name, file_size, caption, client_id; voice=1 и duration - голосовое.
+    """
+    if request.method != 'POST':
+        return JsonResponse({
+            'success': False,
+            'error': 'Метод не разрешен'
+        }, status=405)
+
+    if not storage.is_object_store():
+        # Клиент загружает через upload-media / upload-voice
+        return JsonResponse({
+            'success': False,
+            'error': 'Хранилище не поддерживает прямую загрузку'
+        }, status=501)
+
+    chat = get_object_or_404(ChatRoom, id=chat_id, participants=request.user)
+    file_name = os.path.basename(request.POST.get('file_name', '')).strip()
+    try:
+        file_size = int(request.POST.get('file_size', ''))
+    except ValueError:
+        file_size = 0
+    if not file_name or file_size <= 0:
+        return JsonResponse({
+            'success': False,
+            'error': 'Нужны имя и размер файла'
+        }, status=400)
+
+    voice = request.POST.get('voice') == '1'
+    client_id = idempotency.clean(request.POST.get('client_id'))
+    ack = previous_upload(chat.id, request.user.id, client_id)
+    if ack is not None:
+        return duplicate_upload_response(ack)
+
+    # Те же ограничения размера, что и у загрузки через сервер
+    max_size = (10 if voice else 50) * 1024 * 1024
+    if file_size > max_size:
+        return JsonResponse({
+            'success': False,
+            'error': f'Файл слишком большой. Максимальный размер: {max_size // (1024 * 1024)}MB'
+        }, status=400)
+
+    retry_after = check_upload_rate(request.user.id, chat.id, file_size)
+    if retry_after is not None:
+        return rate_limited_response(retry_after)
+
+    quota_error = quotas.check(request.user.id, chat.id, file_size)
+    if quota_error:
+        return quota_exceeded_response(quota_error)
+
+    if voice:
+        file_type, mime_type = 'voice', 'audio/webm'
+    else:
+        file_type, mime_type = determine_file_type_by_extension(file_name)
+        if not file_type:
+            return JsonResponse({
+                'success': False,
+                'error': 'Тип файла не поддерживается'
+            }, status=400)
+
+    key = media_upload_path(MediaFile(chat=chat, sender=request.user, file_type=file_type), file_name)
+    token = signing.dumps({
+        'chat': chat.id,
+        'user': request.user.id,
+        'key': key,
+        'type': file_type,
+        'mime': mime_type,
+        'name': file_name,
+        'size': file_size,
+        'caption': request.POST.get('caption', '').strip(),
+        'duration': int(request.POST.get('duration') or 0) if voice else 0,
+        'client_id': client_id,
+    }, salt=UPLOAD_TOKEN_SALT, compress=True)
+
+    return JsonResponse({
+        'success': True,
+        'upload': storage.presigned_upload(key, mime_type, file_size),
+        'token': token,
+        'expires_in': storage.presigned_upload_seconds(),
+    })
+
+
+@login_required
+def confirm_upload(request, chat_id):
+    """
+    Прямая загрузка, шаг 2: файл уже в бакете - создаем медиафайл и
+    сообщение по метаданным из подписанного токена. Байты через Django не идут.
+    """
+    if request.method != 'POST':
+        return JsonResponse({
+            'success': False,
+            'error': 'Метод не разрешен'
+        }, status=405)
+
+    started = time.perf_counter()
+    chat = get_object_or_404(ChatRoom, id=chat_id, participants=request.user)
+    try:
+        # Загрузка могла начаться в последнюю секунду действия формы
+        data = signing.loads(
+            request.POST.get('token', ''),
+            salt=UPLOAD_TOKEN_SALT,
+            max_age=2 * storage.presigned_upload_seconds(),
+        )
+    except signing.BadSignature:
+        return JsonResponse({
+            'success': False,
+            'error': 'Недействительный или просроченный токен загрузки'
+        }, status=400)
+    if data['chat'] != chat.id or data['user'] != request.user.id:
+        return JsonResponse({
+            'success': False,
+            'error': 'Токен выдан для другого чата'
+        }, status=400)
+
+    client_id = data['client_id']
+    ack = previous_upload(chat.id, request.user.id, client_id)
+    if ack is None:
+        # Повторное подтверждение того же объекта
+        original = Message.objects.filter(media_file__file=data['key']).first()
+        if original is not None:
+            ack = idempotency.message_ack(original)
+    if ack is not None:
+        return duplicate_upload_response(ack)
+
+    key = data['key']
+    if not default_storage.exists(key) or default_storage.size(key) != data['size']:
+        return JsonResponse({
+            'success': False,
+            'error': 'Файл не загружен в хранилище'
+        }, status=400)
+
+    # Квота могла закончиться, пока файл загружался
+    quota_error = quotas.check(request.user.id, chat.id, data['size'])
+    if quota_error:
+        default_storage.delete(key)
+        return quota_exceeded_response(quota_error)
+
+    voice = data['type'] == 'voice'
+    caption = data['caption']
+    message, ack = save_media_message(
+        chat, request.user, client_id, VOICE_MESSAGE_TEXT if voice else caption,
+        # Объект останется в бакете: на него может ссылаться исходная загрузка
+        discard_on_conflict=False,
+        file=key,
+        file_type=data['type'],
+        file_name=data['name'],
+        file_size=data['size'],
+        mime_type=data['mime'],
+        caption='' if voice else caption,
+        duration=data['duration'],
+    )
+    if ack is not None:
+        return duplicate_upload_response(ack)
+
+    chat.update_media_stats()
+    observe_upload(data['type'], data['size'], started)
+    # Размеры, заглушку и метаданные читаем из хранилища в фоне
+    media_processing.schedule(message.media_file)
+
+    return JsonResponse({
+        'success': True,
+        **idempotency.message_ack(message),
+    })
+
+
 @login_required
 def media_gallery(request, chat_id):
     """
@@ -390,11 +667,15 @@ def get_chat_media(request, chat_id):
             'name': media.file_name,
             'size': media.get_file_size_display(),
             'duration': media.duration,
+            'width': media.width,
+            'height': media.height,
+            'placeholder': media.placeholder,
             'caption': media.caption,
             'timestamp': media.uploaded_at.isoformat(),
             'sender': {
                 'id': media.sender.id,
                 'username': media.sender.username,
+                'avatar': json_avatar_url(media.sender),
             },
         })
 
@@ -425,14 +706,7 @@ def download_media(request, media_id):
     media_file.increment_downloads()
 
     # Отдаем файл
-    response = FileResponse(media_file.file.open('rb'))
-
-    # Угадываем MIME тип по расширению
-    mime_type, _ = mimetypes.guess_type(media_file.file_name)
-    response['Content-Type'] = mime_type or 'application/octet-stream'
-    response['Content-Disposition'] = f'attachment; filename="{media_file.file_name}"'
-
-    return response
+    return media_file_response(media_file, inline=False)
 
 
 @login_required
@@ -450,14 +724,7 @@ def view_media(request, media_id):
     media_file.increment_views()
 
     # Отдаем файл
-    response = FileResponse(media_file.file.open('rb'))
-
-    # Угадываем MIME тип
-    mime_type, _ = mimetypes.guess_type(media_file.file_name)
-    response['Content-Type'] = mime_type or 'application/octet-stream'
-    response['Content-Disposition'] = f'inline; filename="{media_file.file_name}"'
-
-    return response
+    return media_file_response(media_file, inline=True)
 
 
 @login_required
@@ -475,8 +742,9 @@ def delete_media(request, media_id):
     try:
         media_file = get_object_or_404(MediaFile, id=media_id, sender=request.user)
 
-        # Мягкое удаление
+        # Мягкое удаление; байты удалит сборщик мусора после срока
         media_file.soft_delete()
+        media_gc.schedule()
 
         # Обновляем статистику чата
         media_file.chat.update_media_stats()
@@ -493,8 +761,298 @@ def delete_media(request, media_id):
         }, status=500)
 
 
+# ==================== СИНХРОНИЗАЦИЯ ====================
+
+@login_required
+def sync_changes(request):
+    """
+    Изменения во всех чатах пользователя после токена (messenger.sync).
+    Без токена - только токен текущей позиции.
+    """
+    token = request.GET.get('token')
+    if not token:
+        return JsonResponse({
+            'success': True,
+            'changes': [],
+            'has_more': False,
+            'token': sync.make_token(request.user.id, *sync.current_position(request.user)),
+        })
+
+    try:
+        seq, recent = sync.read_token(token, request.user.id)
+    except signing.SignatureExpired:
+        # Журнал за этот период уже очищен - нужна полная загрузка
+        return JsonResponse({'success': False, 'error': 'resync_required'}, status=410)
+    except signing.BadSignature:
+        return JsonResponse({'success': False, 'error': 'Неверный токен'}, status=400)
+
+    changes, seq, recent, has_more = sync.changes_since(request.user, seq, recent)
+    return JsonResponse({
+        'success': True,
+        'changes': changes,
+        'has_more': has_more,
+        'token': sync.make_token(request.user.id, seq, recent),
+    })
+
+
+# ==================== ШАРДИРОВАНИЕ ====================
+
+@login_required
+def chat_shard(request, chat_id):
+    """Шард-владелец чата и адрес его WebSocket (messenger.sharding)"""
+    get_object_or_404(ChatRoom, id=chat_id, participants=request.user)
+    shard = sharding.owner(chat_id)
+    return JsonResponse({
+        'success': True,
+        'sharded': shard is not None,
+        'shard': shard,
+        'url': sharding.chat_url(chat_id, shard) if shard else None,
+    })
+
+
+# ==================== ЭКСПОРТ ====================
+
+@login_required
+def export_chat(request, chat_id):
+    """
+    Выгрузка истории чата потоком: ?format=jsonl (по умолчанию) или zip
+    (с медиафайлами), ?after=<id сообщения> - продолжить после него.
+    Потоком и под ASGI, и под WSGI (export.stream).
+    """
+    chat = get_object_or_404(ChatRoom, id=chat_id, participants=request.user)
+
+    export_format = request.GET.get('format', 'jsonl')
+    if export_format not in ('jsonl', 'zip'):
+        return JsonResponse({'success': False, 'error': 'Неизвестный формат'}, status=400)
+
+    after = request.GET.get('after')
+    if after is not None:
+        try:
+            after = int(after)
+            export.export_messages(chat, after)
+        except (ValueError, Message.DoesNotExist):
+            return JsonResponse({'success': False, 'error': 'Сообщение не найдено'}, status=400)
+
+    if export_format == 'zip':
+        content, content_type = export.iter_zip(chat, after), 'application/zip'
+    else:
+        content, content_type = export.iter_jsonl(chat, after), 'application/x-ndjson'
+
+    response = StreamingHttpResponse(export.stream(request, content), content_type=content_type)
+    suffix = f'_after_{after}' if after is not None else ''
+    response['Content-Disposition'] = f'attachment; filename="chat_{chat.id}{suffix}.{export_format}"'
+    return response
+
+
+# ==================== СЛУЖЕБНЫЕ VIEWS ====================
+
+def metrics_view(request):
+    """
+    Метрики процесса для Prometheus.
+    Доступ с заголовком Authorization: Bearer METRICS_TOKEN или для персонала.
+    Адресу клиента не доверяем: за прокси REMOTE_ADDR - адрес прокси.
+    """
+    if not request.user.is_staff and not has_metrics_token(request):
+        return HttpResponse(status=403)
+    return HttpResponse(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+def has_metrics_token(request):
+    """Bearer-токен сборщика совпадает с METRICS_TOKEN (пустой - доступ только персоналу)"""
+    token = getattr(settings, 'METRICS_TOKEN', '')
+    scheme, _, value = request.headers.get('Authorization', '').partition(' ')
+    return bool(token) and scheme.lower() == 'bearer' and hmac.compare_digest(value.strip().encode(), token.encode())
+
+
+async def profile_view(request):
+    """
+    Съемка профиля этого процесса по подписанной одноразовой ссылке
+    (manage.py profile --token). Отвечает стеками в формате collapsed
+    после окончания окна съемки; interval - секунд между снимками.
+    """
+    if not getattr(settings, 'PROFILER_ENABLED', False):
+        return HttpResponse(status=404)
+    try:
+        seconds = profiling.check_token(request.GET.get('token', ''))
+    except signing.BadSignature:
+        return HttpResponse(status=403)
+
+    try:
+        sampler = profiling.start(seconds, request.GET.get('interval'))
+    except profiling.ProfilerBusy as e:
+        return JsonResponse({'success': False, 'error': str(e)}, status=409)
+    except ValueError as e:
+        return JsonResponse({'success': False, 'error': str(e)}, status=400)
+    # Ждем в отдельном потоке, чтобы не занимать поток синхронных представлений
+    await sync_to_async(profiling.finish, thread_sensitive=False)(sampler)
+    response = HttpResponse(sampler.collapsed(), content_type='text/plain; charset=utf-8')
+    response['X-Profile-Samples'] = str(sampler.samples)
+    return response
+
+
 # ==================== ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ ====================
 
+def chat_list_rows(user, chats):
+    """
+    Строки списка чатов из кэша фрагментов: [(чат, html)].
+    Ключ строки зависит от версии чата и собеседника, а в групповом чате -
+    от версии автора последнего сообщения (chat.last_sender_id); последние
+    сообщения для промахов загружаются одним запросом.
+    """
+    others = {}
+    for chat in chats:
+        if not chat.is_group:
+            others[chat.id] = next((p for p in chat.participants.all() if p.id != user.id), None)
+    senders = {
+        chat.id: chat.last_sender_id
+        for chat in chats
+        if chat.is_group and chat.last_sender_id
+    }
+
+    chat_versions = fragment_cache.get_versions('chat', [chat.id for chat in chats])
+    user_versions = fragment_cache.get_versions(
+        'user',
+        {other.id for other in others.values() if other} | set(senders.values()),
+    )
+    last_messages = SimpleLazyObject(lambda: Message.objects.select_related('sender').in_bulk(
+        [chat.last_message_id for chat in chats if chat.last_message_id]
+    ))
+
+    items = []
+    for chat in chats:
+        other = others.get(chat.id)
+        key = f'{user.id}:{chat.id}:{chat_versions[chat.id]}'
+        if other:
+            key += f':{other.id}:{user_versions[other.id]}'
+        elif chat.id in senders:
+            key += f':s{senders[chat.id]}:{user_versions[senders[chat.id]]}'
+        items.append((key, 'messenger/chat_row.html', lambda chat=chat, other=other: {
+            'chat': chat,
+            'other': other,
+            'last_message': last_messages.get(chat.last_message_id),
+        }))
+    return list(zip(chats, fragment_cache.get_or_render('chat_row', items)))
+
+
+def check_upload_rate(user_id, chat_id, size):
+    """Лимиты на число загрузок и на объем. None - можно загружать"""
+    retry_after = ratelimit.check('upload', user_id, chat_id)
+    if retry_after is not None:
+        return retry_after
+    retry_after = ratelimit.check('upload_bytes', user_id, chat_id, cost=size)
+    if retry_after is not None:
+        # Загрузка отклонена по объему: попытка не считается
+        ratelimit.refund('upload', user_id, chat_id)
+    return retry_after
+
+
+def rate_limited_response(retry_after):
+    """Ответ 429 с заголовком Retry-After"""
+    retry_after = math.ceil(retry_after)
+    response = JsonResponse({
+        'success': False,
+        'error': 'Слишком много запросов, попробуйте позже',
+        'retry_after': retry_after,
+    }, status=429)
+    response['Retry-After'] = str(retry_after)
+    return response
+
+
+def previous_upload(chat_id, user_id, client_id):
+    """Подтверждение уже сохраненной загрузки с этим client_id или None"""
+    if not client_id:
+        return None
+    ack = idempotency.recent(chat_id, user_id, client_id)
+    if ack is None:
+        original = idempotency.find(chat_id, user_id, client_id)
+        if original is not None:
+            idempotency.remember(original)
+            ack = idempotency.message_ack(original)
+    return ack
+
+
+def save_media_message(chat, user, client_id, content, discard_on_conflict=True, **media_fields):
+    """
+    Медиафайл, сообщение и событие для чата - в одной транзакции: после
+    коммита событие сразу уходит в группу (messenger.outbox).
+    (сообщение, None) или (None, подтверждение исходного) при повторе client_id.
+    """
+    media_file = None
+    try:
+        with transaction.atomic():
+            media_file = MediaFile.objects.create(chat=chat, sender=user, **media_fields)
+            message = Message.objects.create(
+                chat=chat,
+                sender=user,
+                content=content,
+                media_file=media_file,
+                client_id=client_id,
+            )
+            outbox.enqueue(chat.group_name, message_event(message), key=outbox.message_key(message.id))
+    except IntegrityError:
+        # Параллельный повтор той же загрузки успел сохраниться первым
+        if discard_on_conflict:
+            discard_media_files(media_file)
+        ack = previous_upload(chat.id, user.id, client_id)
+        if ack is None:
+            raise
+        return None, ack
+    idempotency.remember(message)
+    return message, None
+
+
+def duplicate_upload_response(ack):
+    """Ответ на повтор загрузки: исходное сообщение, файл повторно не сохраняется"""
+    return JsonResponse({'success': True, 'duplicate': True, **ack})
+
+
+def discard_media_files(media_file):
+    """Удаляет с диска файлы медиафайла, запись которого откатилась"""
+    if media_file is None:
+        return
+    media_file.file.delete(save=False)
+    if media_file.thumbnail:
+        media_file.thumbnail.delete(save=False)
+
+
+def media_file_response(media_file, inline):
+    """
+    Содержимое файла после проверки прав: редирект на подписанную ссылку
+    бакета, X-Accel-Redirect для nginx или поток из Django (messenger.storage)
+    """
+    # Угадываем MIME тип по расширению
+    mime_type, _ = mimetypes.guess_type(media_file.file_name)
+    mime_type = mime_type or 'application/octet-stream'
+    disposition = 'inline' if inline else 'attachment'
+
+    url = storage.signed_url(media_file.file, media_file.file_name, mime_type, inline)
+    if url:
+        return HttpResponseRedirect(url)
+
+    internal_path = storage.accel_redirect(media_file.file)
+    if internal_path:
+        response = HttpResponse(content_type=mime_type)
+        response['X-Accel-Redirect'] = internal_path
+    else:
+        response = FileResponse(media_file.file.open('rb'), content_type=mime_type)
+    response['Content-Disposition'] = f'{disposition}; filename="{media_file.file_name}"'
+    return response
+
+
+def quota_exceeded_response(error):
+    """Ответ 413: файл не помещается в квоту пользователя или чата"""
+    return JsonResponse({
+        'success': False,
+        'error': error,
+    }, status=413)
+
+
+def observe_upload(file_type, size, started):
+    """Объем и длительность успешной загрузки в метрики"""
+    metrics.upload_bytes.labels(file_type).inc(size)
+    metrics.upload_seconds.labels(file_type).observe(time.perf_counter() - started)
+
+
 def determine_file_type_by_extension(filename):
     """
     Определяет тип файла по расширению
@@ -570,6 +1128,7 @@ def create_image_thumbnail(file):
     """
     Создает миниатюру для изображения
     """
+    started = time.perf_counter()
     try:
         # Проверяем, что это изображение
         if not is_valid_image(file):
@@ -601,6 +1160,7 @@ def create_image_thumbnail(file):
         thumbnail_file = ContentFile(buffer.read())
         thumbnail_file.name = f"thumb_{int(timezone.now().timestamp())}.jpg"
 
+        metrics.thumbnail_seconds.observe(time.perf_counter() - started)
         return thumbnail_file
 
     except Exception as e:
@@ -2,6 +2,7 @@
 Django settings for messenger_project project.
 """
 
+import json
 import os
 from pathlib import Path
 
@@ -32,6 +33,8 @@ INSTALLED_APPS = [
 
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
+    'messenger.querystats.QueryStatsMiddleware',
+    'messenger.profiling.ProfilerMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -74,11 +77,197 @@ CHANNEL_LAYERS = {
     }
 }
 
+# Кэш: память процесса; общий кэш (Redis) - если задан FRAGMENT_CACHE_REDIS_URL
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'messenger',
+        'OPTIONS': {'MAX_ENTRIES': 10000},
+    },
+}
+if os.environ.get('FRAGMENT_CACHE_REDIS_URL'):
+    CACHES['shared'] = {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': os.environ['FRAGMENT_CACHE_REDIS_URL'],
+    }
+
+# Кэш фрагментов (строки списка чатов, карточки пользователей)
+FRAGMENT_CACHE_SHARED = 'shared' if 'shared' in CACHES else None
+FRAGMENT_CACHE_LOCAL_TIMEOUT = 60     # секунд в памяти процесса
+FRAGMENT_CACHE_TIMEOUT = 3600         # секунд в общем кэше
+
+# Восстановление пропущенных сообщений при переподключении WebSocket
+CHAT_REPLAY_BUFFER_SIZE = 200   # событий в памяти на чат
+CHAT_REPLAY_MAX_ROOMS = 1000    # чатов с буфером в одном процессе
+CHAT_REPLAY_MAX_EVENTS = 500    # больше - клиенту отправляется resync_required
+CHAT_SEQ_GAP_TIMEOUT = 2        # сек.: номер, не пришедший из группы, дозапрашивается из базы
+
+# Мультиплексированное соединение ws/chats/
+CHAT_MUX_MAX_SUBSCRIPTIONS = 100  # чатов на одно соединение
+CHAT_MUX_DEFAULT_WINDOW = 100     # кредит подписки, если клиент не указал window
+CHAT_MUX_MAX_PENDING = 200        # событий в очереди подписки без кредита
+
+# Очередь отправки одного соединения (защита от медленных клиентов)
+CHAT_SEND_QUEUE_HIGH_WATERMARK = 100  # выше - отбрасываем события набора текста
+CHAT_SEND_QUEUE_LOW_WATERMARK = 20    # ниже - снова отправляем всё
+CHAT_SEND_QUEUE_MAX = 500             # схлопывание в resync_required, затем отключение
+CHAT_SEND_STALL_TIMEOUT = 30          # сек.: клиент не прочитал resync_required - отключаем
+CHAT_SEND_BUFFER_HIGH = 256 * 1024    # байт в буфере записи транспорта Daphne: выше - writer ждет клиента
+CHAT_SEND_BUFFER_LOW = 64 * 1024      # ... пока буфер не опустится до этого
+CHAT_SEND_DRAIN_INTERVAL = 0.05       # сек. между замерами буфера
+
+# Кадры клиента (messenger.protocol): больше - закрытие с кодом 1009
+CHAT_MAX_FRAME_SIZE = 256 * 1024  # байт, для deflate - после распаковки
+
+# Большие группы (messenger.broadcast): с этого числа участников события идут через хаб процесса
+CHAT_BROADCAST_THRESHOLD = 1000
+CHAT_BROADCAST_BUFFER = 1000     # событий в кольцевом буфере комнаты; отставшим - resync_required
+CHAT_BROADCAST_GROUP_REFRESH = None  # сек. между продлениями групп хаба; None - половина group_expiry слоя
+
+# Шардирование чатов по процессам (messenger.sharding). Выключено, пока не заданы
+# имя этого процесса и карта шардов {имя: "ws://host:port"} - в CHAT_SHARDS (JSON в
+# переменной окружения) или в файле CHAT_SHARD_MAP_FILE, который можно менять на ходу
+CHAT_SHARD_NAME = os.environ.get('CHAT_SHARD_NAME', '')
+CHAT_SHARDS = json.loads(os.environ.get('CHAT_SHARDS', '{}'))
+CHAT_SHARD_MAP_FILE = os.environ.get('CHAT_SHARD_MAP_FILE', '')
+CHAT_SHARD_MAP_CHECK_INTERVAL = 1.0   # сек. между проверками файла карты
+CHAT_SHARD_VNODES = 128               # виртуальных узлов на шард
+CHAT_SHARD_WATCH_INTERVAL = 5         # сек.: как быстро соединения переехавших чатов закрываются
+
+# Идемпотентная отправка (messenger.idempotency): недавних client_id в памяти процесса
+CHAT_CLIENT_ID_CACHE_SIZE = 10000
+
+# Отзыв сообщения (messenger.editing) возможен столько секунд после отправки
+CHAT_UNSEND_WINDOW = 15 * 60
+
+# Потоков для запросов к БД из консьюмеров (messenger.asyncdb); 0 - один общий поток channels.
+# SQLite все равно пишет по одной транзакции, и пул только добавляет ожидание блокировок;
+# для PostgreSQL - порядка числа соединений на процесс (сравнение: manage.py bench --ws-sweep)
+CHAT_DB_EXECUTOR_WORKERS = 0
+
+# Ограничение частоты: действие -> область -> (токенов в секунду, емкость)
+RATE_LIMIT_BACKEND = 'messenger.ratelimit.LocalBackend'  # или messenger.ratelimit.CacheBackend
+RATE_LIMITS = {
+    'message': {'user': (2, 20), 'room': (20, 100)},
+    'typing': {'user': (5, 10)},
+    'upload': {'user': (0.5, 10), 'room': (2, 30)},
+    # Байты загрузок: емкость не меньше максимального размера файла (50MB)
+    'upload_bytes': {'user': (1024 * 1024, 200 * 1024 * 1024), 'room': (5 * 1024 * 1024, 500 * 1024 * 1024)},
+}
+
+# Бюджеты SQL-запросов на представление / событие WebSocket (messenger.querystats).
+# В CI включайте QUERY_BUDGET_STRICT, чтобы превышение роняло тесты
+QUERY_BUDGETS = {
+    'chat_list': 6,
+    'sync': 7,
+    'chat_detail': 10,
+    'unread_count': 5,
+    'get_chat_media': 8,
+    'upload_media': 23,
+    'upload_voice': 23,
+    'ws:chat_message': 8,
+    'ws:typing': 0,
+}
+QUERY_BUDGET_STRICT = False
+QUERY_STATS_HEADERS = DEBUG
+
+# Метрики Prometheus (/internal/metrics/): сборщик передает Authorization: Bearer <токен>,
+# персоналу доступ есть всегда. Пустой токен - сборщику доступа нет
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
+
+# Семплирующий профилировщик (manage.py profile): выключен, пока не нужен
+PROFILER_ENABLED = False
+PROFILER_INTERVAL = 0.005        # секунд между снимками стеков (0.001-1)
+PROFILER_DEFAULT_SECONDS = 10
+PROFILER_MAX_SECONDS = 60
+PROFILER_TOKEN_MAX_AGE = 300     # срок действия подписанной ссылки, секунд
+PROFILER_TOKEN_CACHE = 'shared' if 'shared' in CACHES else 'default'  # использованные ссылки
+PROFILER_OUTPUT_DIR = BASE_DIR / 'profiles'
+
+# Outbox событий чата (messenger.outbox, manage.py relay_outbox)
+OUTBOX_RELAY_DELAY = 5          # сек.: более свежие события публикует само представление
+OUTBOX_RELAY_BATCH_SIZE = 100
+OUTBOX_MAX_ATTEMPTS = 10        # неудачных публикаций, после которых событие не досылается (dead letter)
+OUTBOX_RETENTION_HOURS = 24     # опубликованные события хранятся для проверки повторов
+
+# Дельта-синхронизация (messenger.sync, GET /sync/?token=...)
+SYNC_PAGE_SIZE = 200             # записей журнала на страницу
+SYNC_MAX_BYTES = 256 * 1024      # и не больше этого объема JSON
+SYNC_RESCAN_SECONDS = 60         # записи моложе просматриваются заново: поздний коммит не теряется
+SYNC_LOG_RETENTION_DAYS = 30     # срок хранения журнала и действия токена
+
+# Экспорт истории чата (messenger.export): сообщений на запрос к БД и размер буфера ответа
+EXPORT_CHUNK_SIZE = 500
+EXPORT_BUFFER_SIZE = 256 * 1024
+
+# Фоновые задачи процесса (messenger.background)
+BACKGROUND_WORKERS = 2
+BACKGROUND_TASKS_EAGER = False
+
+# Варианты аватаров: стороны квадрата в px и плотность экрана для выбора варианта
+AVATAR_SIZES = (64, 128, 256)
+AVATAR_DENSITY = 2
+AVATAR_JSON_SIZE = 40  # px: аватар в JSON-ответах и событиях WebSocket
+
+# Метаданные аудио/видео (messenger.media_processing)
+FFMPEG_BINARY = 'ffmpeg'
+FFPROBE_BINARY = 'ffprobe'
+MEDIA_PROCESSING_TIMEOUT = 120        # секунд на один вызов ffmpeg/ffprobe
+MEDIA_PROCESSING_CPU_SECONDS = 60     # лимит процессорного времени (prlimit)
+MEDIA_PROCESSING_MEMORY_MB = 512      # лимит адресного пространства (prlimit)
+MEDIA_POSTER_WIDTH = 640
+MEDIA_WAVEFORM_POINTS = 64
+MEDIA_WAVEFORM_MAX_SECONDS = 3600
+
+# Квоты на медиафайлы (messenger.quotas); None - без ограничения
+STORAGE_QUOTA_USER_BYTES = 2 * 1024 ** 3
+STORAGE_QUOTA_USER_FILES = None
+STORAGE_QUOTA_CHAT_BYTES = 10 * 1024 ** 3
+STORAGE_QUOTA_CHAT_FILES = None
+
+# Сборщик мусора медиафайлов (messenger.media_gc, manage.py gc_media)
+MEDIA_GC_GRACE_HOURS = 24            # мягко удаленные и файлы-сироты моложе - не трогаем
+MEDIA_GC_BATCH_SIZE = 500            # строк или путей за один запрос и одну контрольную точку
+MEDIA_GC_FILES_PER_SECOND = 50       # удалений в секунду; 0 - без ограничения
+MEDIA_GC_ROOTS = None                # каталоги хранилища для поиска сирот; None - корни upload_to всех FileField
+MEDIA_GC_INTERVAL = 3600             # сек. между фоновыми проходами; 0 - только командой
+MEDIA_GC_BACKGROUND_MAX_FILES = 1000  # файлов за фоновый проход, дальше - со следующего
+
+# Хранилище медиафайлов (messenger.storage). MEDIA_STORAGE=s3 - S3-совместимый бакет через
+# django-storages и boto3 (необязательные зависимости); для разработки AWS_S3_ENDPOINT_URL
+# указывает на локальный сервер (MinIO и т.п.)
+MEDIA_STORAGE = os.environ.get('MEDIA_STORAGE', 'filesystem')
+STORAGES = {
+    'default': {'BACKEND': 'django.core.files.storage.FileSystemStorage'},
+    # Имена с хэшем содержимого, .gz/.br при collectstatic (messenger.staticfiles)
+    'staticfiles': {'BACKEND': 'messenger.staticfiles.CompressedManifestStaticFilesStorage'},
+}
+if MEDIA_STORAGE == 's3':
+    STORAGES['default'] = {
+        'BACKEND': 'storages.backends.s3.S3Storage',
+        'OPTIONS': {
+            'bucket_name': os.environ.get('AWS_STORAGE_BUCKET_NAME', 'tax-media'),
+            'endpoint_url': os.environ.get('AWS_S3_ENDPOINT_URL') or None,
+            'region_name': os.environ.get('AWS_S3_REGION_NAME') or None,
+            'access_key': os.environ.get('AWS_ACCESS_KEY_ID'),
+            'secret_key': os.environ.get('AWS_SECRET_ACCESS_KEY'),
+            'signature_version': 's3v4',
+            'default_acl': None,            # бакет закрыт, доступ только по подписанным ссылкам
+            'file_overwrite': False,
+            'querystring_expire': 6 * 3600,  # ссылки в HTML и событиях чата
+        },
+    }
+MEDIA_SIGNED_URL_SECONDS = 300        # ссылка из view_media/download_media
+MEDIA_PRESIGNED_UPLOAD_SECONDS = 600  # форма прямой загрузки в бакет
+MEDIA_ACCEL_REDIRECT_PREFIX = ''      # напр. '/protected-media/' - локальные файлы отдает nginx
+
 # SQLite для простоты (оставьте как есть)
 DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        # Файл, а не память: живой сервер Daphne в тестах работает с той же базой
+        'TEST': {'NAME': BASE_DIR / 'test_db.sqlite3'},
     }
 }
 
@@ -106,6 +295,9 @@ USE_TZ = True
 STATIC_URL = 'static/'
 STATICFILES_DIRS = [BASE_DIR / 'static']
 STATIC_ROOT = BASE_DIR / 'staticfiles'
+# Статику из STATIC_ROOT отдает messenger.staticfiles.serve (False - отдает nginx)
+STATIC_SERVE = True
+STATIC_CACHE_MAX_AGE = 365 * 24 * 3600  # для имен с хэшем; остальные - no-cache
 
 MEDIA_URL = 'media/'
 MEDIA_ROOT = BASE_DIR / 'media'
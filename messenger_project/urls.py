@@ -1,8 +1,12 @@
+import re
+
 from django.contrib import admin
-from django.urls import path, include
+from django.urls import path, include, re_path
 from django.conf import settings
 from django.conf.urls.static import static
 
+from messenger import staticfiles
+
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('accounts/', include('accounts.urls')),
@@ -12,4 +16,9 @@ urlpatterns = [
 # Для обслуживания медиафайлов в разработке
 if settings.DEBUG:
     urlpatterns += static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
-    urlpatterns += static(settings.STATIC_URL, document_root=settings.STATIC_ROOT)
\ No newline at end of file
+
+# Статика с хэшами в именах: сжатые копии и долгий кэш (см. messenger.staticfiles)
+if getattr(settings, 'STATIC_SERVE', settings.DEBUG):
+    urlpatterns += [
+        re_path(r'^%s(?P<path>.*)$' % re.escape(settings.STATIC_URL.lstrip('/')), staticfiles.serve),
+    ]
\ No newline at end of file
@@ -0,0 +1,113 @@
+// Мобильное меню
+document.getElementById('mobile-menu-button').addEventListener('click', function() {
+    const menu = document.getElementById('mobile-menu');
+    const icon = this.querySelector('i');
+
+    if (menu.classList.contains('hidden')) {
+        menu.classList.remove('hidden');
+        icon.classList.remove('fa-bars');
+        icon.classList.add('fa-times');
+    } else {
+        menu.classList.add('hidden');
+        icon.classList.remove('fa-times');
+        icon.classList.add('fa-bars');
+    }
+});
+
+// Автоматическое скрытие уведомлений через 5 секунд
+setTimeout(function() {
+    const notifications = document.querySelectorAll('.notification');
+    notifications.forEach(function(notification) {
+        notification.style.opacity = '0';
+        setTimeout(function() {
+            notification.style.display = 'none';
+        }, 300);
+    });
+}, 5000);
+
+// Проверка непрочитанных сообщений
+const unreadCountUrl = document.body.dataset.unreadCountUrl;
+
+async function updateUnreadCount() {
+    try {
+        const response = await fetch(unreadCountUrl);
+        const data = await response.json();
+        const badge = document.getElementById('unread-badge');
+
+        if (data.unread_count > 0) {
+            badge.textContent = data.unread_count;
+            badge.classList.remove('hidden');
+        } else {
+            badge.classList.add('hidden');
+        }
+    } catch (error) {
+        console.log('Ошибка проверки непрочитанных сообщений:', error);
+    }
+}
+
+// Проверяем каждые 30 секунд
+if (unreadCountUrl !== '/unread-count/') {
+    updateUnreadCount();
+    setInterval(updateUnreadCount, 30000);
+}
+
+// Предотвращаем двойную отправку форм
+document.addEventListener('submit', function(e) {
+    const form = e.target;
+    const submitButton = form.querySelector('button[type="submit"]');
+
+    if (submitButton) {
+        submitButton.disabled = true;
+        submitButton.innerHTML = '<i class="fas fa-spinner fa-spin mr-2"></i>Отправка...';
+
+        // Восстанавливаем через 3 секунды на случай ошибки
+        setTimeout(function() {
+            submitButton.disabled = false;
+            submitButton.innerHTML = '<i class="fas fa-paper-plane mr-2"></i>Отправить';
+        }, 3000);
+    }
+});
+
+// Кнопка "Наверх"
+const scrollToTopButton = document.createElement('button');
+scrollToTopButton.innerHTML = '<i class="fas fa-arrow-up"></i>';
+scrollToTopButton.className = 'fixed bottom-6 right-6 bg-blue-600 text-white w-12 h-12 rounded-full shadow-lg hover:bg-blue-700 transition hidden z-40';
+scrollToTopButton.id = 'scroll-to-top';
+document.body.appendChild(scrollToTopButton);
+
+scrollToTopButton.addEventListener('click', function() {
+    window.scrollTo({ top: 0, behavior: 'smooth' });
+});
+
+window.addEventListener('scroll', function() {
+    if (window.scrollY > 300) {
+        scrollToTopButton.classList.remove('hidden');
+    } else {
+        scrollToTopButton.classList.add('hidden');
+    }
+});
+
+// Обнаружение устройства
+const isMobile = /Android|webOS|iPhone|iPad|iPod|BlackBerry|IEMobile|Opera Mini/i.test(navigator.userAgent);
+if (isMobile) {
+    document.documentElement.classList.add('mobile');
+} else {
+    document.documentElement.classList.add('desktop');
+}
+
+// Сохраняем позицию скролла при переходе
+document.addEventListener('click', function(e) {
+    const link = e.target.closest('a');
+    if (link && !link.target && !link.href.includes('#') && link.href.startsWith(window.location.origin)) {
+        sessionStorage.setItem('scrollPosition', window.scrollY);
+    }
+});
+
+// Восстанавливаем позицию скролла
+window.addEventListener('load', function() {
+    const savedPosition = sessionStorage.getItem('scrollPosition');
+    if (savedPosition) {
+        window.scrollTo(0, parseInt(savedPosition));
+        sessionStorage.removeItem('scrollPosition');
+    }
+});
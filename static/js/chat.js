@@ -0,0 +1,786 @@
+// ==================== ОСНОВНЫЕ ПЕРЕМЕННЫЕ ====================
+// Параметры чата из шаблона (json_script)
+const chatConfig = JSON.parse(document.getElementById('chat-config').textContent);
+const chatId = chatConfig.chat_id;
+const userId = chatConfig.user_id;
+const username = chatConfig.username;
+const maxFileSize = chatConfig.max_file_size;
+
+// WebSocket (переподключается сам, досылая пропущенное по lastSeq).
+// lastSeq - все номера до него получены; aheadSeqs - полученные сверх него:
+// события конкурентных отправителей приходят не строго по порядку
+let chatSocket;
+let lastSeq = chatConfig.last_seq;
+const aheadSeqs = new Set();
+let seqGapTimer = null;
+const SEQ_GAP_TIMEOUT = 10000;
+let reconnectDelay = 1000;
+// Адрес сокета чата; при шардировании сервер сообщает адрес владельца (wrong_shard)
+let socketUrl = `ws://${window.location.host}/ws/chat/${chatId}/`;
+
+// DOM элементы
+const messageContainer = document.getElementById('message-container');
+const messageForm = document.getElementById('message-form');
+const messageInput = document.getElementById('message-input');
+const sendButton = document.getElementById('send-button');
+const previewContainer = document.getElementById('preview-container');
+const previewItems = document.getElementById('preview-items');
+const recordingIndicator = document.getElementById('recording-indicator');
+const recordingTimer = document.getElementById('recording-timer');
+const typingIndicator = document.getElementById('typing-indicator');
+const typingText = document.getElementById('typing-text');
+
+// Состояние
+let typingTimeout;
+let isConnected = false;
+let mediaFiles = [];
+let isRecording = false;
+let mediaRecorder;
+let audioChunks = [];
+let recordingStartTime;
+let recordingInterval;
+
+// ==================== ОСНОВНЫЕ ФУНКЦИИ ЧАТА ====================
+
+// Авторесайз текстового поля
+function autoResize(textarea) {
+    textarea.style.height = 'auto';
+    const newHeight = Math.min(textarea.scrollHeight, 150);
+    textarea.style.height = newHeight + 'px';
+}
+
+// Прокрутка вниз
+function scrollToBottom() {
+    messageContainer.scrollTop = messageContainer.scrollHeight;
+}
+
+// Экранирование HTML
+function escapeHtml(text) {
+    const div = document.createElement('div');
+    div.textContent = text;
+    return div.innerHTML;
+}
+
+// Форматирование времени
+function formatTime() {
+    const now = new Date();
+    return now.toLocaleTimeString([], {hour: '2-digit', minute:'2-digit'});
+}
+
+// Форматирование размера файла
+function formatFileSize(bytes) {
+    if (bytes < 1024) return bytes + ' B';
+    if (bytes < 1024 * 1024) return (bytes / 1024).toFixed(1) + ' KB';
+    if (bytes < 1024 * 1024 * 1024) return (bytes / (1024 * 1024)).toFixed(1) + ' MB';
+    return (bytes / (1024 * 1024 * 1024)).toFixed(1) + ' GB';
+}
+
+// ==================== ФУНКЦИИ ДОБАВЛЕНИЯ СООБЩЕНИЙ ====================
+
+function acceptSeq(seq) {
+    // false - повтор; опоздавший меньший номер - не повтор, если его еще не было
+    if (seq <= lastSeq || aheadSeqs.has(seq)) return false;
+    aheadSeqs.add(seq);
+    while (aheadSeqs.has(lastSeq + 1)) {
+        lastSeq += 1;
+        aheadSeqs.delete(lastSeq);
+    }
+    if (aheadSeqs.size && !seqGapTimer) {
+        // Сервер сам дошлет недостающее; чего нет и у него (отозванные) - пропускаем
+        seqGapTimer = setTimeout(function() {
+            seqGapTimer = null;
+            if (aheadSeqs.size) {
+                lastSeq = Math.max(...aheadSeqs);
+                aheadSeqs.clear();
+            }
+        }, SEQ_GAP_TIMEOUT);
+    }
+    return true;
+}
+
+function insertMessage(messageDiv, seq) {
+    // Опоздавшее сообщение встает перед уже показанными с большим номером
+    if (seq !== undefined) {
+        messageDiv.dataset.seq = seq;
+        const later = Array.from(messageContainer.querySelectorAll('.message[data-seq]'))
+            .find(element => Number(element.dataset.seq) > seq);
+        if (later) {
+            messageContainer.insertBefore(messageDiv, later);
+            return;
+        }
+    }
+    messageContainer.appendChild(messageDiv);
+}
+
+function senderLabel(data) {
+    // sender_avatar - готовый вариант аватара с сервера (accounts.avatars)
+    let html = '';
+    if (data.sender_avatar) {
+        html += `<img src="${escapeHtml(data.sender_avatar)}" alt="" width="20" height="20" class="w-5 h-5 rounded-full inline-block mr-2" loading="lazy" decoding="async">`;
+    }
+    return html + `<span class="sender-name">${escapeHtml(data.sender_username)}</span>`;
+}
+
+function addMessageToChat(data) {
+    const isOwnMessage = data.sender_id === userId;
+    const messageDiv = document.createElement('div');
+    messageDiv.className = 'message';
+    messageDiv.dataset.messageId = data.message_id;
+
+    let html = '';
+
+    if (!isOwnMessage) {
+        html += senderLabel(data);
+    }
+
+    html += `<div class="message-bubble ${isOwnMessage ? 'own-message' : 'other-message'}">`;
+    if (data.deleted) {
+        html += `<div class="message-text message-deleted"><i>Сообщение удалено</i></div>`;
+    } else {
+        html += `<div class="message-text">${escapeHtml(data.message).replace(/\n/g, '<br>')}</div>`;
+    }
+    html += `<span class="message-time">${formatTime()}`;
+    if (isOwnMessage) {
+        html += `<i class="fas fa-check ml-1 text-gray-400"></i>`;
+    }
+    html += `</span></div>`;
+
+    messageDiv.innerHTML = html;
+    insertMessage(messageDiv, data.seq);
+    scrollToBottom();
+}
+
+function addMediaMessageToChat(data) {
+    const isOwnMessage = data.sender_id === userId;
+    const messageDiv = document.createElement('div');
+    messageDiv.className = 'message';
+    messageDiv.dataset.messageId = data.message_id;
+
+    let html = '';
+
+    if (!isOwnMessage) {
+        html += senderLabel(data);
+    }
+
+    html += `<div class="message-bubble ${isOwnMessage ? 'own-message' : 'other-message'}">`;
+
+    if (data.content) {
+        html += `<div class="message-text">${escapeHtml(data.content).replace(/\n/g, '<br>')}</div>`;
+    }
+
+    html += `<div class="media-message">`;
+
+    if (data.media.type === 'image') {
+        html += `<div class="media-preview" onclick="openMedia('${data.media.url}')">`;
+        const size = data.media.width ? ` width="${data.media.width}" height="${data.media.height}"` : '';
+        const placeholder = data.media.placeholder ? ` data-placeholder="${data.media.placeholder}"` : '';
+        html += `<img src="${data.media.thumbnail_url || data.media.url}" class="media-image"${size}${placeholder} loading="lazy" decoding="async">`;
+        html += `</div>`;
+    }
+    else if (data.media.type === 'video') {
+        html += `<div class="media-preview" onclick="openMedia('${data.media.url}')">`;
+        html += `<video controls class="media-video" preload="metadata"${data.media.poster_url ? ` poster="${data.media.poster_url}"` : ''}>`;
+        html += `<source src="${data.media.url}" type="video/mp4">`;
+        html += `</video>`;
+        html += `</div>`;
+    }
+    else if (data.media.type === 'document') {
+        const ext = data.media.name.split('.').pop().toLowerCase();
+        let icon = 'fa-file';
+        if (ext === 'pdf') icon = 'fa-file-pdf';
+        else if (['doc', 'docx'].includes(ext)) icon = 'fa-file-word';
+        else if (ext === 'txt') icon = 'fa-file-alt';
+
+        html += `<div class="media-document" onclick="downloadFile('${data.media.url}', '${escapeHtml(data.media.name)}')">`;
+        html += `<div class="document-icon"><i class="fas ${icon}"></i></div>`;
+        html += `<div class="document-info">`;
+        html += `<div class="document-name">${escapeHtml(data.media.name)}</div>`;
+        html += `<div class="document-size">${data.media.size}</div>`;
+        html += `</div>`;
+        html += `<div class="text-blue-600"><i class="fas fa-download"></i></div>`;
+        html += `</div>`;
+    }
+
+    html += `</div>`; // Закрываем media-message
+
+    html += `<span class="message-time">${formatTime()}`;
+    if (isOwnMessage) {
+        html += `<i class="fas fa-check ml-1 text-gray-400"></i>`;
+    }
+    html += `</span>`;
+    html += `</div>`; // Закрываем message-bubble
+
+    messageDiv.innerHTML = html;
+    applyPlaceholders(messageDiv);
+    insertMessage(messageDiv, data.seq);
+    scrollToBottom();
+}
+
+function addVoiceMessageToChat(data) {
+    const isOwnMessage = data.sender_id === userId;
+    const messageDiv = document.createElement('div');
+    messageDiv.className = 'message';
+    messageDiv.dataset.messageId = data.message_id;
+
+    let html = '';
+
+    if (!isOwnMessage) {
+        html += senderLabel(data);
+    }
+
+    html += `<div class="message-bubble ${isOwnMessage ? 'own-message' : 'other-message'}">`;
+    html += `<div class="media-message">`;
+    html += `<div class="voice-message">`;
+    html += `<button class="voice-play-btn" data-audio-url="${data.voice.url}" onclick="playVoiceMessage(this)">`;
+    html += `<i class="fas fa-play"></i>`;
+    html += `</button>`;
+    html += `<div class="voice-waveform"></div>`;
+    html += `<div class="voice-duration">${data.voice.duration} сек</div>`;
+    html += `</div></div>`;
+    html += `<span class="message-time">${formatTime()}`;
+    if (isOwnMessage) {
+        html += `<i class="fas fa-check ml-1 text-gray-400"></i>`;
+    }
+    html += `</span>`;
+    html += `</div>`;
+
+    messageDiv.innerHTML = html;
+    renderWaveform(messageDiv.querySelector('.voice-waveform'), data.voice.waveform);
+    insertMessage(messageDiv, data.seq);
+    scrollToBottom();
+}
+
+function renderWaveform(element, peaks) {
+    if (!element || !peaks || !peaks.length) return;
+    element.innerHTML = peaks.map(peak => `<span class="peak" style="height: ${Math.max(peak, 5)}%"></span>`).join('');
+    element.classList.add('has-peaks');
+}
+
+function updateMediaMessage(data) {
+    // Метаданные, извлеченные сервером после загрузки
+    const messageDiv = messageContainer.querySelector(`[data-message-id="${data.message_id}"]`);
+    if (!messageDiv) return;
+
+    if (data.voice) {
+        renderWaveform(messageDiv.querySelector('.voice-waveform'), data.voice.waveform);
+        const duration = messageDiv.querySelector('.voice-duration');
+        if (duration) duration.textContent = `${data.voice.duration} сек`;
+    } else if (data.media && data.media.poster_url) {
+        const video = messageDiv.querySelector('video');
+        if (video) video.poster = data.media.poster_url;
+    }
+}
+
+function patchMessage(data) {
+    // Правка, удаление или отзыв уже показанного сообщения
+    const messageDiv = messageContainer.querySelector(`[data-message-id="${data.message_id}"]`);
+    if (!messageDiv) return;
+
+    if (data.unsent) {
+        messageDiv.remove();
+        return;
+    }
+    const bubble = messageDiv.querySelector('.message-bubble');
+    if (data.deleted) {
+        bubble.querySelectorAll('.message-text, .media-message').forEach(element => element.remove());
+        bubble.insertAdjacentHTML('afterbegin', '<div class="message-text message-deleted"><i>Сообщение удалено</i></div>');
+        const edited = bubble.querySelector('.message-edited');
+        if (edited) edited.remove();
+        return;
+    }
+    if (data.content !== undefined) {
+        const text = bubble.querySelector('.message-text');
+        if (text) text.innerHTML = escapeHtml(data.content).replace(/\n/g, '<br>');
+    }
+    if (data.is_edited && !bubble.querySelector('.message-edited')) {
+        bubble.querySelector('.message-time').insertAdjacentHTML('afterbegin', '<span class="message-edited">изменено</span> ');
+    }
+}
+
+// ==================== ВОСПРОИЗВЕДЕНИЕ ГОЛОСОВЫХ ====================
+
+function playVoiceMessage(button) {
+    const audioUrl = button.dataset.audioUrl;
+    const icon = button.querySelector('i');
+
+    const audio = new Audio(audioUrl);
+
+    audio.addEventListener('play', () => {
+        icon.className = 'fas fa-pause';
+    });
+
+    audio.addEventListener('pause', () => {
+        icon.className = 'fas fa-play';
+    });
+
+    audio.addEventListener('ended', () => {
+        icon.className = 'fas fa-play';
+    });
+
+    audio.play();
+}
+
+// ==================== МЕДИА ФУНКЦИИ ====================
+
+// Прикрепление файлов
+document.getElementById('attach-file-btn').addEventListener('click', () => {
+    document.getElementById('file-input').click();
+});
+
+document.getElementById('camera-btn').addEventListener('click', () => {
+    document.getElementById('camera-input').click();
+});
+
+document.getElementById('gallery-btn').addEventListener('click', () => {
+    document.getElementById('gallery-input').click();
+});
+
+// Обработка выбранных файлов
+document.getElementById('file-input').addEventListener('change', handleFileSelect);
+document.getElementById('camera-input').addEventListener('change', handleFileSelect);
+document.getElementById('gallery-input').addEventListener('change', handleFileSelect);
+
+function handleFileSelect(event) {
+    const files = Array.from(event.target.files);
+    if (files.length === 0) return;
+
+    files.forEach(file => {
+        if (file.size > maxFileSize) {
+            alert(`Файл "${file.name}" слишком большой. Максимум: 50MB`);
+            return;
+        }
+
+        mediaFiles.push(file);
+        createFilePreview(file);
+    });
+
+    previewContainer.style.display = 'block';
+    event.target.value = '';
+}
+
+function createFilePreview(file) {
+    const previewItem = document.createElement('div');
+    previewItem.className = 'preview-item';
+    previewItem.dataset.filename = file.name;
+
+    const isImage = file.type.startsWith('image/');
+    const isVideo = file.type.startsWith('video/');
+
+    if (isImage) {
+        const reader = new FileReader();
+        reader.onload = function(e) {
+            const img = document.createElement('img');
+            img.src = e.target.result;
+            img.className = 'preview-image';
+            previewItem.appendChild(img);
+        };
+        reader.readAsDataURL(file);
+    } else if (isVideo) {
+        previewItem.innerHTML = `
+            <div class="preview-document">
+                <i class="fas fa-video text-blue-500 text-xl mb-2"></i>
+                <span class="text-xs text-center truncate w-full">${file.name}</span>
+            </div>
+        `;
+    } else {
+        const ext = file.name.split('.').pop().toLowerCase();
+        let icon = 'fa-file';
+        if (ext === 'pdf') icon = 'fa-file-pdf';
+        else if (['doc', 'docx'].includes(ext)) icon = 'fa-file-word';
+        else if (ext === 'txt') icon = 'fa-file-alt';
+        else if (['zip', 'rar', '7z'].includes(ext)) icon = 'fa-file-archive';
+
+        previewItem.innerHTML = `
+            <div class="preview-document">
+                <i class="fas ${icon} text-blue-500 text-xl mb-2"></i>
+                <span class="text-xs text-center truncate w-full">${file.name}</span>
+                <span class="text-xs text-gray-500">${formatFileSize(file.size)}</span>
+            </div>
+        `;
+    }
+
+    const removeBtn = document.createElement('button');
+    removeBtn.className = 'remove-preview';
+    removeBtn.innerHTML = '<i class="fas fa-times"></i>';
+    removeBtn.onclick = function() {
+        removeFilePreview(file.name);
+    };
+
+    previewItem.appendChild(removeBtn);
+    previewItems.appendChild(previewItem);
+}
+
+function removeFilePreview(filename) {
+    const index = mediaFiles.findIndex(f => f.name === filename);
+    if (index > -1) {
+        mediaFiles.splice(index, 1);
+    }
+
+    const preview = document.querySelector(`.preview-item[data-filename="${filename}"]`);
+    if (preview) preview.remove();
+
+    if (mediaFiles.length === 0) {
+        previewContainer.style.display = 'none';
+    }
+}
+
+function clearMediaPreview() {
+    mediaFiles = [];
+    previewItems.innerHTML = '';
+    previewContainer.style.display = 'none';
+}
+
+// ==================== ГОЛОСОВЫЕ СООБЩЕНИЯ ====================
+
+function startVoiceRecording() {
+    if (!navigator.mediaDevices || !window.MediaRecorder) {
+        alert('Ваш браузер не поддерживает запись голоса');
+        return;
+    }
+
+    navigator.mediaDevices.getUserMedia({ audio: true })
+        .then(stream => {
+            isRecording = true;
+            audioChunks = [];
+
+            recordingIndicator.style.display = 'flex';
+            document.getElementById('voice-message-btn').innerHTML = '<i class="fas fa-square text-red-500"></i>';
+
+            recordingStartTime = Date.now();
+            updateRecordingTimer();
+            recordingInterval = setInterval(updateRecordingTimer, 1000);
+
+            mediaRecorder = new MediaRecorder(stream, {
+                mimeType: 'audio/webm;codecs=opus'
+            });
+
+            mediaRecorder.ondataavailable = event => {
+                audioChunks.push(event.data);
+            };
+
+            mediaRecorder.onstop = async () => {
+                const audioBlob = new Blob(audioChunks, { type: 'audio/webm' });
+                await sendVoiceMessage(audioBlob);
+
+                recordingIndicator.style.display = 'none';
+                document.getElementById('voice-message-btn').innerHTML = '<i class="fas fa-microphone"></i>';
+
+                clearInterval(recordingInterval);
+                stream.getTracks().forEach(track => track.stop());
+            };
+
+            mediaRecorder.start();
+        })
+        .catch(error => {
+            console.error('Ошибка доступа к микрофону:', error);
+            alert('Не удалось получить доступ к микрофону. Проверьте разрешения.');
+        });
+}
+
+function stopVoiceRecording() {
+    if (isRecording && mediaRecorder && mediaRecorder.state !== 'inactive') {
+        isRecording = false;
+        mediaRecorder.stop();
+        clearInterval(recordingInterval);
+    }
+}
+
+function updateRecordingTimer() {
+    if (!recordingStartTime) return;
+
+    const elapsed = Math.floor((Date.now() - recordingStartTime) / 1000);
+    const minutes = Math.floor(elapsed / 60).toString().padStart(2, '0');
+    const seconds = (elapsed % 60).toString().padStart(2, '0');
+
+    recordingTimer.textContent = `${minutes}:${seconds}`;
+
+    if (elapsed >= 120) {
+        stopVoiceRecording();
+    }
+}
+
+async function sendVoiceMessage(audioBlob) {
+    const formData = new FormData();
+    const duration = Math.floor((Date.now() - recordingStartTime) / 1000);
+
+    formData.append('voice', audioBlob, `voice_${Date.now()}.webm`);
+    formData.append('duration', duration);
+    formData.append('chat_id', chatId);
+    formData.append('client_id', newClientId());
+
+    try {
+        const response = await fetch(`/chat/${chatId}/upload-voice/`, {
+            method: 'POST',
+            body: formData,
+            headers: {
+                'X-CSRFToken': document.querySelector('[name=csrfmiddlewaretoken]').value
+            }
+        });
+
+        // Сообщение рассылает сервер после сохранения: ждем его по сокету
+        const data = await response.json();
+        if (!data.success) {
+            console.error('Ошибка отправки голосового:', data.error);
+        }
+    } catch (error) {
+        console.error('Ошибка отправки голосового:', error);
+    }
+}
+
+// ==================== ОТПРАВКА СООБЩЕНИЙ ====================
+
+// Прямая загрузка в объектное хранилище; false - сервер ее не поддерживает
+let directUploads = true;
+
+async function uploadDirect(file, caption, clientId) {
+    const csrfToken = document.querySelector('[name=csrfmiddlewaretoken]').value;
+    const request = new FormData();
+    request.append('file_name', file.name);
+    request.append('file_size', file.size);
+    request.append('caption', caption);
+    request.append('client_id', clientId);
+
+    const response = await fetch(`/chat/${chatId}/upload-url/`, {
+        method: 'POST',
+        body: request,
+        headers: {'X-CSRFToken': csrfToken}
+    });
+    if (response.status === 501) {
+        directUploads = false;
+        return null;
+    }
+    const data = await response.json();
+    if (!data.success || data.duplicate) return data;
+
+    // Байты идут прямо в бакет, серверу - только подтверждение
+    const upload = new FormData();
+    Object.entries(data.upload.fields).forEach(([name, value]) => upload.append(name, value));
+    upload.append('file', file);
+    const stored = await fetch(data.upload.url, {method: 'POST', body: upload});
+    if (!stored.ok) return {success: false, error: 'Не удалось загрузить файл в хранилище'};
+
+    const confirm = new FormData();
+    confirm.append('token', data.token);
+    const confirmed = await fetch(`/chat/${chatId}/upload-confirm/`, {
+        method: 'POST',
+        body: confirm,
+        headers: {'X-CSRFToken': csrfToken}
+    });
+    return confirmed.json();
+}
+
+async function sendMediaFiles() {
+    if (mediaFiles.length === 0) return [];
+
+    const results = [];
+
+    for (const file of mediaFiles) {
+        const caption = messageInput.value.trim();
+        const clientId = newClientId();
+        if (directUploads) {
+            try {
+                const data = await uploadDirect(file, caption, clientId);
+                if (data) {
+                    if (data.success) results.push(data);
+                    else console.error('Ошибка загрузки файла:', data.error);
+                    continue;
+                }
+            } catch (error) {
+                console.error('Ошибка прямой загрузки файла:', error);
+                continue;
+            }
+        }
+
+        const formData = new FormData();
+        formData.append('file', file);
+        formData.append('chat_id', chatId);
+        formData.append('caption', caption);
+        formData.append('client_id', clientId);
+
+        try {
+            const response = await fetch(`/chat/${chatId}/upload-media/`, {
+                method: 'POST',
+                body: formData,
+                headers: {
+                    'X-CSRFToken': document.querySelector('[name=csrfmiddlewaretoken]').value
+                }
+            });
+
+            // Событие media_message приходит по сокету от сервера
+            const data = await response.json();
+            if (data.success) {
+                results.push(data);
+            }
+        } catch (error) {
+            console.error('Ошибка загрузки файла:', error);
+        }
+    }
+
+    return results;
+}
+
+messageForm.onsubmit = async function(e) {
+    e.preventDefault();
+
+    const message = messageInput.value.trim();
+    sendButton.disabled = true;
+
+    if (mediaFiles.length > 0) {
+        await sendMediaFiles();
+        clearMediaPreview();
+        messageInput.value = '';
+    }
+    else if (message && isConnected) {
+        chatSocket.send(JSON.stringify({
+            type: 'chat_message',
+            message: message,
+            client_id: newClientId()
+        }));
+        messageInput.value = '';
+    }
+
+    messageInput.style.height = 'auto';
+    messageInput.focus();
+
+    clearTimeout(typingTimeout);
+    if (isConnected) {
+        chatSocket.send(JSON.stringify({
+            type: 'typing',
+            is_typing: false
+        }));
+    }
+
+    sendButton.disabled = false;
+};
+
+// ==================== УТИЛИТЫ ====================
+
+// Id отправки: повтор с тем же id сервер не сохранит второй раз
+function newClientId() {
+    if (window.crypto && crypto.randomUUID) return crypto.randomUUID();
+    return `${Date.now().toString(36)}-${Math.random().toString(36).slice(2)}`;
+}
+
+function openMedia(url) {
+    window.open(url, '_blank');
+}
+
+function downloadFile(url, filename) {
+    const a = document.createElement('a');
+    a.href = url;
+    a.download = filename;
+    document.body.appendChild(a);
+    a.click();
+    document.body.removeChild(a);
+}
+
+// ==================== WebSocket ОБРАБОТЧИКИ ====================
+
+function connectSocket() {
+    chatSocket = new WebSocket(`${socketUrl}?last_seq=${lastSeq}`);
+
+    chatSocket.onopen = function() {
+        console.log('WebSocket соединение установлено');
+        isConnected = true;
+        reconnectDelay = 1000;
+        scrollToBottom();
+    };
+
+    chatSocket.onclose = function(e) {
+        console.log('WebSocket соединение закрыто', e);
+        isConnected = false;
+        if (e.code === 4009) {
+            // Чат на другом шарде: переподключаемся сразу, пропущенное дошлется по lastSeq
+            setTimeout(connectSocket, 0);
+            return;
+        }
+        setTimeout(connectSocket, reconnectDelay);
+        reconnectDelay = Math.min(reconnectDelay * 2, 30000);
+    };
+
+    chatSocket.onerror = function(error) {
+        console.error('WebSocket ошибка:', error);
+    };
+
+    chatSocket.onmessage = function(e) {
+        try {
+            const data = JSON.parse(e.data);
+
+            if (data.seq !== undefined && !acceptSeq(data.seq)) return;
+
+            if (data.type === 'chat_message') {
+                addMessageToChat(data);
+            } else if (data.type === 'media_message') {
+                addMediaMessageToChat(data);
+            } else if (data.type === 'voice_message') {
+                addVoiceMessageToChat(data);
+            } else if (data.type === 'media_updated') {
+                updateMediaMessage(data);
+            } else if (data.type === 'message_patch') {
+                patchMessage(data);
+            } else if (data.type === 'typing') {
+                if (data.is_typing && data.user_id !== userId) {
+                    typingText.textContent = `${data.username} печатает...`;
+                    typingIndicator.style.display = 'block';
+                } else {
+                    typingIndicator.style.display = 'none';
+                }
+            } else if (data.type === 'wrong_shard') {
+                if (data.url) socketUrl = data.url;
+            } else if (data.type === 'resync_required') {
+                // Пропущено слишком много - перезагружаем историю целиком
+                window.location.reload();
+            }
+        } catch (error) {
+            console.error('Ошибка обработки сообщения:', error);
+        }
+    };
+}
+
+connectSocket();
+
+// ==================== ИНИЦИАЛИЗАЦИЯ ====================
+
+document.addEventListener('DOMContentLoaded', function() {
+    messageInput.focus();
+    document.querySelectorAll('.voice-waveform[data-peaks]').forEach(element => {
+        renderWaveform(element, element.dataset.peaks.split(',').filter(Boolean).map(Number));
+    });
+    scrollToBottom();
+
+    messageInput.addEventListener('keydown', function(e) {
+        if (e.key === 'Enter' && !e.shiftKey) {
+            e.preventDefault();
+            messageForm.dispatchEvent(new Event('submit'));
+        }
+
+        if (e.key === 'Enter' && e.shiftKey) {
+            e.preventDefault();
+            const start = this.selectionStart;
+            const end = this.selectionEnd;
+            this.value = this.value.substring(0, start) + '\n' + this.value.substring(end);
+            this.selectionStart = this.selectionEnd = start + 1;
+            autoResize(this);
+        }
+    });
+
+    // Индикатор набора текста
+    messageInput.addEventListener('input', function() {
+        if (!isConnected) return;
+
+        chatSocket.send(JSON.stringify({
+            type: 'typing',
+            is_typing: true
+        }));
+
+        clearTimeout(typingTimeout);
+        typingTimeout = setTimeout(() => {
+            if (isConnected) {
+                chatSocket.send(JSON.stringify({
+                    type: 'typing',
+                    is_typing: false
+                }));
+            }
+        }, 1000);
+    });
+});
@@ -0,0 +1,115 @@
+// Фильтрация по типам
+document.querySelectorAll('.gallery-tab').forEach(tab => {
+    tab.addEventListener('click', function() {
+        // Убираем активный класс у всех табов
+        document.querySelectorAll('.gallery-tab').forEach(t => {
+            t.classList.remove('active');
+        });
+
+        // Добавляем активный класс текущему табу
+        this.classList.add('active');
+
+        const type = this.dataset.type;
+
+        // Показываем/скрываем секции
+        document.querySelectorAll('.media-section').forEach(section => {
+            if (type === 'all' || section.dataset.type === type) {
+                section.style.display = 'block';
+            } else {
+                section.style.display = 'none';
+            }
+        });
+    });
+});
+
+// Просмотр медиафайла
+document.querySelectorAll('.media-item').forEach(item => {
+    item.addEventListener('click', function(e) {
+        // Не открываем при клике на кнопки внутри
+        if (e.target.closest('button') || e.target.closest('a')) {
+            return;
+        }
+
+        const mediaId = this.dataset.mediaId;
+        const mediaType = this.dataset.type;
+
+        if (mediaType === 'image' || mediaType === 'video') {
+            // Открываем в новом окне
+            window.open(`/media/${mediaId}/view/`, '_blank');
+        } else if (mediaType === 'document') {
+            // Скачиваем документ
+            window.location.href = `/media/${mediaId}/download/`;
+        }
+    });
+});
+
+// Воспроизведение голосовых сообщений
+document.querySelectorAll('.play-voice-btn').forEach(btn => {
+    btn.addEventListener('click', function() {
+        const audioUrl = this.dataset.audioUrl;
+        const audio = new Audio(audioUrl);
+
+        // Меняем иконку при воспроизведении
+        const icon = this.querySelector('i');
+
+        audio.addEventListener('play', () => {
+            icon.classList.remove('fa-play');
+            icon.classList.add('fa-pause');
+        });
+
+        audio.addEventListener('pause', () => {
+            icon.classList.remove('fa-pause');
+            icon.classList.add('fa-play');
+        });
+
+        audio.addEventListener('ended', () => {
+            icon.classList.remove('fa-pause');
+            icon.classList.add('fa-play');
+        });
+
+        // Воспроизводим или ставим на паузу
+        if (audio.paused) {
+            audio.play();
+        } else {
+            audio.pause();
+        }
+    });
+});
+
+// Загрузка больше файлов при прокрутке (ленивая загрузка)
+const galleryChatId = document.querySelector('.gallery-container').dataset.chatId;
+let isLoading = false;
+let page = 1;
+
+window.addEventListener('scroll', function() {
+    if (isLoading) return;
+
+    const scrollPosition = window.innerHeight + window.scrollY;
+    const pageHeight = document.documentElement.scrollHeight;
+
+    if (scrollPosition >= pageHeight - 500) {
+        loadMoreMedia();
+    }
+});
+
+async function loadMoreMedia() {
+    isLoading = true;
+    page++;
+
+    try {
+        const activeTab = document.querySelector('.gallery-tab.active');
+        const type = activeTab ? activeTab.dataset.type : 'all';
+
+        const response = await fetch(`/chat/${galleryChatId}/media/?type=${type}&page=${page}`);
+        const data = await response.json();
+
+        if (data.success && data.media.length > 0) {
+            // Здесь можно добавить новую разметку
+            console.log('Загружено больше медиа:', data.media);
+        }
+    } catch (error) {
+        console.error('Ошибка загрузки:', error);
+    } finally {
+        isLoading = false;
+    }
+}
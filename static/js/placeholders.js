@@ -0,0 +1,45 @@
+// Заглушки изображений "4x3:<base64 RGB>" (messenger/placeholders.py):
+// сетка рисуется на canvas и растягивается фоном, пока грузится миниатюра.
+(function () {
+    const cache = new Map();
+
+    function placeholderUrl(placeholder) {
+        if (!placeholder) return null;
+        if (cache.has(placeholder)) return cache.get(placeholder);
+
+        const [size, data] = placeholder.split(':');
+        const [width, height] = size.split('x').map(Number);
+        const bytes = atob(data);
+        const canvas = document.createElement('canvas');
+        canvas.width = width;
+        canvas.height = height;
+        const context = canvas.getContext('2d');
+        const pixels = context.createImageData(width, height);
+        for (let i = 0; i < width * height; i++) {
+            pixels.data[i * 4] = bytes.charCodeAt(i * 3);
+            pixels.data[i * 4 + 1] = bytes.charCodeAt(i * 3 + 1);
+            pixels.data[i * 4 + 2] = bytes.charCodeAt(i * 3 + 2);
+            pixels.data[i * 4 + 3] = 255;
+        }
+        context.putImageData(pixels, 0, 0);
+        const url = canvas.toDataURL();
+        cache.set(placeholder, url);
+        return url;
+    }
+
+    function applyPlaceholder(img) {
+        const url = placeholderUrl(img.dataset.placeholder);
+        if (!url || img.complete) return;
+        img.style.backgroundImage = `url(${url})`;
+        img.style.backgroundSize = 'cover';
+        img.addEventListener('load', () => { img.style.backgroundImage = ''; }, { once: true });
+    }
+
+    function applyPlaceholders(root) {
+        (root || document).querySelectorAll('img[data-placeholder]').forEach(applyPlaceholder);
+    }
+
+    window.placeholderUrl = placeholderUrl;
+    window.applyPlaceholders = applyPlaceholders;
+    document.addEventListener('DOMContentLoaded', () => applyPlaceholders());
+})();